@@ -0,0 +1,134 @@
+"""
+End-to-end consumer throughput, without Kafka nor Cassandra.
+
+Replays synthetic events through ``MoisturizerKafkaConsumer`` with the
+stand-ins of ``harness.py`` and reports events per second, p50/p99 event
+latencies and memory for each scenario::
+
+    python benchmarks/bench_consumer.py
+    python benchmarks/bench_consumer.py churn mixed --events 50000
+
+Results can be saved as a baseline, and later runs compared against it,
+failing on throughput or p99 regressions beyond ``--tolerance``::
+
+    python benchmarks/bench_consumer.py --save
+    python benchmarks/bench_consumer.py --compare
+
+Baselines depend on the machine, and are not versioned.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+
+from harness import EventGenerator, run
+
+
+SCENARIOS = {
+    'flat': {'types': 10, 'fields': 10},
+    'nested': {'types': 10, 'fields': 30, 'depth': 3},
+    'churn': {'types': 10, 'fields': 10, 'churn': 0.01},
+    'mixed': {'types': 10, 'fields': 10, 'msgpack': 0.5},
+    'many_types': {'types': 500, 'fields': 10},
+}
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'baseline.json')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='bench_consumer')
+    parser.add_argument('scenarios', nargs='*',
+                        help='scenarios to run among {}, defaults to '
+                             'all'.format(', '.join(sorted(SCENARIOS))))
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--latency-ms', type=float, default=0,
+                        help='simulated Cassandra round trip')
+    parser.add_argument('--engine', default='colander',
+                        help='schema engine, colander or compiled')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='executor worker processes')
+    parser.add_argument('--no-batch', action='store_true',
+                        help='write events one by one')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='report the tracemalloc peak, slower')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save', action='store_true',
+                        help='save results as the baseline')
+    parser.add_argument('--compare', action='store_true',
+                        help='fail on regressions against the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: {}'.format(', '.join(unknown)))
+    return args
+
+
+def regressions(name, result, baseline, tolerance):
+    if baseline['events_per_second'] * (1 - tolerance) > \
+            result['events_per_second']:
+        yield '{}: {:.0f} events/s, baseline {:.0f}'.format(
+            name, result['events_per_second'],
+            baseline['events_per_second'])
+
+    if result['p99_ms'] > baseline['p99_ms'] * (1 + tolerance):
+        yield '{}: p99 {:.2f} ms, baseline {:.2f}'.format(
+            name, result['p99_ms'], baseline['p99_ms'])
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.getLogger('moisturizer').setLevel(logging.WARNING)
+
+    settings = {
+        'schema.engine': args.engine,
+        'executor.workers': args.workers,
+        'batch.enabled': not args.no_batch,
+        'kafka.max_poll_records': args.batch_size,
+    }
+
+    results = {}
+    for name in args.scenarios or sorted(SCENARIOS):
+        generator = EventGenerator(**SCENARIOS[name])
+        batches = generator.batches(args.events, args.batch_size)
+        result = results[name] = run(batches, settings, args.latency_ms,
+                                     args.trace_memory)
+
+        print('{:<11} {:9.0f} events/s  p50 {:7.2f} ms  p99 {:7.2f} ms  '
+              'rss {:6.1f} MB{}'.format(
+                  name, result['events_per_second'], result['p50_ms'],
+                  result['p99_ms'], result['max_rss_mb'],
+                  '' if result['traced_peak_mb'] is None else
+                  '  traced {:6.1f} MB'.format(result['traced_peak_mb'])))
+
+    if args.save:
+        saved = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                saved = json.load(f)
+        saved.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(saved, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+
+        failures = [failure for name, result in results.items()
+                    if name in baselines
+                    for failure in regressions(name, result, baselines[name],
+                                               args.tolerance)]
+        for failure in failures:
+            print('Regression in ' + failure)
+        if failures:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,69 @@
+"""
+Flattening and inference of nested payloads.
+
+Compares ``flatten_json`` with a null filter and a separate
+``infer_schema_change()`` pass against the single-pass
+``flatten_object()``::
+
+    python benchmarks/bench_flatten.py
+
+"""
+import timeit
+
+import flatten_json
+
+from moisturizer.models import DescriptorModel, DescriptorFieldType
+from moisturizer.utils import KeyCache, flatten_object
+
+
+PAYLOADS = {
+    'flat': {'id': '1', 'user': 'alice', 'status': 200, 'latency': 0.25,
+             'path': '/index', 'referrer': None},
+    'nested': {'id': '1', 'request': {'method': 'GET', 'path': '/index',
+                                      'headers': {'host': 'a', 'agent': 'b'}},
+               'response': {'status': 200, 'size': 512, 'error': None},
+               'tags': ['a', 'b', 'c']},
+    'deep': {'id': '1', 'a': {'b': {'c': {'d': {'e': {'f': [1, 2, 3]}}}}}},
+}
+
+NUMBER = 20000
+
+
+def make_descriptor(payload):
+    descriptor = DescriptorModel(id='bench')
+    for key, value in flatten_json.flatten(payload, separator='__').items():
+        if value is not None:
+            descriptor.properties[key] = DescriptorFieldType.from_value(value)
+    return descriptor
+
+
+def current(payload, descriptor):
+    flatten = {k: v for k, v in
+               flatten_json.flatten(payload, separator='__').items()
+               if v is not None}
+    descriptor.infer_schema_change(flatten)
+    return flatten
+
+
+def fused(payload, descriptor, keys):
+    return flatten_object(payload, keys, known=descriptor.properties,
+                          infer=DescriptorFieldType.from_value)
+
+
+def main():
+    keys = KeyCache(separator='__')
+
+    for name, payload in PAYLOADS.items():
+        descriptor = make_descriptor(payload)
+        before = timeit.timeit(lambda: current(payload, descriptor),
+                               number=NUMBER)
+        after = timeit.timeit(lambda: fused(payload, descriptor, keys),
+                              number=NUMBER)
+
+        print('{:<8} current {:7.2f} us  fused {:7.2f} us  {:5.2f}x'.format(
+            name, before / NUMBER * 1e6, after / NUMBER * 1e6,
+            before / after))
+
+
+if __name__ == '__main__':
+    main()
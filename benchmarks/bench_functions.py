@@ -0,0 +1,149 @@
+"""
+Micro-benchmarks of the functions run for every event.
+
+Times each function over payloads of growing width and depth, keeping the
+best of ``--repeat`` runs so results are stable enough to compare across
+commits::
+
+    python benchmarks/bench_functions.py --output before.json
+    git checkout my-optimization
+    python benchmarks/bench_functions.py --compare before.json
+
+``--filter`` runs the benchmarks whose name contains a string only.
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import timeit
+
+import msgpack
+
+from harness import EventGenerator
+from moisturizer.decoders import decoders, unwrap_payload
+from moisturizer.models import (
+    DescriptorModel,
+    DescriptorFieldType,
+    InferredModel,
+)
+from moisturizer.schemas import SCHEMA_ENGINES, InferredObjectSchema
+from moisturizer.utils import flatten_dict, unflatten_dict
+
+
+WIDTHS = (10, 50, 200)
+DEPTHS = (0, 3)
+
+
+def make_payload(width, depth):
+    return EventGenerator(fields=width, depth=depth).event(0)['data']
+
+
+def make_descriptor(flatten):
+    descriptor = DescriptorModel(id='bench')
+    for key, value in flatten.items():
+        descriptor.properties[key] = DescriptorFieldType.from_value(value)
+    return descriptor
+
+
+def benchmarks(payload):
+    """``(name, function)`` pairs timed over ``payload``."""
+
+    schema = InferredObjectSchema()
+    flatten = schema.flatten(payload)
+    descriptor = make_descriptor(flatten)
+    fields = list(descriptor.properties.values())
+    values = list(flatten.values())
+
+    as_json = json.dumps({'type_id': 'bench', 'data': payload}).encode()
+    as_msgpack = msgpack.packb({'type_id': 'bench', 'data': payload},
+                               use_bin_type=True)
+
+    yield 'unwrap_message[json]', lambda: unwrap_payload(
+        decoders.decode(as_json))
+    yield 'unwrap_message[msgpack]', lambda: unwrap_payload(
+        decoders.decode(as_msgpack))
+    yield 'schema.flatten', lambda: schema.flatten(payload)
+    yield 'schema.unflatten', lambda: schema.unflatten(flatten)
+    yield 'utils.flatten_dict', lambda: flatten_dict(payload, '__')
+    yield 'utils.unflatten_dict', lambda: unflatten_dict(flatten, '__')
+
+    for engine, bind in sorted(SCHEMA_ENGINES.items()):
+        bound = bind(schema, descriptor=descriptor)
+        yield 'schema.bind[{}]'.format(engine), (
+            lambda bind=bind: bind(schema, descriptor=descriptor))
+        yield 'schema.deserialize[{}]'.format(engine), (
+            lambda bound=bound: bound.deserialize(payload))
+
+    # Per payload, over all of its fields.
+    yield 'DescriptorFieldType.from_value', lambda: [
+        DescriptorFieldType.from_value(value) for value in values]
+    yield 'DescriptorFieldType.as_column', lambda: [
+        field.as_column() for field in fields]
+    yield 'InferredModel.from_descriptor', lambda: (
+        InferredModel.from_descriptor(descriptor))
+
+
+def measure(function, repeat):
+    """Best time of a call to ``function``, in seconds."""
+
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='bench_functions')
+    parser.add_argument('--filter', default='')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='save results to a JSON file')
+    parser.add_argument('--compare', help='compare with saved results')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+
+    results = {}
+    for width in WIDTHS:
+        for depth in DEPTHS:
+            payload = make_payload(width, depth)
+            for name, function in benchmarks(payload):
+                if args.filter not in name:
+                    continue
+
+                key = '{} width={} depth={}'.format(name, width, depth)
+                elapsed = results[key] = measure(function, args.repeat)
+
+                line = '{:<52} {:10.2f} us'.format(key, elapsed * 1e6)
+                if key in previous:
+                    line += '  {:5.2f}x'.format(previous[key] / elapsed)
+                print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'commit': commit(),
+                'python': platform.python_version(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
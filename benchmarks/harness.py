@@ -0,0 +1,254 @@
+"""
+Synthetic events and in-process stand-ins for Kafka and Cassandra.
+
+Drives ``MoisturizerKafkaConsumer`` end to end without a cluster: a
+``ReplayConsumer`` serves pre-generated ``getmany()`` batches and a
+``FakeSession`` answers queries, optionally after a simulated round trip.
+"""
+import asyncio
+import collections
+import json
+import random
+import resource
+import time
+import tracemalloc
+
+import msgpack
+from cassandra.cqlengine import models
+
+from moisturizer.consumer import MoisturizerKafkaConsumer
+
+
+Record = collections.namedtuple('Record', ['topic', 'partition', 'offset',
+                                           'key', 'value', 'headers',
+                                           'timestamp'])
+
+
+class EventGenerator:
+    """
+    Generates Kafka records of synthetic events.
+
+    Events are spread over ``types`` types of ``fields`` fields each,
+    nested ``depth`` levels deep. A ``churn`` fraction of events carries a
+    field never seen before, and a ``msgpack`` fraction is encoded in
+    msgpack instead of JSON.
+    """
+
+    def __init__(self, types=10, fields=10, depth=0, churn=0.0, msgpack=0.0,
+                 partitions=4, seed=0):
+        self.types = ['type_{:04d}'.format(n) for n in range(types)]
+        self.fields = fields
+        self.depth = depth
+        self.churn = churn
+        self.msgpack = msgpack
+        self.partitions = partitions
+        self.random = random.Random(seed)
+        self.new_fields = 0
+
+    def value(self, n):
+        kind = n % 4
+        if kind == 0:
+            return self.random.randint(0, 1 << 30)
+        if kind == 1:
+            return self.random.random()
+        if kind == 2:
+            return 'value-{}'.format(self.random.randint(0, 1000))
+        return self.random.random() < 0.5
+
+    def event(self, index):
+        data = {'id': 'event-{}'.format(index)}
+        for n in range(self.fields):
+            node = data
+            for level in range(n % (self.depth + 1)):
+                node = node.setdefault('level_{}'.format(level), {})
+            node['field_{}'.format(n)] = self.value(n)
+
+        if self.churn and self.random.random() < self.churn:
+            self.new_fields += 1
+            data['extra_{}'.format(self.new_fields)] = self.value(
+                self.new_fields)
+
+        return {'type_id': self.random.choice(self.types), 'data': data}
+
+    def encode(self, event):
+        if self.random.random() < self.msgpack:
+            return (msgpack.packb(event, use_bin_type=True),
+                    [('content-type', b'application/msgpack')])
+        return json.dumps(event).encode(), []
+
+    def batches(self, events, batch_size=500):
+        """``getmany()`` batches holding ``events`` records in total."""
+
+        offsets = collections.Counter()
+        batches = []
+        for start in range(0, events, batch_size):
+            batch = collections.defaultdict(list)
+            for index in range(start, min(start + batch_size, events)):
+                partition = index % self.partitions
+                value, headers = self.encode(self.event(index))
+                batch[partition].append(Record(
+                    'bench', partition, offsets[partition], None, value,
+                    headers, int(time.time() * 1000)))
+                offsets[partition] += 1
+            batches.append(dict(batch))
+        return batches
+
+
+class ReplayConsumer:
+    """Serves replayed batches to ``getmany()``, then stops their owner."""
+
+    def __init__(self, **options):
+        self.options = options
+        self.batches = []
+        self.owner = None
+        self.position = 0
+        self.fetched_at = {}
+        self.highwaters = collections.Counter()
+
+    def replay(self, batches, owner):
+        self.batches = batches
+        self.owner = owner
+        for batch in batches:
+            for partition, records in batch.items():
+                self.highwaters[partition] += len(records)
+
+    def subscribe(self, topics, listener=None):
+        pass
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def assignment(self):
+        return set(self.highwaters)
+
+    def pause(self, *partitions):
+        pass
+
+    def resume(self, *partitions):
+        pass
+
+    def highwater(self, partition):
+        return self.highwaters[partition]
+
+    async def commit(self, offsets):
+        pass
+
+    async def getmany(self, *partitions, timeout_ms=0, max_records=None):
+        if self.position >= len(self.batches):
+            self.owner.stop()
+            return {}
+
+        batch = self.batches[self.position]
+        self.position += 1
+        if self.position == len(self.batches):
+            self.owner.stop()
+
+        now = time.perf_counter()
+        for partition, records in batch.items():
+            for record in records:
+                self.fetched_at[partition, record.offset] = now
+        return batch
+
+
+class FakeSession:
+    """
+    Answers ``aiosession`` queries after ``latency_ms``.
+
+    Lightweight transactions always apply.
+    """
+
+    def __init__(self, latency_ms=0):
+        self.latency = latency_ms / 1000
+        self.queries = 0
+
+    async def execute_future(self, query, parameters=None):
+        self.queries += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        query = query.query_string
+        if query.startswith(('INSERT', 'UPDATE')) and ' IF ' in query:
+            return [{'[applied]': True}]
+        return []
+
+
+class BenchConsumer(MoisturizerKafkaConsumer):
+    """Consumes ``batches`` from a ``ReplayConsumer``."""
+
+    kafka_consumer_class = ReplayConsumer
+    batches = ()
+    kafka = None
+
+    def create_kafka_consumer(self):
+        self.kafka = super().create_kafka_consumer()
+        self.kafka.replay(self.batches, self)
+        return self.kafka
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def run(batches, settings=None, latency_ms=0, trace_memory=False):
+    """
+    Consumes ``batches`` with a fresh consumer and reports its throughput.
+
+    Latencies run from the ``getmany()`` call returning an event to the
+    acknowledgement of its write.
+    """
+
+    models.DEFAULT_KEYSPACE = 'bench'
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    session = FakeSession(latency_ms)
+    consumer = BenchConsumer(
+        cluster='localhost:9092', topics=['bench'], group='bench',
+        event_loop=loop, session=session, settings=dict(
+            {'metrics.log_interval_ms': 0}, **(settings or {})))
+    consumer.batches = batches
+
+    latencies = []
+    ack = consumer.offsets.ack
+
+    def timed_ack(partition, offset):
+        latencies.append(time.perf_counter() -
+                         consumer.kafka.fetched_at[partition, offset])
+        ack(partition, offset)
+
+    consumer.offsets.ack = timed_ack
+
+    if trace_memory:
+        tracemalloc.start()
+
+    started = time.perf_counter()
+    try:
+        loop.run_until_complete(consumer.start())
+    finally:
+        loop.close()
+    elapsed = time.perf_counter() - started
+
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+
+    events = sum(len(records) for batch in batches
+                 for records in batch.values())
+    latencies.sort()
+    return {
+        'events': events,
+        'acked': len(latencies),
+        'events_per_second': events / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_rss_mb': resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'traced_peak_mb': peak,
+        'queries': session.queries,
+    }
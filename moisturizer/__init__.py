@@ -1,6 +1,7 @@
 import os
 import logging
 import asyncio
+import signal
 
 from aiocassandra import aiosession
 from cassandra.cluster import Cluster
@@ -42,30 +43,42 @@ def migrate_tables(settings):
     })
 
 
-def async_start(settings, cassandra_session):
-    """Starts the main async loop."""
-
-    loop = asyncio.get_event_loop()
-    # loop.set_debug(True)
-
-    consumer = MoisturizerKafkaConsumer(
+def create_consumer(settings, cassandra_session, loop):
+    return MoisturizerKafkaConsumer(
         cluster=settings.get('kafka.cluster'),
         topics=settings.get('kafka.topics').split(','),
         group=settings.get('kafka.group'),
         event_loop=loop,
+        settings=settings,
+        session=cassandra_session,
     )
 
+
+def async_start(settings, cassandra_session, loop=None, consumer=None):
+    """Starts the main async loop."""
+
+    loop = loop or asyncio.get_event_loop()
+    # loop.set_debug(True)
+
+    consumer = consumer or create_consumer(settings, cassandra_session, loop)
+
+    # Finish the batch being consumed on shutdown.
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, consumer.stop)
+
     aiosession(cassandra_session, loop=loop)
     loop.run_until_complete(consumer.start())
 
 
-def main(settings):
+def connect(settings, migrate=True):
+    """Connects to Cassandra, migrating the keyspace and descriptors."""
+
     cluster = Cluster([settings['cassandra.cluster']])
     session = cluster.connect()
     session.row_factory = dict_factory
     connection.set_session(session)
 
-    allow_migration = not settings['cassandra.immutable_schema']
+    allow_migration = migrate and not settings['cassandra.immutable_schema']
 
     # Prevent CQL engine migration warnings.
     os.environ['CQLENG_ALLOW_SCHEMA_MANAGEMENT'] = str(allow_migration)
@@ -79,5 +92,11 @@ def main(settings):
     if allow_migration:
         migrate_tables(settings)
 
+    return session
+
+
+def main(settings):
+    session = connect(settings)
+
     logger.info("Starting consumer async loop.")
     return async_start(settings, session)
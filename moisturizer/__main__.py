@@ -1,6 +1,44 @@
+import argparse
+
 from moisturizer import main
 from moisturizer.config import settings
 
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='moisturizer')
+    commands = parser.add_subparsers(dest='command')
+
+    commands.add_parser('consume', help='run a single consumer (default)')
+
+    supervise = commands.add_parser(
+        'supervise', help='run consumers in worker processes')
+    supervise.add_argument(
+        '-w', '--workers', type=int, default=None,
+        help='number of worker processes, defaults to the CPU count')
+
+    import_ = commands.add_parser(
+        'import', help='import JSON lines or msgpack files, bypassing Kafka')
+    import_.add_argument('files', nargs='+', help='files, optionally gzipped')
+    import_.add_argument(
+        '-f', '--format', choices=('jsonl', 'msgpack'), default=None,
+        help='format of the files, defaults to their extension')
+    import_.add_argument(
+        '-w', '--workers', type=int, default=None,
+        help='number of decoding processes, defaults to executor.workers')
+
+    return parser.parse_args(argv)
+
+
 if __name__ == '__main__':
-    main(settings)
+    args = parse_args()
+
+    if args.command == 'supervise':
+        from moisturizer.supervisor import supervise
+        supervise(settings, workers=args.workers)
+    elif args.command == 'import':
+        from moisturizer.importer import import_files
+        if args.workers is not None:
+            settings['executor.workers'] = args.workers
+        import_files(settings, args.files, format=args.format)
+    else:
+        main(settings)
@@ -8,6 +8,45 @@ DEFAULT_SETTINGS = {
     'kafka.cluster': '0.0.0.0:9092',
     'kafka.topics': 'logs',
     'kafka.group': 'moisturizer',
+    'kafka.fetch_min_bytes': 1,
+    'kafka.fetch_max_bytes': 52428800,
+    'kafka.fetch_max_wait_ms': 500,
+    'kafka.max_partition_fetch_bytes': 1048576,
+    'kafka.max_poll_records': 500,
+    'kafka.poll_timeout_ms': 1000,
+    'kafka.commit_interval_ms': 5000,
+    'kafka.max_unacked': 10000,
+    'kafka.content_type_header': 'content-type',
+    'kafka.type_source': 'payload',
+    'kafka.type_header': 'type-id',
+    'kafka.blocked_types': '',
+    'kafka.unknown_types': 'create',
+
+    'batch.enabled': False,
+    'batch.max_messages': 500,
+    'batch.max_latency_ms': 50,
+    'batch.max_statements': 50,
+    'batch.max_bytes': 5120,
+    'batch.coalesce': True,
+
+    'schema.cache_size': 1024,
+    'schema.engine': 'colander',
+    'schema.max_parked': 10000,
+
+    'descriptor.poll_interval_ms': 5000,
+
+    'executor.workers': 0,
+
+    'id.strategy': 'uuid',
+    'id.field': 'event_id',
+
+    'timestamp.source': 'none',
+    'timestamp.field': 'last_modified',
+
+    'supervisor.workers': 0,
+    'supervisor.restart_delay_ms': 1000,
+    'supervisor.report_interval_ms': 10000,
+    'supervisor.shutdown_timeout_ms': 30000,
 
     'cassandra.cluster': '0.0.0.0',
     'cassandra.keyspace_default': 'moisturizer',
@@ -15,8 +54,35 @@ DEFAULT_SETTINGS = {
     'cassandra.create_keyspaces': True,
     'cassandra.override_keyspaces': False,
     'cassandra.immutable_schema': False,
+    'cassandra.max_in_flight': 128,
+    'cassandra.max_retries': 3,
+    'cassandra.retry_delay_ms': 100,
 
     'raven.sentry_dsn': '',
+
+    'errors.sample_interval_ms': 60000,
+    'errors.sample_burst': 10,
+    'errors.max_queue': 100,
+    'errors.dead_letter': '',
+    'errors.dead_letter_topic': 'moisturizer-dead-letters',
+    'errors.dead_letter_path': 'dead-letters.jsonl',
+
+    'metrics.host': '0.0.0.0',
+    'metrics.port': 0,
+    'metrics.log_interval_ms': 60000,
+    'metrics.max_shapes': 1024,
+    'metrics.shape_sample_interval': 100,
+
+    'profiling.sample_rate': 0.0,
+    'profiling.engine': 'stack',
+    'profiling.stack_interval_ms': 1,
+    'profiling.output_dir': 'profiles',
+    'profiling.dump_interval_ms': 60000,
+    'profiling.slow_event_ms': 0,
+    'profiling.tracemalloc_signal': '',
+
+    'import.chunk_size': 1000,
+    'import.concurrency': 4,
 }
 
 
@@ -32,9 +98,24 @@ def get_config_environ(name):
     return os.environ.get(env_name)
 
 
+def coerce_setting(value, default):
+    """Casts an environment string to the type of the default value."""
+
+    if isinstance(default, bool):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+
+    if isinstance(default, (int, float)):
+        return type(default)(value)
+
+    return value
+
+
 def load_settings(**settings):
     for name, value in DEFAULT_SETTINGS.items():
-        settings.setdefault(name, get_config_environ(name) or value)
+        environ = get_config_environ(name)
+        if environ:
+            value = coerce_setting(environ, value)
+        settings.setdefault(name, value)
 
     for name in REQUIRED_SETTINGS:
         if settings.get(name) is None:
@@ -1,83 +1,673 @@
 import asyncio
-import json
-import msgpack
+import collections
+import logging
+import pickle
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
 
-from kafka import KafkaConsumer
+from aiokafka import AIOKafkaConsumer, ConsumerRebalanceListener
+from cassandra.cqlengine import connection
 
-from moisturizer.models import DescriptorModel
-from moisturizer.schemas import InferredObjectSchema
-from moisturizer.config import raven
+from moisturizer.decoders import decoders, unwrap_payload
+from moisturizer.descriptors import DescriptorRegistry
+from moisturizer.executor import DescriptorSnapshot, prepare_records
+from moisturizer.metrics import (
+    Metrics,
+    MetricsServer,
+    log_metrics,
+    render_prometheus,
+)
+from moisturizer.models import (
+    ID_STRATEGIES,
+    assign_id,
+    model_cache,
+    record_id,
+)
+from moisturizer.offsets import OffsetTracker, RecordAck
+from moisturizer.profiling import MemoryTracer, Profiler
+from moisturizer.reporting import ErrorReporter, create_dead_letters
+from moisturizer.utils import timestamp_micros
+from moisturizer.migrations import SchemaMigrator, SchemaChangeWorker
+from moisturizer.schemas import InferredObjectSchema, SchemaCache
+from moisturizer.writer import BatchWriter
+from moisturizer.config import raven, load_settings
+
+
+def record_header(record, name):
+    """Value of a Kafka record header as text, if present."""
+
+    for key, value in getattr(record, 'headers', None) or ():
+        if key.lower() == name.lower() and value is not None:
+            return value.decode('latin-1')
+
+
+logger = logging.getLogger('moisturizer.consumer')
+
+
+def record_key(record):
+    # Undecodable keys fail as unknown types, not out of the consumer.
+    if record.key is not None:
+        return record.key.decode('utf-8', errors='replace')
 
 
 class MoisturizerKafkaConsumer:
 
     _loop = None
-    descriptors = {}
+    _running = False
     schema = InferredObjectSchema()
+    decoders = decoders
+    kafka_consumer_class = AIOKafkaConsumer
+    pool_class = ProcessPoolExecutor
+    pool = None
 
-    def __init__(self, cluster, topics, group, event_loop):
+    def __init__(self, cluster, topics, group, event_loop, settings=None,
+                 session=None):
         self.cluster = cluster
         self.topics = topics
         self.group = group
         self._loop = event_loop
+        self.settings = load_settings(**(settings or {}))
+        self.session = session or connection.get_session()
+        self.schemas = SchemaCache(self.schema,
+                                   max_size=self.settings['schema.cache_size'],
+                                   engine=self.settings['schema.engine'])
+        self.migrator = SchemaMigrator(
+            self.session,
+            enabled=not self.settings['cassandra.immutable_schema'],
+        )
+        self.descriptors = DescriptorRegistry(
+            self.migrator,
+            poll_interval_ms=self.settings['descriptor.poll_interval_ms'],
+            create_types=self.settings['kafka.unknown_types'] == 'create',
+        )
+        self.schema_changes = SchemaChangeWorker(
+            self.migrator,
+            release=self.write,
+            on_error=self.report_error,
+            max_parked=self.settings['schema.max_parked'],
+            reject=self.release_failed,
+            max_retries=self.settings['cassandra.max_retries'],
+            retry_delay_ms=self.settings['cassandra.retry_delay_ms'],
+        )
+        self.metrics = Metrics(
+            max_shapes=self.settings['metrics.max_shapes'],
+            shape_sample_interval=self.settings[
+                'metrics.shape_sample_interval'],
+        )
+        self.writer = BatchWriter.from_settings(self.session, self.settings,
+                                                on_error=self.report_error,
+                                                on_failure=self.write_failed,
+                                                metrics=self.metrics)
+        self.blocked_types = {
+            type_id.strip()
+            for type_id in self.settings['kafka.blocked_types'].split(',')
+            if type_id.strip()
+        }
+        self.id_strategy = self.settings['id.strategy']
+        if self.id_strategy not in ID_STRATEGIES:
+            raise ValueError('Unknown id strategy {}.'.format(
+                self.id_strategy))
+        self.id_field = (self.settings['id.field']
+                         if self.id_strategy == 'field' else None)
 
-    def unwrap_message(self, raw_value):
-        # Try to decode MsgPack
-        try:
-            payload = msgpack.loads(raw_value, encoding='utf-8')
+        self.timestamp_source = self.settings['timestamp.source']
+        self.timestamp_field = self.settings['timestamp.field']
 
-        # Try to decode JSON
-        except msgpack.exceptions.UnpackException:
-            payload = json.loads(raw_value)
+        self.errors = ErrorReporter(
+            raven,
+            sample_interval_ms=self.settings['errors.sample_interval_ms'],
+            sample_burst=self.settings['errors.sample_burst'],
+            max_queue=self.settings['errors.max_queue'],
+        )
+        self.dead_letters = create_dead_letters(self.settings, event_loop)
 
-        type_ = payload.get('type_id')
-        if type_ is None:
-            raise ValueError("Object type was not provided.")
+        # Without a dead-letter sink, records of failed writes and schema
+        # changes can't be acknowledged: they are retried until they
+        # succeed, their partitions paused once saturated.
+        if not self.dead_letters.stores:
+            self.writer.max_retries = None
+            self.schema_changes.max_retries = None
 
-        data = payload.get('data') or {}
+        # Only profiled consumers pay for wrapping their commits.
+        self.profiler = None
+        if self.settings['profiling.sample_rate'] or \
+                self.settings['profiling.slow_event_ms']:
+            self.profiler = Profiler.from_settings(self.settings,
+                                                   self.unwrap_message)
+            self.commit_record = self.profiler.wrap(self.commit_record)
 
-        return type_, data
+        self.memory_tracer = None
+        if self.settings['profiling.tracemalloc_signal']:
+            self.memory_tracer = MemoryTracer(
+                self.settings['profiling.output_dir'])
 
-    def get_descriptor(self, type_id):
-        cached = self.descriptors.get(type_id)
-        if cached is not None:
-            return cached
+        self.offsets = OffsetTracker(
+            commit_interval_ms=self.settings['kafka.commit_interval_ms'],
+            max_unacked=self.settings['kafka.max_unacked'])
+        self.dropped = collections.Counter()
+        self.consumed = 0
+        self._snapshot = None
 
-        return self.load_descriptor(type_id)
+    def record_type(self, record):
+        """Type id routed in the record key or headers, if configured."""
 
-    def load_descriptor(self, type_id):
-        try:
-            descriptor = DescriptorModel.get(id=type_id)
-        except DescriptorModel.DoesNotExist as e:
-            descriptor = DescriptorModel.create(id=type_id)
+        source = self.settings['kafka.type_source']
+        if source == 'key':
+            return record_key(record)
+        if source == 'header':
+            return record_header(record, self.settings['kafka.type_header'])
+
+    def row_id(self, record):
+        """Default id of the object in a record, if derived from it."""
+
+        if self.id_strategy != 'uuid':
+            return record_id(record.topic, record.partition, record.offset)
+
+    def write_timestamp(self, flatten, record_timestamp=None):
+        """
+        Write timestamp of an object, in microseconds, if event-timed.
+
+        Taken from the timestamp field of the object, or else from the
+        timestamp of its Kafka record, in milliseconds.
+        """
+
+        if self.timestamp_source != 'event':
+            return None
+
+        timestamp = timestamp_micros(flatten.get(self.timestamp_field))
+        if timestamp is None and record_timestamp is not None and \
+                record_timestamp >= 0:
+            timestamp = record_timestamp * 1000
+        return timestamp
+
+    def unwrap_message(self, raw_value, content_type=None, type_id=None):
+        payload = self.decoders.decode(raw_value, content_type)
+        return unwrap_payload(payload, type_id)
+
+    async def get_descriptor(self, type_id):
+        return await self.descriptors.get(type_id)
+
+    async def route(self, type_id):
+        """Descriptor of a type, or ``None`` if its events are dropped."""
+
+        if type_id not in self.blocked_types:
+            descriptor = await self.get_descriptor(type_id)
+            if descriptor is not None:
+                return descriptor
+
+        self.dropped[type_id] += 1
+
+    async def prefetch(self, type_ids):
+        """Loads the descriptors of routed types concurrently."""
+
+        await asyncio.gather(*[self.get_descriptor(type_id)
+                               for type_id in type_ids
+                               if type_id not in self.descriptors and
+                               type_id not in self.blocked_types],
+                             return_exceptions=True)
+
+    async def prepare_message(self, message, content_type=None,
+                              type_id=None, row_id=None, timings=None):
+        metrics = self.metrics
+        started = time.perf_counter()
+        type_, payload = self.unwrap_message(message, content_type, type_id)
+        metrics.observe('decode', started, timings)
+
+        started = time.perf_counter()
+        descriptor = await self.route(type_)
+        metrics.observe('descriptor', started, timings)
+        if descriptor is None:
+            return None, None, None
 
-        self.descriptors[type_id] = descriptor
-        return descriptor
+        metrics.count(type_, 'events')
+        metrics.count(type_, 'bytes', len(message))
+        assign_id(payload, row_id, self.id_field)
 
-    async def commit_message(self, message):
-        type_, payload = self.unwrap_message(message)
-        descriptor = self.get_descriptor(type_)
+        started = time.perf_counter()
+        schema = self.schemas.get(descriptor)
+        metrics.observe('bind', started, timings)
 
-        schema = self.schema.bind(descriptor=descriptor)
+        started = time.perf_counter()
         deserialized = schema.deserialize(payload)
-        flatten = schema.flatten(deserialized)
+        metrics.observe('deserialize', started, timings)
 
-        changes = descriptor.infer_schema_change(flatten)
-        if changes:
-            descriptor = self.load_descriptor(type_)
+        # Inline, new fields are inferred while flattening.
+        started = time.perf_counter()
+        flatten, new_fields = schema.flatten_infer(deserialized,
+                                                   descriptor.properties)
+        metrics.observe('flatten', started, timings)
+        metrics.shape(type_, flatten, bool(new_fields))
 
+        return descriptor, flatten, new_fields
+
+    async def write(self, descriptor, flatten, ack=None, timestamp=None,
+                    timings=None):
+        started = time.perf_counter()
         model = descriptor.model(**flatten)
-        model.save()
+        self.metrics.observe('model', started, timings)
 
-    async def start(self):
-        consumer = KafkaConsumer(
-            *self.topics,
+        # Same id writes converge to the newest event in any order.
+        if timestamp is not None:
+            model.timestamp(timestamp)
+
+        self.writer.add(descriptor.id, model, ack)
+
+        if self.writer.due:
+            await self.writer.flush()
+
+    async def commit_message(self, message, content_type=None,
+                             type_id=None, row_id=None, ack=None,
+                             record_timestamp=None, timings=None):
+        descriptor, flatten, new_fields = await self.prepare_message(
+            message, content_type, type_id, row_id, timings)
+        if descriptor is None:
+            if ack is not None:
+                ack()
+            return
+
+        await self.commit_object(descriptor, flatten, new_fields, ack,
+                                 record_timestamp, timings)
+
+    async def commit_object(self, descriptor, flatten, new_fields=None,
+                            ack=None, record_timestamp=None, timings=None):
+        timestamp = self.write_timestamp(flatten, record_timestamp)
+
+        # Wait for new columns in the background.
+        if new_fields:
+            self.metrics.count(descriptor.id, 'new_columns', len(new_fields))
+            await self.schema_changes.park(descriptor, new_fields, flatten,
+                                           ack=ack, timestamp=timestamp)
+            return
+
+        await self.write(descriptor, flatten, ack, timestamp, timings)
+
+    def create_kafka_consumer(self):
+        consumer = self.kafka_consumer_class(
+            loop=self._loop,
             bootstrap_servers=self.cluster,
             group_id=self.group,
+            # Offsets are committed once their records are written.
+            enable_auto_commit=False,
+            fetch_min_bytes=self.settings['kafka.fetch_min_bytes'],
+            fetch_max_bytes=self.settings['kafka.fetch_max_bytes'],
+            fetch_max_wait_ms=self.settings['kafka.fetch_max_wait_ms'],
+            max_partition_fetch_bytes=self.settings[
+                'kafka.max_partition_fetch_bytes'],
+            max_poll_records=self.settings['kafka.max_poll_records'],
         )
-        # Consume messages
-        for message in consumer:
+        consumer.subscribe(topics=self.topics,
+                           listener=RebalanceListener(self, consumer))
+        return consumer
+
+    def descriptor_snapshot(self):
+        descriptors = list(self.descriptors.descriptors.values())
+        key = DescriptorSnapshot.key(descriptors)
+
+        if self._snapshot is None or self._snapshot[0] != key:
+            self._snapshot = key, DescriptorSnapshot(descriptors)
+        return self._snapshot[1]
+
+    async def prepare_records(self, records):
+        """Prepares records in the process pool, see ``prepare_records``."""
+
+        snapshot = self.descriptor_snapshot()
+        started = time.perf_counter()
+        try:
+            prepared = await self._loop.run_in_executor(
+                self.pool, prepare_records, records, snapshot.data,
+                self.settings['schema.engine'], self.id_field)
+        except Exception as e:
+            self.report_error(e)
+            return snapshot, [None] * len(records)
+        finally:
+            self.metrics.observe('prepare', started)
+
+        return snapshot, pickle.loads(prepared)
+
+    async def commit_prepared(self, snapshot, record, prepared, ack=None,
+                              record_timestamp=None, timings=None):
+        if prepared is None:
+            return await self.commit_message(
+                *record, ack=ack, record_timestamp=record_timestamp,
+                timings=timings)
+
+        type_id, flatten, has_new_fields = prepared
+        descriptor = await self.route(type_id)
+        if descriptor is None:
+            if ack is not None:
+                ack()
+            return
+
+        # Prepared with a descriptor that changed since, redo it here.
+        if descriptor.fingerprint != snapshot.fingerprints.get(type_id):
+            return await self.commit_message(
+                *record, ack=ack, record_timestamp=record_timestamp,
+                timings=timings)
+
+        self.metrics.count(type_id, 'events')
+        self.metrics.count(type_id, 'bytes', len(record[0]))
+        self.metrics.shape(type_id, flatten, has_new_fields)
+
+        new_fields = None
+        if has_new_fields:
+            started = time.perf_counter()
+            new_fields = descriptor.infer_schema_change(flatten)
+            self.metrics.observe('infer', started, timings)
+
+        await self.commit_object(descriptor, flatten, new_fields, ack,
+                                 record_timestamp, timings)
+
+    async def commit_record(self, message, content_type=None, type_id=None,
+                            row_id=None, ack=None, record_timestamp=None,
+                            timings=None, snapshot=None, prepared=None):
+        """
+        Commits a consumed record, the entry point profiled per event.
+
+        Records prepared by ``prepare_records()`` are given their
+        ``snapshot`` and ``prepared`` result, others are committed whole.
+        """
+
+        if snapshot is None:
+            return await self.commit_message(
+                message, content_type, type_id, row_id, ack=ack,
+                record_timestamp=record_timestamp, timings=timings)
+
+        await self.commit_prepared(
+            snapshot, (message, content_type, type_id, row_id), prepared,
+            ack, record_timestamp, timings)
+
+    async def consume_partition(self, partition, messages):
+        # Messages of a partition are committed in order.
+        header = self.settings['kafka.content_type_header']
+        records = []
+        acks = []
+        kept = []
+        self.consumed += len(messages)
+
+        for message in messages:
+            self.offsets.track(partition, message.offset)
+            ack = RecordAck(self.offsets, partition, message)
+            type_id = self.record_type(message)
+
+            # Blocked and unknown types are dropped before decoding.
+            if type_id in self.blocked_types or \
+                    type_id in self.descriptors.unknown:
+                self.dropped[type_id] += 1
+                ack()
+                continue
+
+            records.append((message.value, record_header(message, header),
+                            type_id, self.row_id(message)))
+            acks.append(ack)
+            kept.append(message)
+
+        # Records failing before their write are acknowledged, as
+        # consuming them again would fail the same way.
+        if self.pool is None:
+            for message, record, ack in zip(kept, records, acks):
+                try:
+                    await self.commit_record(
+                        *record, ack=ack, record_timestamp=message.timestamp)
+                except Exception as e:
+                    await self.record_failed(message, e, record[2])
+                    ack()
+            return
+
+        snapshot, results = await self.prepare_records(records)
+        for message, record, prepared, ack in zip(kept, records, results,
+                                                  acks):
             try:
-                await asyncio.ensure_future(self.commit_message(message.value))
+                await self.commit_record(
+                    *record, ack=ack, record_timestamp=message.timestamp,
+                    snapshot=snapshot, prepared=prepared)
             except Exception as e:
-                raven.captureException()
+                await self.record_failed(message, e, record[2])
+                ack()
+
+    def stats(self):
+        stats = {
+            'consumed': self.consumed,
+            'dropped': sum(self.dropped.values()),
+            'unacked': self.offsets.unacked,
+            'parked': self.schema_changes.size,
+            'pending_writes': self.writer.size,
+            'coalesced_writes': self.writer.coalesced,
+            'in_flight_writes': len(self.writer.in_flight),
+            'descriptors': len(self.descriptors.descriptors),
+            'descriptor_refreshes': self.descriptors.refreshes,
+            'schema_cache_hits': self.schemas.hits,
+            'schema_cache_misses': self.schemas.misses,
+            'model_cache_hits': model_cache.hits,
+            'model_cache_misses': model_cache.misses,
+            **self.errors.stats(),
+        }
+        if self.profiler is not None:
+            stats.update(self.profiler.stats())
+        return stats
+
+    def report_error(self, exception):
+        self.errors.report(exception)
+
+    async def record_failed(self, message, exception, type_id=None):
+        """Reports a record that can't be written and dead-letters it."""
+
+        self.metrics.count(type_id, 'errors')
+        self.errors.report(exception, type_id, topic=message.topic,
+                           partition=message.partition,
+                           offset=message.offset)
+        try:
+            await self.dead_letters.send(message, exception, type_id)
+        except Exception as e:
+            self.report_error(e)
+
+    async def reject(self, ack, exception, type_id=None):
+        """Dead-letters the record of an ack, if kept, and acknowledges it."""
+
+        record = getattr(ack, 'record', None)
+        if record is None:
+            self.report_error(exception)
+        else:
+            await self.record_failed(record, exception, type_id)
+        ack()
+
+    async def write_failed(self, exception, acks, type_id=None):
+        # Retrying more would hold their partitions back.
+        for ack in acks:
+            await self.reject(ack, exception, type_id)
+
+    async def release_failed(self, descriptor, object_, exception, ack=None,
+                             **context):
+        if ack is None:
+            self.report_error(exception)
+            return
+        await self.reject(ack, exception, descriptor.id)
+
+    async def wait_for_writes(self, consumer):
+        """Pauses fetching while the in-flight write window is full."""
+
+        partitions = consumer.assignment()
+        consumer.pause(*partitions)
+        try:
+            await self.writer.wait_for_capacity()
+        finally:
+            consumer.resume(*partitions)
+
+    def pause_saturated(self, consumer, paused):
+        """
+        Pauses partitions with too many records not written yet.
+
+        Partitions of ``paused`` that caught up are resumed. Returns the
+        paused partitions.
+        """
+
+        assignment = consumer.assignment()
+        saturated = self.offsets.saturated() & assignment
+
+        resumed = (paused - saturated) & assignment
+        if resumed:
+            consumer.resume(*resumed)
+        if saturated:
+            consumer.pause(*saturated)
+        return saturated
+
+    async def flush_writes(self):
+        try:
+            await self.writer.flush()
+        except Exception as e:
+            self.report_error(e)
+
+    def track_lag(self, consumer, batch):
+        """Records how far behind the end of its partitions a batch is."""
+
+        for partition, messages in batch.items():
+            highwater = consumer.highwater(partition)
+            if highwater is not None and messages:
+                self.metrics.lag(partition,
+                                 highwater - messages[-1].offset - 1)
+
+    def render_metrics(self):
+        return render_prometheus(self.metrics, self.stats())
+
+    async def consume_batch(self, batch):
+        """Consumes a ``getmany()`` batch with one task per partition."""
+
+        await self.prefetch({self.record_type(message)
+                             for messages in batch.values()
+                             for message in messages} - {None})
+        await asyncio.gather(*[self.consume_partition(partition, messages)
+                               for partition, messages in batch.items()])
+
+    async def commit_offsets(self, consumer, partitions=None):
+        """Commits the positions of the records written so far."""
+
+        offsets = self.offsets.committable(partitions)
+        if not offsets:
+            return
+
+        try:
+            await consumer.commit(offsets)
+        except Exception as e:
+            self.report_error(e)
+            return
+
+        self.offsets.mark_committed(offsets)
+        logger.debug('Committed offsets.', extra={
+            'partitions': len(offsets),
+        })
+
+    async def partitions_revoked(self, consumer, revoked):
+        """Writes and commits what was consumed before a rebalance."""
+
+        await self.flush_writes()
+        await self.writer.drain()
+        await self.commit_offsets(consumer, revoked)
+        self.offsets.forget(revoked)
+
+    def start_pool(self):
+        # Decoding and flattening are offloaded to worker processes.
+        workers = self.settings['executor.workers']
+        if workers:
+            self.pool = self.pool_class(max_workers=workers)
+
+    def stop_pool(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    async def start(self):
+        consumer = self.create_kafka_consumer()
+        await consumer.start()
+        await self.dead_letters.start()
+        polling = asyncio.ensure_future(self.descriptors.run())
+
+        server = None
+        if self.settings['metrics.port']:
+            server = MetricsServer(self.render_metrics,
+                                   host=self.settings['metrics.host'],
+                                   port=self.settings['metrics.port'])
+            await server.start()
+
+        profiling = None
+        if self.profiler is not None:
+            self.profiler.start()
+            profiling = asyncio.ensure_future(self.profiler.run())
+
+        tracing_signal = None
+        if self.memory_tracer is not None:
+            tracing_signal = getattr(
+                signal, self.settings['profiling.tracemalloc_signal'])
+            self._loop.add_signal_handler(tracing_signal,
+                                          self.memory_tracer.toggle)
+
+        logging_metrics = None
+        if self.settings['metrics.log_interval_ms']:
+            logging_metrics = asyncio.ensure_future(log_metrics(
+                self.metrics, self.stats,
+                self.settings['metrics.log_interval_ms'] / 1000))
+
+        self.start_pool()
+
+        self._running = True
+        paused = set()
+        try:
+            while self._running:
+                if self.writer.full:
+                    await self.wait_for_writes(consumer)
+                paused = self.pause_saturated(consumer, paused)
+
+                # Wake up in time to flush pending writes.
+                timeout_ms = self.settings['kafka.poll_timeout_ms']
+                if self.writer.timeout is not None:
+                    timeout_ms = min(timeout_ms, self.writer.timeout * 1000)
+
+                batch = await consumer.getmany(
+                    timeout_ms=int(timeout_ms),
+                    max_records=self.settings['kafka.max_poll_records'],
+                )
+                self.track_lag(consumer, batch)
+                await self.consume_batch(batch)
+
+                if self.writer.due:
+                    await self.flush_writes()
+
+                if self.offsets.due:
+                    await self.commit_offsets(consumer)
+
+            await self.schema_changes.drain()
+            await self.flush_writes()
+            await self.writer.drain()
+            await self.commit_offsets(consumer)
+        finally:
+            polling.cancel()
+            if logging_metrics is not None:
+                logging_metrics.cancel()
+            if server is not None:
+                await server.stop()
+            if profiling is not None:
+                profiling.cancel()
+                self.profiler.stop()
+            if tracing_signal is not None:
+                self._loop.remove_signal_handler(tracing_signal)
+            self.stop_pool()
+            await self.dead_letters.stop()
+            await consumer.stop()
+            self.errors.close()
+
+    def stop(self):
+        """Stops consuming after the batch being processed."""
+
+        self._running = False
+
+
+class RebalanceListener(ConsumerRebalanceListener):
+
+    def __init__(self, owner, consumer):
+        self.owner = owner
+        self.consumer = consumer
+
+    async def on_partitions_revoked(self, revoked):
+        await self.owner.partitions_revoked(self.consumer, revoked)
+
+    async def on_partitions_assigned(self, assigned):
+        pass
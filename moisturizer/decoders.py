@@ -0,0 +1,111 @@
+import json
+
+import msgpack
+
+
+JSON_WHITESPACE = b' \t\r\n'
+
+
+def decode_json(value):
+    # ``json.loads`` doesn't take buffers, only bytes.
+    if isinstance(value, memoryview):
+        value = value.tobytes()
+    return json.loads(value)
+
+
+def decode_msgpack(value):
+    # Buffers are unpacked in place, strings decoded as UTF-8 once.
+    return msgpack.unpackb(value, raw=False)
+
+
+def unwrap_payload(payload, type_id=None):
+    """
+    Splits a decoded payload in its type id and object.
+
+    Payloads carry a ``type_id``/``data`` envelope, unless the type id was
+    routed in the record and they hold the object alone.
+    """
+
+    if type_id is not None:
+        return type_id, payload or {}
+
+    type_ = payload.get('type_id')
+    if type_ is None:
+        raise ValueError("Object type was not provided.")
+
+    data = payload.get('data') or {}
+
+    return type_, data
+
+
+class DecoderRegistry:
+    """
+    Decodes message values by payload format.
+
+    A format is picked from the content type of a message, when producers
+    send one, or else from the first byte of its value. Values of unknown
+    formats are tried against each decoder in registration order.
+    """
+
+    def __init__(self):
+        self.decoders = {}
+        self.content_types = {}
+        self.leading_bytes = {}
+
+    def register(self, name, decoder, content_types=(), leading_bytes=()):
+        self.decoders[name] = decoder
+
+        for content_type in content_types:
+            self.content_types[content_type] = name
+        for byte in leading_bytes:
+            self.leading_bytes[byte] = name
+
+    def detect(self, value, content_type=None):
+        """Name of the format of a value, if it can be told cheaply."""
+
+        if content_type is not None:
+            content_type = content_type.split(';', 1)[0].strip().lower()
+            name = self.content_types.get(content_type)
+            if name is not None:
+                return name
+
+        if not value:
+            return None
+
+        first = value[0]
+        if first in JSON_WHITESPACE:
+            stripped = bytes(value[:64]).lstrip(JSON_WHITESPACE)
+            if not stripped:
+                return None
+            first = stripped[0]
+
+        return self.leading_bytes.get(first)
+
+    def decode(self, value, content_type=None):
+        name = self.detect(value, content_type)
+        if name is not None:
+            return self.decoders[name](value)
+
+        for decoder in self.decoders.values():
+            try:
+                return decoder(value)
+            except ValueError:
+                continue
+
+        raise ValueError('Unknown payload format.')
+
+
+decoders = DecoderRegistry()
+
+decoders.register(
+    'json', decode_json,
+    content_types=('application/json', 'text/json'),
+    leading_bytes=b'{[',
+)
+
+decoders.register(
+    'msgpack', decode_msgpack,
+    content_types=('application/msgpack', 'application/x-msgpack'),
+    # fixmap, map 16 and map 32
+    leading_bytes=bytes(range(0x80, 0x90)) + b'\xde\xdf',
+)
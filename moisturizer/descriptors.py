@@ -0,0 +1,100 @@
+import asyncio
+import logging
+
+from moisturizer.models import DescriptorModel
+
+
+logger = logging.getLogger('moisturizer.descriptors')
+
+
+class DescriptorRegistry:
+    """
+    Descriptors of the consumed types, shared by a consumer.
+
+    Descriptors are loaded once per type, and concurrent lookups of a new
+    type share a single load. Other consumers may migrate the same types,
+    so stored descriptor versions are polled every ``poll_interval_ms`` and
+    outdated descriptors are refreshed in place.
+
+    Without ``create_types``, lookups of types that aren't stored return
+    ``None``; they are remembered as unknown until a poll finds them.
+    """
+
+    def __init__(self, migrator, poll_interval_ms=5000, create_types=True):
+        self.migrator = migrator
+        self.poll_interval = poll_interval_ms / 1000
+        self.create_types = create_types
+
+        self.descriptors = {}
+        self.loading = {}
+        self.unknown = set()
+        self.refreshes = 0
+
+    def __contains__(self, type_id):
+        return type_id in self.descriptors
+
+    def add(self, descriptor):
+        self.descriptors[descriptor.id] = descriptor
+
+    async def get(self, type_id):
+        cached = self.descriptors.get(type_id)
+        if cached is not None or type_id in self.unknown:
+            return cached
+
+        loading = self.loading.get(type_id)
+        if loading is None:
+            loading = asyncio.ensure_future(self.load(type_id))
+            self.loading[type_id] = loading
+            loading.add_done_callback(
+                lambda _: self.loading.pop(type_id, None))
+
+        return await asyncio.shield(loading)
+
+    async def load(self, type_id):
+        descriptor = await self.migrator.load(type_id)
+
+        if descriptor is None:
+            if not self.create_types:
+                self.unknown.add(type_id)
+                return None
+
+            descriptor = DescriptorModel(id=type_id)
+
+            # Another consumer created the type first, use its descriptor.
+            if not await self.migrator.create(descriptor):
+                descriptor = await self.migrator.load(type_id)
+
+        self.descriptors[type_id] = descriptor
+        return descriptor
+
+    async def poll(self):
+        """Refreshes descriptors changed by other consumers."""
+
+        versions = await self.migrator.versions()
+        self.unknown.difference_update(versions)
+
+        for type_id, descriptor in list(self.descriptors.items()):
+            version = versions.get(type_id)
+            if version is None or version == descriptor.version:
+                continue
+
+            logger.info('Refreshing schema.', extra={
+                'type_id': type_id,
+                'version': version,
+            })
+
+            await self.migrator.refresh(descriptor)
+            self.refreshes += 1
+
+    async def run(self):
+        """Polls descriptor versions until cancelled."""
+
+        if not self.poll_interval:
+            return
+
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.poll()
+            except Exception as e:
+                logger.error('Descriptor poll failed.', exc_info=e)
@@ -0,0 +1,118 @@
+import pickle
+
+from moisturizer.decoders import decoders, unwrap_payload
+from moisturizer.models import (
+    DescriptorModel,
+    DescriptorFieldType,
+    assign_id,
+)
+from moisturizer.schemas import InferredObjectSchema, SchemaCache
+
+
+FIELD_ATTRIBUTES = ('type', 'format', 'primary_key', 'partition_key',
+                    'index', 'required')
+
+
+class DescriptorSnapshot:
+    """
+    Descriptors shipped to worker processes.
+
+    Properties are pickled once per set of descriptor revisions and sent
+    along each batch, so workers don't need a Cassandra session.
+    ``fingerprints`` holds the revision of each descriptor in the
+    snapshot, to tell rows prepared with an outdated one.
+    """
+
+    def __init__(self, descriptors):
+        self.fingerprints = {descriptor.id: descriptor.fingerprint
+                             for descriptor in descriptors}
+        self.data = pickle.dumps({
+            descriptor.id: (descriptor.fingerprint, {
+                name: tuple(getattr(field, attribute)
+                            for attribute in FIELD_ATTRIBUTES)
+                for name, field in descriptor.properties.items()
+            })
+            for descriptor in descriptors
+        }, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def key(descriptors):
+        return frozenset((descriptor.id, descriptor.fingerprint)
+                         for descriptor in descriptors)
+
+
+# Worker process state, reused across batches.
+_snapshot = None
+_descriptors = {}
+_schemas = {}
+
+
+def load_snapshot(data):
+    global _snapshot
+
+    if data == _snapshot:
+        return _descriptors
+
+    for type_id, (fingerprint, properties) in pickle.loads(data).items():
+        cached = _descriptors.get(type_id)
+        if cached is not None and cached[0] == fingerprint:
+            continue
+
+        descriptor = DescriptorModel(id=type_id)
+        descriptor.properties.update({
+            name: DescriptorFieldType(**dict(zip(FIELD_ATTRIBUTES, field)))
+            for name, field in properties.items()
+        })
+        _descriptors[type_id] = (fingerprint, descriptor)
+
+    _snapshot = data
+    return _descriptors
+
+
+def prepare_record(schemas, descriptors, id_field, value, content_type,
+                   type_id, row_id):
+    type_, payload = unwrap_payload(decoders.decode(value, content_type),
+                                    type_id)
+
+    cached = descriptors.get(type_)
+    if cached is None:
+        return None
+
+    assign_id(payload, row_id, id_field)
+
+    _, descriptor = cached
+    schema = schemas.get(descriptor)
+    deserialized = schema.deserialize(payload)
+    flatten, new_fields = schema.flatten_infer(deserialized,
+                                               descriptor.properties)
+    return type_, flatten, bool(new_fields)
+
+
+def prepare_records(records, snapshot, engine='colander', id_field=None):
+    """
+    Decodes, deserializes and flattens records in a worker process.
+
+    ``records`` are ``(value, content_type, type_id, row_id)`` tuples, and
+    objects without an id get one as ``assign_id()`` does. Results keep
+    their order: ``(type_id, flatten, has_new_fields)`` for each prepared
+    record, or ``None`` for records to be prepared by the consumer itself,
+    either of types missing from the snapshot or that failed, so errors
+    are raised and reported there. Results are pickled at once, sharing
+    the joined flattened keys between rows.
+    """
+
+    descriptors = load_snapshot(snapshot)
+    schemas = _schemas.get(engine)
+    if schemas is None:
+        schemas = _schemas[engine] = SchemaCache(InferredObjectSchema(),
+                                                 engine=engine)
+
+    results = []
+    for record in records:
+        try:
+            results.append(prepare_record(schemas, descriptors, id_field,
+                                          *record))
+        except Exception:
+            results.append(None)
+
+    return pickle.dumps(results, protocol=pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,257 @@
+import asyncio
+import collections
+import gzip
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+
+from aiocassandra import aiosession
+
+from moisturizer import connect, create_consumer
+
+
+logger = logging.getLogger('moisturizer.importer')
+
+
+FileRecord = collections.namedtuple('FileRecord', [
+    'topic', 'partition', 'offset', 'key', 'value', 'headers', 'timestamp',
+])
+
+FILE_FORMATS = {
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+    '.json': 'jsonl',
+    '.msgpack': 'msgpack',
+    '.mpk': 'msgpack',
+}
+
+CONTENT_TYPES = {
+    'jsonl': b'application/json',
+    'msgpack': b'application/msgpack',
+}
+
+LENGTH_PREFIX = struct.Struct('>I')
+
+# Errors of unreadable, truncated or corrupt files.
+FILE_ERRORS = (OSError, ValueError, EOFError, zlib.error)
+
+
+def file_format(path):
+    """Format of a file, from its extension ignoring ``.gz``."""
+
+    root, extension = os.path.splitext(path)
+    if extension == '.gz':
+        root, extension = os.path.splitext(root)
+
+    try:
+        return FILE_FORMATS[extension]
+    except KeyError:
+        raise ValueError('Unknown format of {}.'.format(path))
+
+
+def split_lines(buffer):
+    """Non-blank lines of a buffer, copied one at a time."""
+
+    start = 0
+    size = len(buffer)
+    while start < size:
+        end = buffer.find(b'\n', start)
+        if end < 0:
+            end = size
+        line = buffer[start:end].rstrip(b'\r')
+        if line.strip():
+            yield line
+        start = end + 1
+
+
+def split_length_prefixed(buffer):
+    """Values of a buffer, each prefixed by its 32 bits big endian size."""
+
+    offset = 0
+    size = len(buffer)
+    while offset < size:
+        if offset + LENGTH_PREFIX.size > size:
+            raise ValueError('Truncated length at byte {}.'.format(offset))
+        length, = LENGTH_PREFIX.unpack_from(buffer, offset)
+        offset += LENGTH_PREFIX.size
+
+        if offset + length > size:
+            raise ValueError('Truncated value at byte {}.'.format(offset))
+        yield buffer[offset:offset + length]
+        offset += length
+
+
+def read_lines(stream):
+    for line in stream:
+        if line.strip():
+            yield line.rstrip(b'\r\n')
+
+
+def read_length_prefixed(stream):
+    while True:
+        prefix = stream.read(LENGTH_PREFIX.size)
+        if not prefix:
+            return
+        if len(prefix) < LENGTH_PREFIX.size:
+            raise ValueError('Truncated length.')
+
+        length, = LENGTH_PREFIX.unpack(prefix)
+        value = stream.read(length)
+        if len(value) < length:
+            raise ValueError('Truncated value.')
+        yield value
+
+
+SPLITTERS = {'jsonl': split_lines, 'msgpack': split_length_prefixed}
+READERS = {'jsonl': read_lines, 'msgpack': read_length_prefixed}
+
+
+def read_values(path, format=None):
+    """
+    Raw values of a JSON lines or length-prefixed msgpack file.
+
+    Plain files are memory-mapped and split in place, gzipped ones are
+    decompressed as a stream.
+    """
+
+    format = format or file_format(path)
+
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as stream:
+            yield from READERS[format](stream)
+        return
+
+    with open(path, 'rb') as f:
+        # Empty files can't be mapped.
+        if not os.fstat(f.fileno()).st_size:
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            yield from SPLITTERS[format](buffer)
+
+
+def chunks(values, size):
+    chunk = []
+    for value in values:
+        chunk.append(value)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Importer:
+    """
+    Imports event files through a consumer, bypassing Kafka.
+
+    Each file is consumed as a partition of its own, its records numbered
+    from zero, through the consumer pipeline: decoding, validation,
+    flattening, schema inference, worker processes and batched writes.
+    Offset derived ids are then stable across imports of a same path.
+    Up to ``concurrency`` files are imported at once, in chunks of
+    ``chunk_size`` records, waiting for the writes of a file once it has
+    ``kafka.max_unacked`` records not written yet.
+    """
+
+    def __init__(self, consumer, chunk_size=1000, concurrency=4,
+                 format=None):
+        self.consumer = consumer
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.format = format
+        self.read = collections.Counter()
+
+    def records(self, path):
+        format = self.format or file_format(path)
+        headers = [(self.consumer.settings['kafka.content_type_header'],
+                    CONTENT_TYPES[format])]
+
+        for offset, value in enumerate(read_values(path, format)):
+            yield FileRecord(path, path, offset, None, value, headers, -1)
+
+    async def import_file(self, path, limit):
+        consumer = self.consumer
+
+        async with limit:
+            logger.info('Importing file.', extra={'path': path})
+
+            try:
+                for chunk in chunks(self.records(path), self.chunk_size):
+                    self.read[path] += len(chunk)
+                    await consumer.prefetch({consumer.record_type(record)
+                                             for record in chunk} - {None})
+                    await consumer.consume_partition(path, chunk)
+
+                    # Too many records of the file are not written yet.
+                    if consumer.offsets.full(path):
+                        await consumer.schema_changes.drain()
+                        await consumer.flush_writes()
+                        await consumer.writer.drain()
+                    elif consumer.writer.due:
+                        await consumer.flush_writes()
+            except FILE_ERRORS as e:
+                # Other files are still imported.
+                logger.error('Import failed.', extra={'path': path})
+                consumer.report_error(e)
+
+    async def run(self, paths):
+        consumer = self.consumer
+        limit = asyncio.Semaphore(self.concurrency)
+
+        await consumer.dead_letters.start()
+        consumer.start_pool()
+        try:
+            results = await asyncio.gather(*[self.import_file(path, limit)
+                                             for path in paths],
+                                           return_exceptions=True)
+
+            await consumer.schema_changes.drain()
+            await consumer.flush_writes()
+            await consumer.writer.drain()
+
+            # Raised once the other files are imported and written.
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        finally:
+            consumer.stop_pool()
+            await consumer.dead_letters.stop()
+            consumer.errors.close()
+
+    def stats(self):
+        """Consumer stats, ``unacked`` counting the records not written."""
+
+        stats = self.consumer.stats()
+        stats['read'] = sum(self.read.values())
+        return stats
+
+
+def import_files(settings, paths, format=None):
+    """Imports event files, see ``Importer``."""
+
+    session = connect(settings)
+    loop = asyncio.get_event_loop()
+    aiosession(session, loop=loop)
+
+    consumer = create_consumer(settings, session, loop)
+    importer = Importer(consumer,
+                        chunk_size=settings['import.chunk_size'],
+                        concurrency=settings['import.concurrency'],
+                        format=format)
+
+    started = time.monotonic()
+    try:
+        loop.run_until_complete(importer.run(paths))
+    finally:
+        session.cluster.shutdown()
+
+    stats = importer.stats()
+    elapsed = time.monotonic() - started
+    stats['elapsed'] = elapsed
+    stats['per_second'] = stats['read'] / elapsed if elapsed else 0
+    logger.info('Import done.', extra=stats)
+    return stats
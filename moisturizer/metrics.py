@@ -0,0 +1,240 @@
+import asyncio
+import bisect
+import collections
+import logging
+import time
+
+
+logger = logging.getLogger('moisturizer.metrics')
+
+
+# Upper bounds of the latency buckets, in seconds.
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5)
+
+
+class Histogram:
+    """Counts of observed values by bucket, as Prometheus histograms."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """``(upper bound, count)`` pairs, ending with ``+Inf``."""
+
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the ``q`` quantile."""
+
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound
+
+
+class Metrics:
+    """
+    Stage latencies, per type counters and partition lags of a consumer.
+
+    Stages are timed with ``time.perf_counter()`` and recorded in fixed
+    bucket histograms, so observing costs a bisect and a few additions.
+
+    The distinct key sets of the objects of each type are counted as its
+    shapes, up to ``max_shapes`` per type. Hashing a key set costs about
+    as much as flattening, so only objects with new fields and one object
+    in ``shape_sample_interval`` are hashed: rare shapes may be missed,
+    and the counts are lower bounds.
+    """
+
+    def __init__(self, max_shapes=1024, shape_sample_interval=100):
+        self.max_shapes = max_shapes
+        self.shape_sample_interval = shape_sample_interval
+        self.shape_samples = 0
+        self.stages = collections.defaultdict(Histogram)
+        self.types = collections.defaultdict(collections.Counter)
+        self.shapes = collections.defaultdict(set)
+        self.lags = {}
+
+    def observe(self, stage, started, timings=None):
+        """
+        Records the time spent in ``stage`` since ``started``.
+
+        It is also set in ``timings``, if given, to collect the stage
+        times of a single event.
+        """
+
+        elapsed = time.perf_counter() - started
+        self.stages[stage].observe(elapsed)
+        if timings is not None:
+            timings[stage] = elapsed
+
+    def count(self, type_id, name, value=1):
+        self.types[type_id][name] += value
+
+    def shape(self, type_id, object_, new=False):
+        """
+        Records the key set of an object among the shapes of its type.
+
+        Objects are sampled, unless ``new``, having fields new to the type.
+        """
+
+        if not new:
+            self.shape_samples += 1
+            if self.shape_samples < self.shape_sample_interval:
+                return
+            self.shape_samples = 0
+
+        shapes = self.shapes[type_id]
+        if len(shapes) < self.max_shapes:
+            shapes.add(hash(frozenset(object_)))
+
+    def lag(self, partition, lag):
+        self.lags[partition] = lag
+
+    def summary(self):
+        return {
+            'stages': {
+                stage: {
+                    'count': histogram.count,
+                    'mean': histogram.sum / histogram.count,
+                    'p50': histogram.quantile(0.5),
+                    'p99': histogram.quantile(0.99),
+                }
+                for stage, histogram in self.stages.items()
+                if histogram.count
+            },
+            'types': {str(type_id): dict(counts)
+                      for type_id, counts in self.types.items()},
+            'shapes': {str(type_id): len(shapes)
+                       for type_id, shapes in self.shapes.items()},
+            'lag': sum(self.lags.values()),
+        }
+
+
+def format_labels(**labels):
+    return ','.join('{}="{}"'.format(name, str(value)
+                                     .replace('\\', '\\\\')
+                                     .replace('"', '\\"')
+                                     .replace('\n', '\\n'))
+                    for name, value in sorted(labels.items()))
+
+
+def partition_labels(partition):
+    if hasattr(partition, 'topic'):
+        return {'topic': partition.topic, 'partition': partition.partition}
+    return {'partition': partition}
+
+
+def render_prometheus(metrics, stats=None):
+    """Renders metrics and ``stats`` gauges in the Prometheus text format."""
+
+    lines = ['# TYPE moisturizer_stage_seconds histogram']
+    for stage, histogram in sorted(metrics.stages.items()):
+        for bound, total in histogram.cumulative():
+            lines.append('moisturizer_stage_seconds_bucket{{{}}} {}'.format(
+                format_labels(stage=stage, le='{:g}'.format(bound)
+                              .replace('inf', '+Inf')),
+                total))
+        labels = format_labels(stage=stage)
+        lines.append('moisturizer_stage_seconds_sum{{{}}} {}'.format(
+            labels, histogram.sum))
+        lines.append('moisturizer_stage_seconds_count{{{}}} {}'.format(
+            labels, histogram.count))
+
+    names = sorted({name for counts in metrics.types.values()
+                    for name in counts})
+    for name in names:
+        lines.append('# TYPE moisturizer_type_{}_total counter'.format(name))
+        for type_id, counts in sorted(metrics.types.items(),
+                                      key=lambda item: str(item[0])):
+            if name in counts:
+                lines.append('moisturizer_type_{}_total{{{}}} {}'.format(
+                    name, format_labels(type=type_id), counts[name]))
+
+    lines.append('# TYPE moisturizer_type_shapes gauge')
+    for type_id, shapes in sorted(metrics.shapes.items(),
+                                  key=lambda item: str(item[0])):
+        lines.append('moisturizer_type_shapes{{{}}} {}'.format(
+            format_labels(type=type_id), len(shapes)))
+
+    lines.append('# TYPE moisturizer_partition_lag gauge')
+    for partition, lag in metrics.lags.items():
+        lines.append('moisturizer_partition_lag{{{}}} {}'.format(
+            format_labels(**partition_labels(partition)), lag))
+
+    for name, value in sorted((stats or {}).items()):
+        lines.append('# TYPE moisturizer_{} gauge'.format(name))
+        lines.append('moisturizer_{} {}'.format(name, value))
+
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """
+    Serves ``render()`` at ``/metrics`` over a minimal HTTP listener.
+
+    Runs on the consumer event loop, as scrapes are rare and cheap.
+    """
+
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, render, host='0.0.0.0', port=9100):
+        self.render = render
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host,
+                                                 self.port)
+
+    async def handle(self, reader, writer):
+        try:
+            request = (await reader.readline()).split()
+            while (await reader.readline()).strip():
+                pass
+
+            if len(request) > 1 and request[1].split(b'?')[0] == b'/metrics':
+                status, body = '200 OK', self.render().encode()
+            else:
+                status, body = '404 Not Found', b''
+
+            writer.write('HTTP/1.0 {}\r\nContent-Type: {}\r\n'
+                         'Content-Length: {}\r\n\r\n'.format(
+                             status, self.content_type,
+                             len(body)).encode('ascii') + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+
+async def log_metrics(metrics, stats, interval):
+    """Logs a metrics summary every ``interval`` seconds."""
+
+    while True:
+        await asyncio.sleep(interval)
+        summary = metrics.summary()
+        summary.update(stats())
+        logger.info('Consumer metrics.', extra=summary)
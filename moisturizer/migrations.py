@@ -0,0 +1,302 @@
+import asyncio
+import collections
+import functools
+import logging
+
+from cassandra import AlreadyExists, InvalidRequest
+from cassandra.cqlengine import management
+from cassandra.query import SimpleStatement
+
+from moisturizer.models import DescriptorModel
+from moisturizer.writer import capture_statements, render_statements, retry
+
+
+logger = logging.getLogger('moisturizer.migrations')
+
+
+def column_definition(name, field):
+    column = field.as_column()
+    column.column_name = name
+    return column
+
+
+def was_applied(rows):
+    """Whether a lightweight transaction was applied."""
+
+    row = rows[0]
+    if isinstance(row, dict):
+        return row['[applied]']
+    return row[0]
+
+
+def index_statement(table, column):
+    return 'CREATE INDEX IF NOT EXISTS ON {} ("{}")'.format(
+        table, column.db_field_name)
+
+
+class SchemaMigrator:
+    """
+    Migrates inferred type tables from descriptor changes.
+
+    Instead of introspecting tables with ``sync_table``, the migrator diffs
+    the descriptor properties and only emits the ``CREATE TABLE``,
+    ``ALTER TABLE ... ADD`` and ``CREATE INDEX`` statements needed, once.
+    Statements run on the ``aiosession`` API; the driver waits for schema
+    agreement off the event loop before answering them.
+    """
+
+    def __init__(self, session, enabled=True):
+        self.session = session
+        self.enabled = enabled
+        self.locks = collections.defaultdict(asyncio.Lock)
+
+    def create_statements(self, model):
+        table = model.column_family_name()
+        statements = [management._get_create_table(model)]
+        statements += [index_statement(table, column)
+                       for column in model._columns.values()
+                       if column.index]
+        return statements
+
+    def alter_statements(self, model, new_fields):
+        table = model.column_family_name()
+        statements = []
+
+        for name, field in new_fields.items():
+            column = column_definition(name, field)
+            statements.append('ALTER TABLE {} ADD {}'.format(
+                table, column.get_column_def()))
+
+            if column.index:
+                statements.append(index_statement(table, column))
+
+        return statements
+
+    async def execute(self, statements):
+        if not self.enabled:
+            return
+
+        # DDL is issued sequentially, each waiting for schema agreement.
+        for statement in statements:
+            try:
+                await self.session.execute_future(SimpleStatement(statement))
+            except AlreadyExists:
+                pass
+            except InvalidRequest as e:
+                # Another consumer added the column first.
+                if 'conflicts with an existing column' not in str(e):
+                    raise
+
+    async def save(self, descriptor):
+        """Stores a conditional descriptor, returning whether it applied."""
+
+        query, parameters = render_statements(
+            capture_statements([descriptor]))
+        rows = await self.session.execute_future(SimpleStatement(query),
+                                                 parameters)
+        return was_applied(rows)
+
+    async def select(self, type_id):
+        query = 'SELECT * FROM {} WHERE "id" = %s'.format(
+            DescriptorModel.column_family_name())
+        return await self.session.execute_future(SimpleStatement(query),
+                                                 (type_id,))
+
+    async def backfill_version(self, type_id):
+        """Sets the version of a descriptor stored before it had one."""
+
+        query = ('UPDATE {} SET "version" = 0 WHERE "id" = %s '
+                 'IF "version" = null').format(
+                     DescriptorModel.column_family_name())
+        await self.session.execute_future(SimpleStatement(query), (type_id,))
+
+    async def load(self, type_id):
+        rows = await self.select(type_id)
+
+        # Revisions can't be conditioned on a null version.
+        if rows and rows[0]['version'] is None:
+            await self.backfill_version(type_id)
+            rows = await self.select(type_id)
+
+        if rows:
+            return DescriptorModel._construct_instance(rows[0])
+
+    async def versions(self):
+        """Stored versions of all descriptors."""
+
+        query = 'SELECT "id", "version" FROM {}'.format(
+            DescriptorModel.column_family_name())
+        rows = await self.session.execute_future(SimpleStatement(query))
+        return {row['id']: row['version'] or 0 for row in rows}
+
+    async def create(self, descriptor):
+        """
+        Creates the table of a new descriptor and stores it.
+
+        Returns whether this call created the descriptor, or another
+        consumer did it first.
+        """
+
+        async with self.locks[descriptor.id]:
+            logger.info('Creating schema.', extra={
+                'type_id': descriptor.id,
+            })
+
+            await self.execute(self.create_statements(descriptor.model))
+            return await self.save(descriptor.if_not_exists())
+
+    async def refresh(self, descriptor):
+        """Reloads a descriptor in place from its stored state."""
+
+        async with self.locks[descriptor.id]:
+            stored = await self.load(descriptor.id)
+            if stored is not None and stored.version != descriptor.version:
+                descriptor.refresh(stored)
+
+    async def migrate(self, descriptor, object_):
+        """Adds the columns ``object_`` needs to a descriptor."""
+
+        new_fields = descriptor.infer_schema_change(object_)
+        if new_fields:
+            return await self.add_columns(descriptor, new_fields)
+
+    async def add_columns(self, descriptor, new_fields):
+        """
+        Adds columns to the table of a descriptor.
+
+        Migrations of the same type are serialized, fields added meanwhile
+        are skipped, and the descriptor is only updated once its table has
+        the new columns. The descriptor is stored conditioned on its
+        version; when another consumer changed it first, it is reloaded
+        and the fields still missing are stored again.
+        """
+
+        async with self.locks[descriptor.id]:
+            new_fields = {k: v for k, v in new_fields.items()
+                          if k not in descriptor.properties}
+            if not new_fields:
+                return
+
+            logger.info('Mutating schema.', extra={
+                'type_id': descriptor.id,
+            })
+
+            await self.execute(self.alter_statements(descriptor.model,
+                                                     new_fields))
+
+            missing = new_fields
+            while missing:
+                if await self.save(descriptor.revise(missing)):
+                    descriptor.update_schema(missing)
+                    break
+
+                stored = await self.load(descriptor.id)
+                descriptor.refresh(stored)
+                missing = {k: v for k, v in missing.items()
+                           if k not in descriptor.properties}
+
+            return new_fields
+
+
+class SchemaChangeWorker:
+    """
+    Applies schema changes off the consumer hot path.
+
+    Objects needing columns that don't exist yet are parked in a queue per
+    type while a background task migrates it. Columns requested while a
+    migration runs are coalesced into the next ``ALTER`` round, and parked
+    objects are handed to ``release`` in order once their columns exist,
+    along with the keyword arguments they were parked with. Objects of
+    other types, or fitting the schema, keep flowing meanwhile.
+
+    Failed migrations are retried ``max_retries`` times, or until they
+    succeed when it is ``None``. Objects that can't be released then, or
+    that fail to, are handed to ``reject`` with the exception and the
+    same keyword arguments.
+    """
+
+    def __init__(self, migrator, release, on_error=None, max_parked=10000,
+                 reject=None, max_retries=3, retry_delay_ms=100):
+        self.migrator = migrator
+        self.release = release
+        self.on_error = on_error
+        self.max_parked = max_parked
+        self.reject = reject
+        self.max_retries = max_retries
+        self.retry_delay_ms = retry_delay_ms
+
+        self.parked = {}
+        self.requested = {}
+        self.tasks = {}
+
+    async def park(self, descriptor, new_fields, object_, **context):
+        type_id = descriptor.id
+
+        requested = self.requested.setdefault(type_id, {})
+        for name, field in new_fields.items():
+            requested.setdefault(name, field)
+        self.parked.setdefault(type_id, []).append((object_, context))
+
+        task = self.tasks.get(type_id)
+        if task is None:
+            task = asyncio.ensure_future(self.run(descriptor))
+            self.tasks[type_id] = task
+
+        # Too many parked objects, wait for the migration.
+        if len(self.parked.get(type_id, ())) >= self.max_parked:
+            await asyncio.wait([task])
+
+    async def run(self, descriptor):
+        type_id = descriptor.id
+
+        try:
+            while self.requested.get(type_id):
+                new_fields = self.requested.pop(type_id)
+                parked = self.parked.pop(type_id, [])
+
+                add_columns = functools.partial(self.migrator.add_columns,
+                                                descriptor, new_fields)
+                try:
+                    await retry(add_columns, self.max_retries,
+                                self.retry_delay_ms)
+                except Exception as e:
+                    self.failed(e)
+                    for object_, context in parked:
+                        await self.rejected(descriptor, object_, e, context)
+                    continue
+
+                for object_, context in parked:
+                    try:
+                        await self.release(descriptor, object_, **context)
+                    except Exception as e:
+                        await self.rejected(descriptor, object_, e, context)
+        finally:
+            del self.tasks[type_id]
+
+    async def rejected(self, descriptor, object_, exception, context):
+        if self.reject is None:
+            self.failed(exception)
+            return
+
+        try:
+            await self.reject(descriptor, object_, exception, **context)
+        except Exception as e:
+            self.failed(e)
+
+    def failed(self, exception):
+        if self.on_error is None:
+            logger.error('Schema change failed.', exc_info=exception)
+        else:
+            self.on_error(exception)
+
+    @property
+    def size(self):
+        """Number of parked objects."""
+
+        return sum(len(parked) for parked in self.parked.values())
+
+    async def drain(self):
+        """Waits for all pending schema changes."""
+
+        while self.tasks:
+            await asyncio.wait(list(self.tasks.values()))
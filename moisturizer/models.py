@@ -42,6 +42,36 @@ logger = logging.getLogger("moisturizer.models")
 
 DoesNotExist = models.BaseModel.DoesNotExist
 
+# Namespace of the ids derived from Kafka coordinates.
+RECORD_ID_NAMESPACE = uuid.UUID('5f0b8a3e-4c1d-4e8b-9a57-6d2f1c7e9b40')
+
+ID_STRATEGIES = ('uuid', 'offset', 'field')
+
+
+def record_id(topic, partition, offset):
+    """Deterministic id of the object in a Kafka record."""
+
+    return uuid.uuid5(RECORD_ID_NAMESPACE, '{}/{}/{}'.format(
+        topic, partition, offset)).hex
+
+
+def assign_id(object_, default=None, field=None):
+    """
+    Sets the id of an object without one.
+
+    The id is taken from ``field`` of the object, if given and present,
+    or else is ``default``. Objects without either keep the generated
+    ``uuid1`` id of their model.
+    """
+
+    if object_.get('id') is not None:
+        return
+
+    if field is not None and object_.get(field) is not None:
+        object_['id'] = str(object_[field])
+    elif default is not None:
+        object_['id'] = default
+
 
 class InferredModel(models.Model):
     """
@@ -108,9 +138,62 @@ class DescriptorFieldType(usertype.UserType):
         )
 
 
+class ModelCache:
+    """
+    Inferred model classes by descriptor id.
+
+    Keeps a single class per descriptor, rebuilt only when the descriptor
+    fingerprint changes.
+    """
+
+    def __init__(self):
+        self.models = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, descriptor):
+        fingerprint = descriptor.fingerprint
+        cached = self.models.get(descriptor.id)
+
+        if cached is not None and cached[0] == fingerprint:
+            self.hits += 1
+            return cached[1]
+
+        self.misses += 1
+        model = InferredModel.from_descriptor(descriptor)
+        self.models[descriptor.id] = (fingerprint, model)
+        return model
+
+    def invalidate(self, type_id):
+        self.models.pop(type_id, None)
+
+    def clear(self):
+        self.models.clear()
+        self.hits = self.misses = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {
+            'size': len(self.models),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate,
+        }
+
+
+model_cache = ModelCache()
+
+
 class DescriptorModel(InferredModel):
     properties = columns.Map(columns.Text,
                              columns.UserDefinedType(DescriptorFieldType))
+    version = columns.Integer(default=0)
+
+    _fingerprint = None
 
     def __init__(self, *args,  **kwargs):
         super().__init__(*args, **kwargs)
@@ -120,9 +203,24 @@ class DescriptorModel(InferredModel):
     def schema(self):
         return {k: v.as_column() for k, v in self.properties.items()}
 
+    @property
+    def fingerprint(self):
+        """Hash of the properties, identifying a schema revision."""
+
+        # Properties only grow, so their count catches direct mutations.
+        size = len(self.properties)
+        if self._fingerprint is None or self._fingerprint[0] != size:
+            self._fingerprint = (size, hash(tuple(sorted(
+                (name, field.type, field.format or '', field.primary_key,
+                 field.partition_key, field.index, field.required)
+                for name, field in self.properties.items()
+            ))))
+
+        return self._fingerprint
+
     @property
     def model(self):
-        return InferredModel.from_descriptor(self)
+        return model_cache.get(self)
 
     def set_default_properties(self):
         self.properties.update(**{
@@ -134,43 +232,49 @@ class DescriptorModel(InferredModel):
                                                  format='date-time',
                                                  index=True),
         })
+        self._fingerprint = None
 
     def infer_schema_change(self, object_):
+        """Infers the fields of ``object_`` missing from the properties."""
+
         new_fields = {k: DescriptorFieldType.from_value(v)
                       for k, v in object_.items() if k not in self.properties}
 
-        if not new_fields:
-            return
+        return new_fields or None
 
+    def update_schema(self, new_fields):
         self.properties.update(**new_fields)  # noqa
-        self.save()
+        self.version = (self.version or 0) + 1
+        self._fingerprint = None
 
-        logger.info('Mutating schema.', extra={
-            'type_id': self.id,
-        })
+    def revise(self, new_fields):
+        """
+        Builds the next version of the descriptor with ``new_fields``.
 
-        management.sync_table(self.model)
-        return new_fields
+        The revision saves as an update conditioned on the current version,
+        and this instance is left untouched until it is stored.
+        """
 
-    @classmethod
-    def create(cls, *args, **kwargs):
-        created = cls(*args, **kwargs)
-        created.set_default_properties()
-        created.save()
+        revision = type(self)(id=self.id,
+                              properties=dict(self.properties),
+                              version=self.version)
+        revision._set_persisted()
+        revision.update_schema(new_fields)
+        return revision.iff(version=self.version)
 
-        logger.info('Creating schema.', extra={
-            'type_id': created.id,
-        })
+    def refresh(self, other):
+        """Adopts the stored state of another instance of the descriptor."""
 
-        management.sync_table(created.model)
-        return created
+        self.properties = dict(other.properties)
+        self.version = other.version
+        self._set_persisted()
+        self._fingerprint = None
 
     def save(self, **kwargs):
         logger.info('Updating schema.', extra={
             'type_id': self.id,
         })
 
-        management.sync_table(self.model)
         return super().save(**kwargs)
 
     def delete(self, **kwargs):
@@ -179,4 +283,5 @@ class DescriptorModel(InferredModel):
         })
 
         management.drop_table(self.model)
+        model_cache.invalidate(self.id)
         return super().delete(**kwargs)
@@ -0,0 +1,112 @@
+import collections
+import time
+
+
+class RecordAck:
+    """
+    Acknowledges a record to an ``OffsetTracker`` once processed.
+
+    The record is kept until then, to be dead-lettered if its write fails.
+    """
+
+    __slots__ = ('tracker', 'partition', 'record')
+
+    def __init__(self, tracker, partition, record):
+        self.tracker = tracker
+        self.partition = partition
+        self.record = record
+
+    def __call__(self):
+        self.tracker.ack(self.partition, self.record.offset)
+
+
+class OffsetTracker:
+    """
+    Offsets of the consumed records of each partition, until processed.
+
+    Records are tracked in consumption order and acknowledged once
+    written, possibly out of order. A partition can be committed up to its
+    highest contiguous acknowledged offset, so a commit never skips a
+    record that isn't written yet. Positions are committed in batches,
+    every ``commit_interval_ms`` at most.
+
+    Partitions with ``max_unacked`` records tracked are ``saturated()``,
+    and should not be consumed further until their records are written.
+    """
+
+    def __init__(self, commit_interval_ms=5000, max_unacked=10000):
+        self.commit_interval = commit_interval_ms / 1000
+        self.max_unacked = max_unacked
+        self.pending = {}
+        self.acked = {}
+        self.positions = {}
+        self.committed = {}
+        self.committed_at = time.monotonic()
+
+    def track(self, partition, offset):
+        pending = self.pending.get(partition)
+        if pending is None:
+            pending = self.pending[partition] = collections.deque()
+            self.acked[partition] = set()
+        pending.append(offset)
+
+    def ack(self, partition, offset):
+        pending = self.pending.get(partition)
+
+        # Revoked meanwhile, or already committed.
+        if not pending or offset < pending[0]:
+            return
+
+        acked = self.acked[partition]
+        acked.add(offset)
+
+        while pending and pending[0] in acked:
+            done = pending.popleft()
+            acked.discard(done)
+            self.positions[partition] = done + 1
+
+    def committable(self, partitions=None):
+        """Positions to commit, of ``partitions`` or of all partitions."""
+
+        if partitions is None:
+            partitions = self.positions
+
+        return {partition: self.positions[partition]
+                for partition in partitions
+                if partition in self.positions and
+                self.committed.get(partition) != self.positions[partition]}
+
+    @property
+    def due(self):
+        return (time.monotonic() - self.committed_at >= self.commit_interval
+                and bool(self.committable()))
+
+    @property
+    def unacked(self):
+        """Number of tracked records not processed yet."""
+
+        return sum(len(pending) for pending in self.pending.values())
+
+    def full(self, partition):
+        """Whether a partition has too many records not processed yet."""
+
+        return len(self.pending.get(partition, ())) >= self.max_unacked
+
+    def saturated(self):
+        """Partitions with too many records not processed yet."""
+
+        return {partition for partition, pending in self.pending.items()
+                if len(pending) >= self.max_unacked}
+
+    def mark_committed(self, offsets):
+        self.committed.update(offsets)
+        self.committed_at = time.monotonic()
+
+    def forget(self, partitions):
+        """Drops the state of revoked partitions."""
+
+        for partition in partitions:
+            self.pending.pop(partition, None)
+            self.acked.pop(partition, None)
+            self.positions.pop(partition, None)
+            self.committed.pop(partition, None)
@@ -0,0 +1,312 @@
+import asyncio
+import cProfile
+import collections
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+
+logger = logging.getLogger('moisturizer.profiling')
+
+
+PROFILING_ENGINES = ('stack', 'cprofile')
+
+TRACEMALLOC_FRAMES = 10
+
+# ``asyncio.current_task()`` is new in Python 3.7.
+current_task = getattr(asyncio, 'current_task', None) or \
+    asyncio.Task.current_task
+
+
+def running_task():
+    """The task running in this thread, ``None`` outside of one."""
+
+    try:
+        return current_task()
+    except RuntimeError:
+        return None
+
+
+def collapse_stack(frame):
+    """A frame stack in the collapsed format of flame graph tools."""
+
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{}:{}'.format(os.path.basename(code.co_filename),
+                                    code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler:
+    """
+    Samples the stack of a thread every ``interval_ms`` while active.
+
+    Samples of the thread starting the sampler, by default, are taken from
+    a background thread and aggregated by collapsed stack, for
+    ``flamegraph.pl`` or speedscope.
+
+    The sampler is active between ``enter()`` and ``exit()`` calls. Made
+    from a task, it is only active while that task runs, so the other
+    tasks of its loop aren't sampled while it is suspended.
+    """
+
+    def __init__(self, interval_ms=1, thread_id=None):
+        self.interval = interval_ms / 1000
+        self.thread_id = thread_id
+        self.stacks = collections.Counter()
+        self.tasks = collections.Counter()
+        self.loop = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        if self.thread_id is None:
+            self.thread_id = threading.get_ident()
+
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name='moisturizer-sampler')
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if not self.active:
+                continue
+
+            # Calls made outside of a task are sampled throughout.
+            if None not in self.tasks and \
+                    current_task(self.loop) not in self.tasks:
+                continue
+
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse_stack(frame)] += 1
+
+    @property
+    def active(self):
+        return bool(self.tasks)
+
+    def enter(self):
+        task = running_task()
+        if task is not None:
+            self.loop = asyncio.get_event_loop()
+        self.tasks[task] += 1
+
+    def exit(self):
+        task = running_task()
+        self.tasks[task] -= 1
+        if not self.tasks[task]:
+            del self.tasks[task]
+
+    def dump(self, path):
+        with open(path + '.folded', 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class CallProfiler:
+    """
+    Profiles the active calls with ``cProfile``, in a single profile.
+
+    ``cProfile`` traces the whole thread: while a call is active, the
+    other tasks its loop runs when it is suspended are profiled too.
+    """
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.active = 0
+
+    def start(self):
+        pass
+
+    def enter(self):
+        if not self.active:
+            self.profile.enable()
+        self.active += 1
+
+    def exit(self):
+        self.active -= 1
+        if not self.active:
+            self.profile.disable()
+
+    def dump(self, path):
+        self.profile.dump_stats(path + '.pstats')
+
+    def stop(self):
+        if self.active:
+            self.profile.disable()
+
+
+class Profiler:
+    """
+    Samples event commits and captures slow events.
+
+    A ``sample_rate`` fraction of the calls to ``wrap()``ped commits runs
+    under the ``engine`` profiler, whose aggregated output is dumped to
+    ``output_dir`` every ``dump_interval_ms``. Events slower than
+    ``slow_event_ms`` are logged with their type id, size and stage
+    timings, which commits collect in the ``timings`` dict they are given.
+    Consumers only wrap their commits when profiling, so it costs nothing
+    otherwise.
+    """
+
+    def __init__(self, identify, sample_rate=0.0, engine='stack',
+                 stack_interval_ms=1, output_dir='profiles',
+                 dump_interval_ms=60000, slow_event_ms=0, max_slow_events=100):
+        if engine not in PROFILING_ENGINES:
+            raise ValueError('Unknown profiling engine {}.'.format(engine))
+
+        self.identify = identify
+        self.sample_rate = sample_rate
+        self.output_dir = output_dir
+        self.dump_interval = dump_interval_ms / 1000
+        self.slow_event = slow_event_ms / 1000 if slow_event_ms else None
+
+        self.sampler = None
+        if sample_rate:
+            self.sampler = (StackSampler(stack_interval_ms)
+                            if engine == 'stack' else CallProfiler())
+
+        self.sampled = 0
+        self.slow_events = collections.deque(maxlen=max_slow_events)
+        self.slow_count = 0
+
+    @classmethod
+    def from_settings(cls, settings, identify):
+        return cls(
+            identify,
+            sample_rate=settings['profiling.sample_rate'],
+            engine=settings['profiling.engine'],
+            stack_interval_ms=settings['profiling.stack_interval_ms'],
+            output_dir=settings['profiling.output_dir'],
+            dump_interval_ms=settings['profiling.dump_interval_ms'],
+            slow_event_ms=settings['profiling.slow_event_ms'],
+        )
+
+    @property
+    def path(self):
+        return os.path.join(self.output_dir,
+                            'moisturizer-{}'.format(os.getpid()))
+
+    def wrap(self, commit):
+        """
+        Profiles ``commit(message, content_type, type_id, ...)``.
+
+        The commit is called with a ``timings`` keyword argument, a dict to
+        fill with the seconds spent in each stage of the event.
+        """
+
+        sampler = self.sampler
+        sample_rate = self.sample_rate
+        slow_event = self.slow_event
+
+        async def profiled(message, content_type=None, type_id=None, *args,
+                           **kwargs):
+            sampled = sampler is not None and random.random() < sample_rate
+            if sampled:
+                self.sampled += 1
+                sampler.enter()
+
+            timings = {}
+            started = time.perf_counter()
+            try:
+                return await commit(message, content_type, type_id, *args,
+                                    timings=timings, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                if sampled:
+                    sampler.exit()
+                if slow_event is not None and elapsed >= slow_event:
+                    self.slow(message, content_type, type_id, elapsed,
+                              timings)
+
+        return profiled
+
+    def slow(self, message, content_type, type_id, elapsed, timings):
+        # Decoded again, as only slow events need their type.
+        try:
+            type_id, _ = self.identify(message, content_type, type_id)
+        except Exception:
+            pass
+
+        event = {
+            'type_id': type_id,
+            'size': len(message),
+            'elapsed_ms': elapsed * 1000,
+            'stages_ms': {stage: value * 1000
+                          for stage, value in timings.items()},
+        }
+        self.slow_count += 1
+        self.slow_events.append(event)
+        logger.warning('Slow event.', extra=event)
+
+    def start(self):
+        if self.sampler is not None:
+            os.makedirs(self.output_dir, exist_ok=True)
+            self.sampler.start()
+
+    def dump(self):
+        if self.sampler is not None and self.sampled:
+            self.sampler.dump(self.path)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.dump_interval)
+            self.dump()
+
+    def stop(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.dump()
+
+    def stats(self):
+        return {
+            'profiled_events': self.sampled,
+            'slow_events': self.slow_count,
+        }
+
+
+class MemoryTracer:
+    """
+    Toggles ``tracemalloc`` on a signal.
+
+    The first signal starts tracing, the next one dumps a snapshot to
+    ``output_dir``, logs the top allocating lines and stops tracing, as
+    tracing slows the consumer down.
+    """
+
+    def __init__(self, output_dir='profiles', top=10):
+        self.output_dir = output_dir
+        self.top = top
+        self.snapshots = 0
+
+    def toggle(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            logger.info('Tracing memory allocations.')
+            return
+
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        self.snapshots += 1
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, 'moisturizer-{}-{}.snapshot'
+                            .format(os.getpid(), self.snapshots))
+        snapshot.dump(path)
+
+        logger.info('Memory snapshot.', extra={
+            'path': path,
+            'top': [str(stat) for stat in
+                    snapshot.statistics('lineno')[:self.top]],
+        })
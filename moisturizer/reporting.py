@@ -0,0 +1,225 @@
+import base64
+import collections
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiokafka import AIOKafkaProducer
+
+from moisturizer.errors import parse_exception
+
+
+logger = logging.getLogger('moisturizer.reporting')
+
+
+def error_kind(exception, type_id=None):
+    return type_id, type(exception).__name__
+
+
+class ErrorReporter:
+    """
+    Reports errors to Sentry off the event loop, sampled by kind.
+
+    Errors are counted by type id and exception class. Within each
+    ``sample_interval_ms`` window only the first ``sample_burst`` errors
+    of a kind are reported, the rest are counted and summarized in the
+    logs when the window ends. Reports are sent from a background thread,
+    and dropped while ``max_queue`` of them are already waiting.
+    """
+
+    def __init__(self, client, sample_interval_ms=60000, sample_burst=10,
+                 max_queue=100):
+        self.client = client
+        self.sample_interval = sample_interval_ms / 1000
+        self.sample_burst = sample_burst
+        self.max_queue = max_queue
+
+        self.counts = collections.Counter()
+        self.window = collections.Counter()
+        self.window_started_at = time.monotonic()
+        self.suppressed = 0
+        # Decremented from the reporting thread.
+        self.queued = 0
+        self.queued_lock = threading.Lock()
+        self.executor = None
+
+    def roll_window(self):
+        suppressed = {kind: count - self.sample_burst
+                      for kind, count in self.window.items()
+                      if count > self.sample_burst}
+        if suppressed:
+            logger.warning('Errors suppressed.', extra={
+                'errors': {'{}:{}'.format(*kind): count
+                           for kind, count in suppressed.items()},
+            })
+
+        self.window.clear()
+        self.window_started_at = time.monotonic()
+
+    def sampled(self, kind):
+        if time.monotonic() - self.window_started_at >= self.sample_interval:
+            self.roll_window()
+
+        self.window[kind] += 1
+        return self.window[kind] <= self.sample_burst
+
+    def report(self, exception, type_id=None, **extra):
+        kind = error_kind(exception, type_id)
+        self.counts[kind] += 1
+
+        if not self.sampled(kind) or not self.enqueue():
+            self.suppressed += 1
+            return
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+
+        future = self.executor.submit(
+            self.client.captureException,
+            exc_info=(type(exception), exception, exception.__traceback__),
+            tags={'type_id': type_id},
+            extra=extra,
+        )
+        future.add_done_callback(self._reported)
+
+    def enqueue(self):
+        with self.queued_lock:
+            if self.queued >= self.max_queue:
+                return False
+            self.queued += 1
+            return True
+
+    def _reported(self, future):
+        with self.queued_lock:
+            self.queued -= 1
+        if future.exception() is not None:
+            logger.error('Error report failed.', exc_info=future.exception())
+
+    def stats(self):
+        return {
+            'errors': sum(self.counts.values()),
+            'errors_suppressed': self.suppressed,
+        }
+
+    def close(self):
+        """Waits for the queued reports to be sent."""
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+
+def dead_letter(record, exception, type_id=None):
+    """Error metadata of a failed record."""
+
+    letter = {
+        'topic': record.topic,
+        'partition': record.partition,
+        'offset': record.offset,
+    }
+    letter.update(parse_exception(exception))
+    if type_id is not None:
+        letter['type'] = type_id
+    return letter
+
+
+class DeadLetters:
+    """Discards failed records."""
+
+    # Whether failed records are kept somewhere, and can be acknowledged.
+    stores = False
+
+    async def start(self):
+        pass
+
+    async def send(self, record, exception, type_id=None):
+        pass
+
+    async def stop(self):
+        pass
+
+
+class KafkaDeadLetters(DeadLetters):
+    """
+    Produces failed records to a dead-letter topic.
+
+    Raw values and keys are produced as is, with the error metadata in
+    ``moisturizer-*`` headers. Deliveries are not waited for.
+    """
+
+    stores = True
+    producer_class = AIOKafkaProducer
+
+    def __init__(self, cluster, topic, loop=None):
+        self.cluster = cluster
+        self.topic = topic
+        self.loop = loop
+        self.producer = None
+        self.failures = 0
+
+    async def start(self):
+        self.producer = self.producer_class(loop=self.loop,
+                                            bootstrap_servers=self.cluster)
+        await self.producer.start()
+
+    def _delivered(self, future):
+        if future.cancelled() or future.exception() is not None:
+            self.failures += 1
+
+    async def send(self, record, exception, type_id=None):
+        headers = [('moisturizer-{}'.format(name), str(value).encode())
+                   for name, value in dead_letter(record, exception,
+                                                  type_id).items()
+                   if value is not None]
+
+        delivery = await self.producer.send(self.topic, value=record.value,
+                                            key=record.key, headers=headers)
+        delivery.add_done_callback(self._delivered)
+
+    async def stop(self):
+        if self.producer is not None:
+            await self.producer.stop()
+
+
+class FileDeadLetters(DeadLetters):
+    """
+    Appends failed records to a local JSON lines file.
+
+    Each line holds the error metadata and the raw value, base64 encoded.
+    """
+
+    stores = True
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    async def start(self):
+        self.file = open(self.path, 'a')
+
+    async def send(self, record, exception, type_id=None):
+        letter = dead_letter(record, exception, type_id)
+        letter['value'] = base64.b64encode(record.value).decode('ascii')
+        self.file.write(json.dumps(letter) + '\n')
+
+    async def stop(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def create_dead_letters(settings, loop=None):
+    kind = settings['errors.dead_letter']
+
+    if kind == 'kafka':
+        return KafkaDeadLetters(settings['kafka.cluster'],
+                                settings['errors.dead_letter_topic'],
+                                loop=loop)
+    if kind == 'file':
+        return FileDeadLetters(settings['errors.dead_letter_path'])
+    if not kind:
+        return DeadLetters()
+
+    raise ValueError('Unknown dead letter destination {}.'.format(kind))
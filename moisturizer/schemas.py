@@ -1,9 +1,17 @@
+import collections
+import decimal
+
 import colander
 import flatten_json
+import iso8601
 
 from moisturizer.models import (
     DescriptorFieldType,
 )
+from moisturizer.utils import KeyCache, flatten_object
+
+
+FLATTEN_KEYS = KeyCache(separator='__')
 
 
 JSONSCHEMA_COLANDER_TYPE_MAPPER = {
@@ -35,9 +43,14 @@ class BaseMappingSchema(colander.MappingSchema):
         return colander.Mapping(unknown='preserve')
 
     def flatten(self, nested):
-        return {k: v for k, v in
-                flatten_json.flatten(nested, separator='__').items()
-                if v is not None}
+        flatten, _ = flatten_object(nested, FLATTEN_KEYS)
+        return flatten
+
+    def flatten_infer(self, nested, known):
+        """Flattens an object, inferring the fields missing from ``known``."""
+
+        return flatten_object(nested, FLATTEN_KEYS, known=known,
+                              infer=DescriptorFieldType.from_value)
 
     def unflatten(self, flatten):
         return flatten_json.unflatten(flatten, separator='__')
@@ -76,6 +89,254 @@ class InferredObjectSchema(BaseMappingSchema):
         return super()._bind(kw)
 
 
+class _Fallback(Exception):
+    """Raised by compiled functions to defer to the colander schema."""
+
+
+def _compile_node(node, index):
+    """Generates the statements deserializing the value ``v`` of a node."""
+
+    name = repr(node.name)
+    typ = node.typ
+    on_null = ('raise _Fallback' if node.missing is colander.required
+               else 'pass')
+
+    if node.preparer is not None or node.validator is not None:
+        kind = None
+    else:
+        kind = type(typ)
+
+    if kind is colander.String and not typ.encoding and not typ.allow_empty:
+        return [
+            'if v.__class__ is not str:',
+            '    raise _Fallback',
+            'if v:',
+            '    result[{}] = v'.format(name),
+            'else:',
+            '    ' + on_null,
+        ]
+
+    if kind is colander.Integer:
+        return [
+            'if v.__class__ is int:',
+            '    result[{}] = v'.format(name),
+            'elif v.__class__ is str and v:',
+            '    try:',
+            '        result[{}] = int(v)'.format(name),
+            '    except ValueError:',
+            '        raise _Fallback',
+            'else:',
+            '    raise _Fallback',
+        ]
+
+    if kind is colander.Float:
+        return [
+            'if v.__class__ is float or v.__class__ is int:',
+            '    result[{}] = float(v)'.format(name),
+            'else:',
+            '    raise _Fallback',
+        ]
+
+    if (kind is colander.Decimal and typ.quant is None and
+            not typ.normalize):
+        return [
+            'if v.__class__ is int or v.__class__ is float or (',
+            '        v.__class__ is str and v):',
+            '    try:',
+            '        result[{}] = _Decimal(str(v))'.format(name),
+            '    except _DecimalException:',
+            '        raise _Fallback',
+            'else:',
+            '    raise _Fallback',
+        ]
+
+    if (kind is colander.Boolean and not typ.true_choices and
+            typ.false_choices == ('false', '0')):
+        return [
+            'if v.__class__ is bool:',
+            '    result[{}] = v'.format(name),
+            'elif v.__class__ is str or v.__class__ is int:',
+            '    result[{}] = str(v).lower() not in _FALSE'.format(name),
+            'else:',
+            '    raise _Fallback',
+        ]
+
+    if kind is colander.DateTime:
+        return [
+            'if not v:',
+            '    ' + on_null,
+            'elif v.__class__ is not str:',
+            '    raise _Fallback',
+            'else:',
+            '    try:',
+            '        result[{}] = _parse_date(v, default_timezone=_n{}.typ'
+            '.default_tzinfo)'.format(name, index),
+            '    except Exception:',
+            '        raise _Fallback',
+        ]
+
+    return [
+        'try:',
+        '    v = _n{}.deserialize(v)'.format(index),
+        'except _Invalid:',
+        '    raise _Fallback',
+        'if v is not _drop:',
+        '    result[{}] = v'.format(name),
+    ]
+
+
+def compile_deserializer(schema):
+    """
+    Generates a function deserializing objects like a bound object schema.
+
+    The function inlines the common coercions of each property type and
+    raises ``_Fallback`` for anything else, including invalid values.
+    """
+
+    namespace = {
+        '_Fallback': _Fallback,
+        '_Invalid': colander.Invalid,
+        '_Decimal': decimal.Decimal,
+        '_DecimalException': decimal.DecimalException,
+        '_FALSE': ('false', '0'),
+        '_drop': colander.drop,
+        '_null': colander.null,
+        '_parse_date': iso8601.parse_date,
+    }
+
+    lines = [
+        'def deserialize(cstruct):',
+        '    if cstruct.__class__ is not dict:',
+        '        raise _Fallback',
+        '    id_field = cstruct.get("id")',
+        '    if id_field is not None:',
+        '        cstruct["id"] = str(id_field)',
+        '    value = {k: v for k, v in cstruct.items() if v is not None}',
+        '    result = {}',
+    ]
+
+    for index, node in enumerate(schema.children):
+        namespace['_n{}'.format(index)] = node
+        lines.append('    v = value.pop({!r}, _null)'.format(node.name))
+
+        if node.missing is colander.required:
+            lines.append('    if v is _null:')
+            lines.append('        raise _Fallback')
+        lines.append('    if v is not _null:')
+        lines.extend('        ' + line
+                     for line in _compile_node(node, index))
+
+    lines.append('    result.update(value)')
+    lines.append('    return result')
+
+    exec('\n'.join(lines), namespace)
+    return namespace['deserialize']
+
+
+class CompiledObjectSchema:
+    """
+    Object schema deserializing with a function compiled per descriptor.
+
+    Results and errors are the same as the bound colander schema, which
+    is used whenever the compiled function falls back.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self._deserialize = compile_deserializer(schema)
+
+    @classmethod
+    def bind(cls, schema, **kw):
+        return cls(schema.bind(**kw))
+
+    def deserialize(self, cstruct):
+        try:
+            return self._deserialize(cstruct)
+        except _Fallback:
+            return self.schema.deserialize(cstruct)
+
+    def serialize(self, appstruct):
+        return self.schema.serialize(appstruct)
+
+    def flatten(self, nested):
+        return self.schema.flatten(nested)
+
+    def flatten_infer(self, nested, known):
+        return self.schema.flatten_infer(nested, known)
+
+    def unflatten(self, flatten):
+        return self.schema.unflatten(flatten)
+
+
+SCHEMA_ENGINES = {
+    'colander': lambda schema, **kw: schema.bind(**kw),
+    'compiled': CompiledObjectSchema.bind,
+}
+
+
+class SchemaCache:
+    """
+    Bound object schemas by descriptor revision.
+
+    Binding builds a node per descriptor property, so schemas are bound
+    once per ``(type_id, fingerprint)`` and reused. Superseded revisions
+    of a type are dropped, and the least recently used schemas are
+    evicted past ``max_size``.
+
+    ``engine`` picks how bound schemas deserialize, one of
+    ``SCHEMA_ENGINES``.
+    """
+
+    def __init__(self, schema=None, max_size=1024, engine='colander'):
+        self.schema = schema or InferredObjectSchema()
+        self.bind = SCHEMA_ENGINES[engine]
+        self.max_size = max_size
+        self.schemas = collections.OrderedDict()
+        self.revisions = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, descriptor):
+        key = (descriptor.id, descriptor.fingerprint)
+        schema = self.schemas.get(key)
+
+        if schema is not None:
+            self.hits += 1
+            self.schemas.move_to_end(key)
+            return schema
+
+        self.misses += 1
+        schema = self.bind(self.schema, descriptor=descriptor)
+
+        self.invalidate(descriptor.id)
+        self.schemas[key] = schema
+        self.revisions[descriptor.id] = key
+
+        while len(self.schemas) > self.max_size:
+            (type_id, _), _ = self.schemas.popitem(last=False)
+            del self.revisions[type_id]
+
+        return schema
+
+    def invalidate(self, type_id):
+        key = self.revisions.pop(type_id, None)
+        if key is not None:
+            del self.schemas[key]
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {
+            'size': len(self.schemas),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate,
+        }
+
+
 class TypeField(colander.MappingSchema):
     type = colander.SchemaNode(colander.String(),
                                required=True)
@@ -0,0 +1,188 @@
+import asyncio
+import collections
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+from moisturizer import async_start, connect, create_consumer
+
+
+logger = logging.getLogger('moisturizer.supervisor')
+
+
+async def report_stats(index, consumer, reports, interval):
+    while True:
+        await asyncio.sleep(interval)
+        reports.put((index, os.getpid(), consumer.stats()))
+
+
+def run_worker(index, settings, reports):
+    """Runs a consumer in a worker process."""
+
+    # Don't run the supervisor handlers inherited by the fork.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    # Each worker serves its metrics on its own port.
+    if settings['metrics.port']:
+        settings = dict(settings)
+        settings['metrics.port'] += index
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    session = connect(settings, migrate=False)
+    consumer = create_consumer(settings, session, loop)
+    reporter = loop.create_task(report_stats(
+        index, consumer, reports,
+        settings['supervisor.report_interval_ms'] / 1000))
+
+    try:
+        async_start(settings, session, loop=loop, consumer=consumer)
+    finally:
+        reporter.cancel()
+        reports.put((index, os.getpid(), consumer.stats()))
+        session.cluster.shutdown()
+
+
+class Supervisor:
+    """
+    Runs consumers of the same Kafka group in worker processes.
+
+    Kafka balances the topic partitions between workers. Workers that
+    exit while the supervisor runs are restarted, and SIGTERM or SIGINT
+    stop them gracefully, killing those still running after
+    ``supervisor.shutdown_timeout_ms``. Workers report their stats every
+    ``supervisor.report_interval_ms``, aggregated by ``health()``.
+    """
+
+    def __init__(self, settings, workers=None, target=run_worker):
+        self.settings = settings
+        self.workers = (workers or settings['supervisor.workers'] or
+                        os.cpu_count())
+        self.target = target
+        self.restart_delay = settings['supervisor.restart_delay_ms'] / 1000
+        self.report_interval = (settings['supervisor.report_interval_ms'] /
+                                1000)
+        self.shutdown_timeout = (settings['supervisor.shutdown_timeout_ms'] /
+                                 1000)
+
+        self.processes = {}
+        self.restarts = collections.Counter()
+        self.stats = {}
+        self.reports = multiprocessing.Queue()
+        self.stopping = False
+
+    def spawn(self, index):
+        process = multiprocessing.Process(
+            target=self.target,
+            args=(index, self.settings, self.reports),
+            name='moisturizer-worker-{}'.format(index),
+        )
+        process.start()
+        self.processes[index] = process
+
+        logger.info('Worker started.', extra={
+            'worker': index,
+            'pid': process.pid,
+        })
+
+    def check(self):
+        """Restarts workers that exited."""
+
+        for index, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+
+            logger.error('Worker exited.', extra={
+                'worker': index,
+                'pid': process.pid,
+                'exitcode': process.exitcode,
+            })
+
+            self.restarts[index] += 1
+            self.spawn(index)
+
+    def collect(self):
+        """Reads the stats reported by workers since the last call."""
+
+        while True:
+            try:
+                index, pid, stats = self.reports.get_nowait()
+            except queue.Empty:
+                return
+            self.stats[index] = stats
+
+    def health(self):
+        totals = collections.Counter()
+        for stats in self.stats.values():
+            totals.update(stats)
+
+        return {
+            'workers': self.workers,
+            'alive': sum(process.is_alive()
+                         for process in self.processes.values()),
+            'restarts': sum(self.restarts.values()),
+            'stats': dict(totals),
+        }
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def shutdown(self):
+        """Stops workers, waiting for them to finish their batches."""
+
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+
+        deadline = time.monotonic() + self.shutdown_timeout
+        for index, process in self.processes.items():
+            process.join(max(deadline - time.monotonic(), 0))
+
+            if process.is_alive():
+                logger.error('Worker killed.', extra={
+                    'worker': index,
+                    'pid': process.pid,
+                })
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+
+        self.collect()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for index in range(self.workers):
+            self.spawn(index)
+
+        reported_at = time.monotonic()
+        try:
+            while not self.stopping:
+                time.sleep(self.restart_delay)
+                self.collect()
+
+                if not self.stopping:
+                    self.check()
+
+                if time.monotonic() - reported_at >= self.report_interval:
+                    logger.info('Workers health.', extra=self.health())
+                    reported_at = time.monotonic()
+        finally:
+            self.shutdown()
+
+
+def supervise(settings, workers=None):
+    """Migrates the schema once, then runs consumers in worker processes."""
+
+    session = connect(settings)
+
+    # The driver isn't fork safe, workers open their own connections.
+    session.cluster.shutdown()
+
+    logger.info('Starting supervisor.')
+    Supervisor(settings, workers=workers).run()
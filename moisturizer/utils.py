@@ -1,6 +1,12 @@
+import datetime
+
+import iso8601
+
 
 PRIMITIVES = [int, bool, float, str, dict, list, type(None)]
 
+EPOCH = datetime.datetime(1970, 1, 1)
+
 
 def flatten_dict(nested, separator='.'):
     def items():
@@ -16,6 +22,116 @@ def flatten_dict(nested, separator='.'):
     return dict(items())
 
 
+class KeyCache:
+    """
+    Joined flattened keys by parent key and child key.
+
+    Events of a type repeat the same paths, so joined keys are built once
+    and reused. The cache is cleared once it holds ``max_size`` keys, as
+    map-like payloads can have unbounded key spaces.
+    """
+
+    def __init__(self, separator='__', max_size=65536):
+        self.separator = separator
+        self.max_size = max_size
+        self.keys = {}
+        self.size = 0
+
+    def join(self, prefix, key):
+        children = self.keys.get(prefix)
+        if children is None:
+            children = self.keys[prefix] = {}
+
+        joined = children.get(key)
+        if joined is None:
+            if self.size >= self.max_size:
+                self.keys.clear()
+                self.size = 0
+                children = self.keys[prefix] = {}
+
+            joined = children[key] = '{}{}{}'.format(prefix, self.separator,
+                                                      key)
+            self.size += 1
+        return joined
+
+
+def flatten_object(nested, keys, known=None, infer=None):
+    """
+    Flattens an object in a single iterative pass.
+
+    Keys match ``flatten_json.flatten``: nested keys are joined by the
+    separator of ``keys``, a ``KeyCache``, list items are keyed by their
+    index and empty containers are kept as is. Null values are dropped.
+
+    When ``infer`` is given, it is called with the values of keys missing
+    from ``known``. Returns the flattened object and the inferred fields.
+    """
+
+    flatten = {}
+    inferred = {}
+    stack = [(None, iter(nested.items()))]
+
+    while stack:
+        prefix, items = stack[-1]
+
+        for key, value in items:
+            if prefix:
+                key = keys.join(prefix, key)
+
+            if value is None:
+                continue
+
+            if value and isinstance(value, dict):
+                stack.append((key, iter(value.items())))
+                break
+
+            if value and isinstance(value, (list, tuple, set)):
+                stack.append((key, enumerate(value)))
+                break
+
+            flatten[key] = value
+            if infer is not None and key not in known:
+                inferred[key] = infer(value)
+        else:
+            stack.pop()
+
+    return flatten, inferred
+
+
+def timestamp_micros(value):
+    """
+    Microseconds since the epoch of a timestamp, or ``None``.
+
+    Takes datetimes, naive ones being UTC, ISO 8601 strings and epoch
+    numbers, whose unit is told from their magnitude: seconds,
+    milliseconds or microseconds.
+    """
+
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(iso8601.UTC).replace(tzinfo=None)
+        delta = value - EPOCH
+        return ((delta.days * 86400 + delta.seconds) * 1000000 +
+                delta.microseconds)
+
+    if isinstance(value, bool):
+        return None
+
+    if isinstance(value, (int, float)):
+        if abs(value) < 1e11:
+            return int(value * 1000000)
+        if abs(value) < 1e14:
+            return int(value * 1000)
+        return int(value)
+
+    if isinstance(value, str):
+        try:
+            return timestamp_micros(iso8601.parse_date(value,
+                                                       default_timezone=None))
+        except iso8601.ParseError:
+            return None
+
+
 def unflatten_dict(flatten, separator='.'):
     unflatten = {}
 
@@ -0,0 +1,391 @@
+import asyncio
+import collections
+import functools
+import logging
+import time
+
+from cassandra.cqlengine.query import BatchQuery, BatchType
+from cassandra.query import SimpleStatement
+
+
+logger = logging.getLogger('moisturizer.writer')
+
+
+MAX_RETRY_DELAY_MS = 10000
+
+
+async def retry(call, retries=3, delay_ms=100):
+    """
+    Awaits ``call()``, retrying it up to ``retries`` times when it fails.
+
+    Retries are delayed by ``delay_ms``, doubled after each one up to
+    ``MAX_RETRY_DELAY_MS``. The last failure is raised, unless ``retries``
+    is ``None``: the call is then retried until it succeeds.
+    """
+
+    attempt = 0
+    while retries is None or attempt < retries:
+        try:
+            return await call()
+        except Exception as e:
+            delay = min(delay_ms * 2 ** attempt, MAX_RETRY_DELAY_MS)
+            attempt += 1
+            logger.warning('Retrying after failure.', extra={
+                'attempt': attempt,
+                'delay_ms': delay,
+                'error': str(e),
+            })
+            await asyncio.sleep(delay / 1000)
+
+    return await call()
+
+
+def capture_statements(models):
+    """Collects the insert statements of ``models`` without executing them."""
+
+    capture = BatchQuery()
+    for model in models:
+        model.batch(capture).save()
+    return capture.queries
+
+
+def validate_model(model):
+    """
+    Validates the values of a model as ``save()`` does, leaving it as is.
+
+    Raises a ``ValidationError`` for values its columns can't write.
+    """
+
+    for name, column in model._columns.items():
+        value = getattr(model, name)
+        if value is None and not model._values[name].explicit and \
+                column.has_default:
+            continue
+        column.validate(value)
+
+
+def render_statements(statements, batch_type=BatchType.Unlogged):
+    """
+    Renders statements as a single CQL query and its parameters.
+
+    A single statement is rendered as is, more than one are wrapped in a
+    ``BEGIN BATCH`` block the same way ``BatchQuery.execute()`` does.
+    """
+
+    if len(statements) == 1:
+        statement, = statements
+        statement.update_context_id(0)
+        return str(statement), statement.get_context()
+
+    query_list = ['BEGIN {} BATCH'.format(batch_type)]
+    parameters = {}
+    ctx_counter = 0
+
+    for statement in statements:
+        statement.update_context_id(ctx_counter)
+        context = statement.get_context()
+        ctx_counter += len(context)
+        query_list.append('  ' + str(statement))
+        parameters.update(context)
+
+    query_list.append('APPLY BATCH;')
+    return '\n'.join(query_list), parameters
+
+
+def estimate_size(statement):
+    """Roughly estimates the mutation size of a statement in bytes."""
+
+    size = 0
+    for value in statement.get_context().values():
+        if isinstance(value, (str, bytes)):
+            size += len(value)
+        else:
+            size += 8
+    return size
+
+
+def key_values(model, keys):
+    return tuple(getattr(model, name) for name in keys)
+
+
+def event_time(model):
+    manager = model._values.get('last_modified')
+    if manager is not None and manager.explicit:
+        return manager.value
+
+
+def merge_models(previous, model):
+    """
+    Merges two writes of the same row into one.
+
+    Fields of the newest event win, by ``last_modified`` when both set it
+    or else by arrival order. Fields missing from it are kept from the
+    other one. Both writes must have the same write timestamp.
+    """
+
+    try:
+        if event_time(model) < event_time(previous):
+            previous, model = model, previous
+    except TypeError:
+        pass
+
+    for name, manager in model._values.items():
+        if manager.explicit and manager.value is not None:
+            continue
+
+        other = previous._values[name]
+        if other.explicit and other.value is not None:
+            setattr(model, name, other.value)
+            manager.explicit = True
+
+    return model
+
+
+class BatchWriter:
+    """
+    Accumulates inferred models and writes them in per-partition batches.
+
+    Models are grouped by type and partition key. Each group is split in
+    ``UNLOGGED`` batches bounded by ``max_batch_statements`` and
+    ``max_batch_bytes`` (keep the latter under Cassandra's
+    ``batch_size_warn_threshold_in_kb``), and never holding the same
+    primary key twice. Groups are then written concurrently, so a group
+    with a single row is just a single-partition write.
+
+    Flushing only dispatches the writes: at most ``max_in_flight`` of them
+    run at once, and writes to the same partition are chained so they are
+    applied in order. Failed writes are retried ``max_retries`` times,
+    then handed to ``on_failure`` with their acks, to dead-letter and
+    acknowledge their records. With ``max_retries`` set to ``None``, they
+    are retried until they succeed, their records left unacknowledged.
+
+    With ``coalesce``, models added for the same row and write timestamp
+    until the next flush are merged in a single write, see
+    ``merge_models()``. Writes with other timestamps are kept apart, so
+    each cell converges by its own timestamp.
+    """
+
+    def __init__(self, session, enabled=True, max_messages=500,
+                 max_latency_ms=50, max_batch_statements=50,
+                 max_batch_bytes=5120, max_in_flight=128, coalesce=True,
+                 max_retries=3, retry_delay_ms=100, on_error=None,
+                 on_failure=None, metrics=None):
+        self.session = session
+        self.enabled = enabled
+        self.max_messages = max_messages if enabled else 1
+        self.max_latency = max_latency_ms / 1000
+        self.max_batch_statements = max_batch_statements
+        self.max_batch_bytes = max_batch_bytes
+        self.max_in_flight = max_in_flight
+        self.coalesce = coalesce
+        self.max_retries = max_retries
+        self.retry_delay_ms = retry_delay_ms
+        self.on_error = on_error
+        self.on_failure = on_failure
+        self.metrics = metrics
+
+        self.pending = collections.OrderedDict()
+        self.rows = {}
+        self.size = 0
+        self.first_added_at = None
+        self.coalesced = 0
+
+        self.in_flight = set()
+        self.tails = {}
+        self._window = None
+
+    @classmethod
+    def from_settings(cls, session, settings, **kwargs):
+        return cls(
+            session,
+            enabled=settings['batch.enabled'],
+            max_messages=settings['batch.max_messages'],
+            max_latency_ms=settings['batch.max_latency_ms'],
+            max_batch_statements=settings['batch.max_statements'],
+            max_batch_bytes=settings['batch.max_bytes'],
+            max_in_flight=settings['cassandra.max_in_flight'],
+            coalesce=settings['batch.coalesce'],
+            max_retries=settings['cassandra.max_retries'],
+            retry_delay_ms=settings['cassandra.retry_delay_ms'],
+            **kwargs
+        )
+
+    @property
+    def window(self):
+        # Created lazily to bind to the running loop.
+        if self._window is None:
+            self._window = asyncio.Semaphore(self.max_in_flight)
+        return self._window
+
+    @property
+    def full(self):
+        """Whether the in-flight window is full."""
+
+        return len(self.in_flight) >= self.max_in_flight
+
+    @property
+    def due(self):
+        """Whether the pending models should be flushed."""
+
+        if self.size >= self.max_messages:
+            return True
+
+        return (self.first_added_at is not None and
+                time.monotonic() - self.first_added_at >= self.max_latency)
+
+    @property
+    def timeout(self):
+        """Seconds left until the pending models are due."""
+
+        if self.first_added_at is None:
+            return None
+
+        elapsed = time.monotonic() - self.first_added_at
+        return max(self.max_latency - elapsed, 0)
+
+    def add(self, type_id, model, ack=None):
+        """
+        Adds a model, calling ``ack`` once it is written.
+
+        Invalid models raise here, leaving the pending ones to be written.
+        """
+
+        validate_model(model)
+
+        acks = [ack] if ack is not None else []
+        self.size += 1
+
+        if self.coalesce:
+            row = (type_id, key_values(model, model._primary_keys))
+            entry = self.rows.get(row)
+
+            if entry is not None and entry[0]._timestamp == model._timestamp:
+                entry[0] = merge_models(entry[0], model)
+                entry[1].extend(acks)
+                self.coalesced += 1
+                return
+
+        entry = [model, acks]
+        key = (type_id, key_values(model, model._partition_keys))
+        self.pending.setdefault(key, []).append(entry)
+
+        if self.coalesce:
+            self.rows[row] = entry
+
+        if self.first_added_at is None:
+            self.first_added_at = time.monotonic()
+
+    def split(self, entries):
+        """
+        Splits the models of a partition in batches within thresholds.
+
+        Yields the statements of each batch and the acks of their models.
+        """
+
+        models = [model for model, _ in entries]
+        batch, acks, batch_bytes, primary_keys = [], [], 0, set()
+
+        for statement, (model, model_acks) in zip(capture_statements(models),
+                                                  entries):
+            size = estimate_size(statement)
+            primary_key = key_values(model, model._primary_keys)
+
+            if batch and (len(batch) >= self.max_batch_statements or
+                          batch_bytes + size > self.max_batch_bytes or
+                          primary_key in primary_keys):
+                yield batch, acks
+                batch, acks, batch_bytes, primary_keys = [], [], 0, set()
+
+            batch.append(statement)
+            batch_bytes += size
+            primary_keys.add(primary_key)
+            acks.extend(model_acks)
+
+        if batch:
+            yield batch, acks
+
+    async def write(self, statements, previous=None, acks=(), type_id=None):
+        # Writes to the same partition wait for the previous one.
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        query, parameters = render_statements(statements)
+        execute = functools.partial(self.session.execute_future,
+                                    SimpleStatement(query), parameters)
+        started = time.perf_counter()
+        try:
+            await retry(execute, self.max_retries, self.retry_delay_ms)
+        except Exception as e:
+            await self.failed(e, acks, type_id)
+            return
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe('write', started)
+
+        for ack in acks:
+            ack()
+
+    async def failed(self, exception, acks, type_id=None):
+        # Given up on, so that its partitions keep being committed.
+        if self.on_failure is not None:
+            await self.on_failure(exception, acks, type_id)
+        elif self.on_error is not None:
+            self.on_error(exception)
+        else:
+            raise exception
+
+    def _write_done(self, key, task):
+        self.in_flight.discard(task)
+        self.window.release()
+
+        if self.tails.get(key) is task:
+            del self.tails[key]
+
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Write failed.', exc_info=task.exception())
+
+    async def dispatch(self, key, statements, acks=()):
+        """Schedules a write, waiting for room in the in-flight window."""
+
+        await self.window.acquire()
+
+        task = asyncio.ensure_future(
+            self.write(statements, previous=self.tails.get(key), acks=acks,
+                       type_id=key[0]))
+        task.add_done_callback(functools.partial(self._write_done, key))
+
+        self.in_flight.add(task)
+        self.tails[key] = task
+        return task
+
+    async def wait_for_capacity(self):
+        """Waits until the in-flight window has room for a write."""
+
+        await self.window.acquire()
+        self.window.release()
+
+    async def drain(self):
+        """Waits for all in-flight writes."""
+
+        if self.in_flight:
+            await asyncio.wait(list(self.in_flight))
+
+    async def flush(self):
+        """Dispatches all pending models, one write per partition batch."""
+
+        pending = self.pending
+        self.pending = collections.OrderedDict()
+        self.rows = {}
+        self.size = 0
+        self.first_added_at = None
+
+        if not pending:
+            return
+
+        logger.debug('Flushing batch.', extra={
+            'partitions': len(pending),
+        })
+
+        for key, entries in pending.items():
+            for statements, acks in self.split(entries):
+                await self.dispatch(key, statements, acks)
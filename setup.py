@@ -9,7 +9,7 @@ REQUIREMENTS = [
     'cassandra-driver',
     'colander',
     'logmatic-python',
-    'msgpack',
+    'msgpack>=0.5.2',
 ]
 
 
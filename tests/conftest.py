@@ -0,0 +1,47 @@
+import asyncio
+
+import pytest
+from cassandra.cqlengine import models
+
+
+class FakeSession(object):
+    """
+    Records queries passed to the ``aiosession`` API.
+
+    Queries are only answered while ``gate`` is set, with the rows
+    returned by ``respond``. Lightweight transactions apply by default.
+    """
+
+    def __init__(self):
+        self.executed = []
+        self.started = []
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def execute_future(self, query, parameters=None):
+        self.started.append((query.query_string, parameters))
+        await self.gate.wait()
+        self.executed.append((query.query_string, parameters))
+        return self.respond(query.query_string, parameters)
+
+    def respond(self, query, parameters):
+        if query.startswith(('INSERT', 'UPDATE')) and ' IF ' in query:
+            return [{'[applied]': True}]
+        return []
+
+
+@pytest.fixture()
+def event_loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture()
+def session():
+    return FakeSession()
+
+
+@pytest.fixture(autouse=True)
+def default_keyspace(monkeypatch):
+    monkeypatch.setattr(models, 'DEFAULT_KEYSPACE', 'test')
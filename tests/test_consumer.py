@@ -0,0 +1,675 @@
+import asyncio
+import collections
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import msgpack
+import pytest
+
+from moisturizer.consumer import MoisturizerKafkaConsumer
+from moisturizer.models import (
+    DescriptorModel,
+    DescriptorFieldType,
+    record_id,
+)
+from moisturizer.reporting import FileDeadLetters
+from moisturizer.writer import BatchWriter
+
+
+Record = collections.namedtuple('Record', ['topic', 'partition', 'offset',
+                                           'value', 'key', 'headers',
+                                           'timestamp'])
+
+
+class FakeKafkaConsumer(object):
+    """Replays ``getmany()`` batches and stops the owner when done."""
+
+    batches = []
+    highwaters = {}
+    owner = None
+
+    def __init__(self, **options):
+        self.options = options
+        self.topics = None
+        self.listener = None
+        self.started = False
+        self.stopped = False
+        self.paused = set()
+        self.polls = []
+        self.commits = []
+
+    def subscribe(self, topics, listener=None):
+        self.topics = topics
+        self.listener = listener
+
+    async def start(self):
+        self.started = True
+
+    def assignment(self):
+        return {0, 1}
+
+    def highwater(self, partition):
+        return self.highwaters.get(partition)
+
+    def pause(self, *partitions):
+        self.paused.update(partitions)
+
+    def resume(self, *partitions):
+        self.paused.difference_update(partitions)
+
+    async def stop(self):
+        self.stopped = True
+
+    async def commit(self, offsets):
+        self.commits.append(offsets)
+
+    async def getmany(self, *partitions, timeout_ms=0, max_records=None):
+        self.polls.append((timeout_ms, max_records))
+        if len(self.polls) >= len(self.batches):
+            self.owner.stop()
+        if len(self.polls) > len(self.batches):
+            return {}
+        return self.batches[len(self.polls) - 1]
+
+
+def make_record(partition, offset, payload, key=None, headers=(),
+                timestamp=-1):
+    return Record('logs', partition, offset, json.dumps(payload).encode(),
+                  key, headers, timestamp)
+
+
+@pytest.fixture()
+def consumer(event_loop, session):
+    consumer = MoisturizerKafkaConsumer(
+        cluster='localhost:9092',
+        topics=['logs'],
+        group='moisturizer',
+        event_loop=event_loop,
+        settings={'kafka.max_poll_records': 10},
+        session=session,
+    )
+    consumer.kafka_consumer_class = FakeKafkaConsumer
+    FakeKafkaConsumer.owner = consumer
+    return consumer
+
+
+class TestKafkaConsumer(object):
+
+    def test_unwrap_json_message(self, consumer):
+        raw = json.dumps({'type_id': 'hello', 'data': {'foo': 1}})
+        assert consumer.unwrap_message(raw.encode()) == ('hello', {'foo': 1})
+
+    def test_unwrap_msgpack_message(self, consumer):
+        raw = msgpack.packb({'type_id': 'hello', 'data': {'foo': 'bar'}},
+                            use_bin_type=True)
+        assert consumer.unwrap_message(raw, 'application/msgpack') == \
+            ('hello', {'foo': 'bar'})
+
+    def test_unwrap_message_requires_type(self, consumer):
+        with pytest.raises(ValueError):
+            consumer.unwrap_message(json.dumps({'data': {}}).encode())
+
+    def test_kafka_consumer_options(self, consumer):
+        kafka = consumer.create_kafka_consumer()
+        assert kafka.topics == ['logs']
+        assert kafka.options['group_id'] == 'moisturizer'
+        assert kafka.options['enable_auto_commit'] is False
+        assert kafka.options['max_poll_records'] == 10
+        assert kafka.options['fetch_max_wait_ms'] == 500
+
+    def test_start_consumes_batches_per_partition(self, consumer,
+                                                  event_loop):
+        committed = []
+
+        async def commit_message(value, *args, **kwargs):
+            committed.append(json.loads(value.decode())['n'])
+            await asyncio.sleep(0)
+
+        consumer.commit_message = commit_message
+        FakeKafkaConsumer.batches = [
+            {0: [make_record(0, 0, {'n': 0}), make_record(0, 1, {'n': 1})],
+             1: [make_record(1, 0, {'n': 10})]},
+            {0: [make_record(0, 2, {'n': 2})]},
+        ]
+
+        event_loop.run_until_complete(consumer.start())
+
+        assert sorted(committed) == [0, 1, 2, 10]
+        partition_0 = [n for n in committed if n < 10]
+        assert partition_0 == [0, 1, 2]
+
+    def test_start_keeps_consuming_on_errors(self, consumer, event_loop,
+                                             monkeypatch):
+        captured = []
+        monkeypatch.setattr('moisturizer.consumer.raven.captureException',
+                            lambda **kwargs: captured.append(kwargs))
+
+        async def commit_message(value, *args, **kwargs):
+            raise ValueError(value)
+
+        consumer.commit_message = commit_message
+        FakeKafkaConsumer.batches = [
+            {0: [make_record(0, 0, {}), make_record(0, 1, {})]},
+        ]
+
+        event_loop.run_until_complete(consumer.start())
+        assert len(captured) == 2
+        assert consumer.stats()['errors'] == 2
+
+    def test_failed_records_are_dead_lettered(self, consumer, event_loop,
+                                              tmpdir):
+        path = str(tmpdir.join('dead.jsonl'))
+        consumer.dead_letters = FileDeadLetters(path)
+        FakeKafkaConsumer.batches = [
+            {0: [Record('logs', 0, 7, b'{"broken', None, (), -1)]},
+        ]
+
+        event_loop.run_until_complete(consumer.start())
+
+        with open(path) as f:
+            letter = json.loads(f.readline())
+        assert (letter['partition'], letter['offset']) == (0, 7)
+        assert consumer.offsets.committed == {0: 8}
+        assert consumer.stats()['errors'] == 1
+
+    def test_batched_commit(self, consumer, session, event_loop,
+                            monkeypatch):
+        consumer.descriptors.add(DescriptorModel(id='hello'))
+        consumer.writer = BatchWriter(session, max_messages=2)
+
+        for id_ in ('1', '2'):
+            raw = json.dumps({'type_id': 'hello', 'data': {'id': id_}})
+            event_loop.run_until_complete(
+                consumer.commit_message(raw.encode()))
+
+        event_loop.run_until_complete(consumer.writer.drain())
+        assert [parameters['0'] for _, parameters in session.executed] == \
+            ['1', '2']
+
+    def test_backpressure_pauses_fetching(self, consumer, event_loop):
+        kafka = FakeKafkaConsumer()
+        consumer.writer.max_in_flight = 1
+        release = asyncio.Event()
+
+        async def consume():
+            await consumer.writer.dispatch(('hello', ('1',)), [])
+            assert consumer.writer.full
+            waiting = asyncio.ensure_future(consumer.wait_for_writes(kafka))
+            await asyncio.sleep(0)
+            assert kafka.paused == {0, 1}
+            release.set()
+            await waiting
+
+        async def write(statements, previous=None, acks=(), type_id=None):
+            await release.wait()
+
+        consumer.writer.write = write
+        event_loop.run_until_complete(consume())
+        assert kafka.paused == set()
+
+    def test_schema_fitting_objects_are_written(self, consumer, session,
+                                                event_loop, monkeypatch):
+        descriptor = DescriptorModel(id='hello')
+        inferred = []
+        monkeypatch.setattr(descriptor, 'infer_schema_change',
+                            inferred.append)
+        consumer.descriptors.add(descriptor)
+
+        raw = json.dumps({'type_id': 'hello', 'data': {'id': '1'}})
+        event_loop.run_until_complete(consumer.commit_message(raw.encode()))
+
+        assert inferred == []
+        assert consumer.schema_changes.size == 0
+        assert session.executed[0][0].startswith('INSERT INTO test.hello')
+
+    def test_stage_metrics(self, consumer, session, event_loop):
+        consumer.descriptors.add(DescriptorModel(id='hello'))
+        consumer.metrics.shape_sample_interval = 1
+
+        raw = json.dumps({'type_id': 'hello', 'data': {'id': '1'}})
+        event_loop.run_until_complete(consumer.commit_message(raw.encode()))
+
+        stages = consumer.metrics.stages
+        for stage in ('decode', 'descriptor', 'bind', 'deserialize',
+                      'flatten', 'model'):
+            assert stages[stage].count == 1
+        assert consumer.metrics.types['hello'] == {'events': 1,
+                                                   'bytes': len(raw)}
+        assert len(consumer.metrics.shapes['hello']) == 1
+
+    def test_partition_lag(self, consumer, event_loop, monkeypatch):
+        monkeypatch.setattr(FakeKafkaConsumer, 'highwaters', {0: 10})
+
+        async def commit_message(value, *args, ack=None, **kwargs):
+            ack()
+
+        consumer.commit_message = commit_message
+        FakeKafkaConsumer.batches = [
+            {0: [make_record(0, 0, {}), make_record(0, 1, {})]},
+        ]
+
+        event_loop.run_until_complete(consumer.start())
+        assert consumer.metrics.lags == {0: 8}
+        assert 'moisturizer_partition_lag{partition="0"} 8' in \
+            consumer.render_metrics()
+
+    def test_commits_are_profiled_on_demand(self, consumer, event_loop,
+                                            session):
+        assert consumer.profiler is None
+        assert consumer.commit_record.__func__ is \
+            MoisturizerKafkaConsumer.commit_record
+
+        profiled = MoisturizerKafkaConsumer(
+            cluster='localhost:9092', topics=['logs'], group='moisturizer',
+            event_loop=event_loop, session=session,
+            settings={'profiling.slow_event_ms': 0.001})
+        profiled.descriptors.add(DescriptorModel(id='hello'))
+
+        raw = json.dumps({'type_id': 'hello', 'data': {'id': '1'}})
+        event_loop.run_until_complete(profiled.commit_record(raw.encode()))
+
+        event, = profiled.profiler.slow_events
+        assert event['type_id'] == 'hello'
+        assert 'flatten' in event['stages_ms']
+        assert profiled.stats()['slow_events'] == 1
+
+    def test_offloaded_commits_are_profiled(self, event_loop, session):
+        profiled = MoisturizerKafkaConsumer(
+            cluster='localhost:9092', topics=['logs'], group='moisturizer',
+            event_loop=event_loop, session=session,
+            settings={'profiling.slow_event_ms': 0.001,
+                      'executor.workers': 2})
+        profiled.kafka_consumer_class = FakeKafkaConsumer
+        profiled.pool_class = ThreadPoolExecutor
+        FakeKafkaConsumer.owner = profiled
+        profiled.descriptors.add(DescriptorModel(id='hello'))
+
+        FakeKafkaConsumer.batches = [
+            {0: [make_record(0, 0, {'type_id': 'hello',
+                                    'data': {'id': '1'}})]},
+        ]
+        event_loop.run_until_complete(profiled.start())
+
+        event, = profiled.profiler.slow_events
+        assert event['type_id'] == 'hello'
+        assert profiled.stats()['slow_events'] == 1
+
+    def test_new_types_are_created_once(self, consumer, session, event_loop):
+        async def lookup():
+            return await asyncio.gather(*[consumer.get_descriptor('new_type')
+                                          for _ in range(3)])
+
+        first, second, third = event_loop.run_until_complete(lookup())
+        assert first is second is third
+        assert consumer.descriptors.descriptors == {'new_type': first}
+
+        creates = [q for q, _ in session.executed
+                   if q.startswith('CREATE TABLE')]
+        assert creates == [
+            'CREATE TABLE test.new_type ("id" text , '
+            '"last_modified" timestamp , PRIMARY KEY (("id")))'
+        ]
+        inserts = [q for q, _ in session.executed
+                   if q.startswith('INSERT INTO test.descriptor_model')]
+        assert len(inserts) == 1
+        assert inserts[0].endswith('IF NOT EXISTS')
+
+    def test_new_columns_do_not_block_known_shapes(self, consumer, session,
+                                                   event_loop, monkeypatch):
+        consumer.descriptors.add(DescriptorModel(id='hello'))
+        session.gate.clear()
+
+        async def commit(**data):
+            raw = json.dumps({'type_id': 'hello', 'data': data})
+            await consumer.commit_message(raw.encode())
+
+        async def consume():
+            await commit(id='1', foo='bar')
+            await commit(id='2')
+            await asyncio.sleep(0.01)
+
+            started = [q for q, _ in session.started]
+            assert started[0].startswith('ALTER TABLE test.hello ADD "foo"')
+            assert started[1].startswith('INSERT INTO test.hello')
+            assert consumer.schema_changes.size == 0
+
+            session.gate.set()
+            await consumer.schema_changes.drain()
+            await consumer.writer.drain()
+
+        event_loop.run_until_complete(consume())
+
+        inserts = [p['0'] for q, p in session.executed
+                   if q.startswith('INSERT INTO test.hello')]
+        assert inserts == ['2', '1']
+
+    def test_record_type_sources(self, consumer):
+        record = make_record(0, 0, {}, key=b'hello',
+                             headers=[('Type-Id', b'world')])
+        assert consumer.record_type(record) is None
+
+        consumer.settings['kafka.type_source'] = 'key'
+        assert consumer.record_type(record) == 'hello'
+
+        consumer.settings['kafka.type_source'] = 'header'
+        assert consumer.record_type(record) == 'world'
+
+    def test_undecodable_keys_do_not_stop_consuming(self, consumer,
+                                                    event_loop):
+        consumer.settings['kafka.type_source'] = 'key'
+        FakeKafkaConsumer.batches = [
+            {0: [make_record(0, 3, {}, key=b'\xff\xfe')]},
+        ]
+
+        kafka = consumer.create_kafka_consumer()
+        consumer.create_kafka_consumer = lambda: kafka
+        event_loop.run_until_complete(consumer.start())
+
+        assert kafka.commits == [{0: 4}]
+
+    def test_routed_records_skip_envelope(self, consumer, session,
+                                          event_loop):
+        consumer.settings['kafka.type_source'] = 'key'
+        consumer.descriptors.add(DescriptorModel(id='hello'))
+        envelope = {'type_id': 'hello', 'data': {'id': '2'}}
+        FakeKafkaConsumer.batches = [
+            {0: [make_record(0, 0, {'id': '1'}, key=b'hello'),
+                 make_record(0, 1, envelope)]},
+        ]
+
+        event_loop.run_until_complete(consumer.start())
+        assert [p['0'] for q, p in session.executed
+                if q.startswith('INSERT INTO test.hello')] == ['1', '2']
+
+    def test_blocked_types_are_not_decoded(self, consumer, event_loop,
+                                           monkeypatch):
+        consumer.settings['kafka.type_source'] = 'key'
+        consumer.blocked_types = {'spam'}
+        decoded = []
+        monkeypatch.setattr(consumer, 'unwrap_message', decoded.append)
+        FakeKafkaConsumer.batches = [
+            {0: [make_record(0, 0, {}, key=b'spam')]},
+        ]
+
+        event_loop.run_until_complete(consumer.start())
+        assert decoded == []
+        assert consumer.dropped == {'spam': 1}
+
+    def test_unknown_types_can_be_dropped(self, event_loop, session):
+        consumer = MoisturizerKafkaConsumer(
+            cluster='localhost:9092',
+            topics=['logs'],
+            group='moisturizer',
+            event_loop=event_loop,
+            settings={'kafka.unknown_types': 'drop'},
+            session=session,
+        )
+
+        async def commit():
+            for _ in range(2):
+                await consumer.commit_message(b'{}', type_id='new_type')
+
+        event_loop.run_until_complete(commit())
+        assert consumer.dropped == {'new_type': 2}
+        selects = [q for q, _ in session.executed if q.startswith('SELECT')]
+        assert len(selects) == 1
+        assert not any(q.startswith('CREATE') for q, _ in session.executed)
+
+    def test_unknown_routed_types_are_not_decoded(self, event_loop, session,
+                                                  monkeypatch):
+        consumer = MoisturizerKafkaConsumer(
+            cluster='localhost:9092',
+            topics=['logs'],
+            group='moisturizer',
+            event_loop=event_loop,
+            settings={'kafka.unknown_types': 'drop',
+                      'kafka.type_source': 'key'},
+            session=session,
+        )
+        consumer.kafka_consumer_class = FakeKafkaConsumer
+        FakeKafkaConsumer.owner = consumer
+        decoded = []
+        monkeypatch.setattr(consumer, 'unwrap_message',
+                            lambda *args: decoded.append(args))
+        FakeKafkaConsumer.batches = [
+            {0: [make_record(0, n, {}, key=b'new_type') for n in range(2)]},
+        ]
+
+        event_loop.run_until_complete(consumer.start())
+
+        assert decoded == []
+        assert consumer.dropped == {'new_type': 2}
+        assert consumer.offsets.committed == {0: 2}
+
+    def test_routed_descriptors_are_prefetched(self, consumer, event_loop):
+        consumer.settings['kafka.type_source'] = 'key'
+        loaded = []
+
+        async def get_descriptor(type_id):
+            loaded.append(type_id)
+
+        consumer.get_descriptor = get_descriptor
+        event_loop.run_until_complete(consumer.consume_batch({
+            0: [make_record(0, 0, {}, key=b'a'),
+                make_record(0, 1, {}, key=b'b')],
+            1: [make_record(1, 0, {}, key=b'a')],
+        }))
+        assert sorted(loaded[:2]) == ['a', 'b']
+
+    def test_offloaded_partitions_are_committed_in_order(self, consumer,
+                                                         session, event_loop):
+        descriptor = DescriptorModel(id='hello')
+        descriptor.properties['foo'] = DescriptorFieldType(type='integer')
+        consumer.descriptors.add(descriptor)
+        consumer.settings['executor.workers'] = 2
+        consumer.pool_class = ThreadPoolExecutor
+
+        def record(partition, offset, **data):
+            return make_record(partition, offset,
+                               {'type_id': 'hello', 'data': data})
+
+        FakeKafkaConsumer.batches = [
+            {0: [record(0, n, id='a', foo=n) for n in range(3)],
+             1: [record(1, 0, id='b', bar='x')]},
+        ]
+
+        event_loop.run_until_complete(consumer.start())
+
+        inserts = [p for q, p in session.executed
+                   if q.startswith('INSERT INTO test.hello')]
+        assert [p['2'] for p in inserts if p['0'] == 'a'] == [0, 1, 2]
+        assert 'bar' in descriptor.properties
+        assert consumer.pool is None
+
+    def test_offsets_are_committed_after_writes(self, consumer, session,
+                                                event_loop):
+        consumer.descriptors.add(DescriptorModel(id='hello'))
+        envelope = {'type_id': 'hello', 'data': {'id': '1'}}
+        FakeKafkaConsumer.batches = [
+            {0: [make_record(0, 5, envelope), make_record(0, 6, {})]},
+        ]
+
+        kafka = consumer.create_kafka_consumer()
+        consumer.create_kafka_consumer = lambda: kafka
+        event_loop.run_until_complete(consumer.start())
+
+        # The invalid record is skipped, not retried.
+        assert kafka.commits == [{0: 7}]
+
+    def test_failed_writes_are_retried_then_dead_lettered(
+            self, session, event_loop, tmpdir):
+        path = str(tmpdir.join('dead.jsonl'))
+        consumer = MoisturizerKafkaConsumer(
+            cluster='localhost:9092',
+            topics=['logs'],
+            group='moisturizer',
+            event_loop=event_loop,
+            settings={'errors.dead_letter': 'file',
+                      'errors.dead_letter_path': path,
+                      'cassandra.retry_delay_ms': 0},
+            session=session,
+        )
+        consumer.kafka_consumer_class = FakeKafkaConsumer
+        FakeKafkaConsumer.owner = consumer
+        consumer.descriptors.add(DescriptorModel(id='hello'))
+        attempts = []
+
+        async def execute_future(query, parameters=None):
+            if parameters and parameters.get('0') == '2':
+                attempts.append(query)
+                raise RuntimeError('timeout')
+
+        session.execute_future = execute_future
+        FakeKafkaConsumer.batches = [
+            {0: [make_record(0, n, {'type_id': 'hello',
+                                    'data': {'id': str(n)}})
+                 for n in range(4)]},
+        ]
+
+        kafka = consumer.create_kafka_consumer()
+        consumer.create_kafka_consumer = lambda: kafka
+        event_loop.run_until_complete(consumer.start())
+
+        with open(path) as f:
+            letter = json.loads(f.readline())
+        assert (letter['partition'], letter['offset']) == (0, 2)
+        assert len(attempts) == 4
+        assert kafka.commits == [{0: 4}]
+        assert consumer.offsets.unacked == 0
+        assert consumer.metrics.types['hello']['errors'] == 1
+
+    def test_failed_writes_are_not_committed(self, consumer, session,
+                                             event_loop):
+        consumer.writer.retry_delay_ms = 0
+        consumer.descriptors.add(DescriptorModel(id='hello'))
+        attempts = []
+
+        async def execute_future(query, parameters=None):
+            if parameters and parameters.get('0') == '2':
+                attempts.append(query)
+                await asyncio.sleep(0.001)
+                raise RuntimeError('timeout')
+
+        session.execute_future = execute_future
+        FakeKafkaConsumer.batches = [
+            {0: [make_record(0, n, {'type_id': 'hello',
+                                    'data': {'id': str(n)}})
+                 for n in range(4)]},
+        ]
+
+        kafka = consumer.create_kafka_consumer()
+        consumer.create_kafka_consumer = lambda: kafka
+
+        async def consume():
+            try:
+                await asyncio.wait_for(consumer.start(), 0.2)
+            except asyncio.TimeoutError:
+                pass
+            for task in consumer.writer.in_flight:
+                task.cancel()
+            await consumer.writer.drain()
+
+        event_loop.run_until_complete(consume())
+
+        assert len(attempts) > consumer.settings['cassandra.max_retries'] + 1
+        assert consumer.offsets.committable() == {0: 2}
+        assert consumer.offsets.unacked == 2
+        assert kafka.commits == []
+
+    def test_saturated_partitions_are_paused(self, consumer):
+        kafka = FakeKafkaConsumer()
+        consumer.offsets.max_unacked = 2
+        consumer.offsets.track(0, 0)
+        consumer.offsets.track(0, 1)
+        consumer.offsets.track(1, 0)
+
+        paused = consumer.pause_saturated(kafka, set())
+        assert paused == kafka.paused == {0}
+
+        consumer.offsets.ack(0, 0)
+        paused = consumer.pause_saturated(kafka, paused)
+        assert paused == kafka.paused == set()
+
+    def test_invalid_objects_do_not_fail_their_batch(self, consumer, session,
+                                                     event_loop):
+        descriptor = DescriptorModel(id='hello')
+        descriptor.properties['foo__bar'] = DescriptorFieldType(
+            type='string')
+        consumer.descriptors.add(descriptor)
+        consumer.writer = BatchWriter(session, max_messages=10,
+                                      on_error=consumer.report_error)
+
+        FakeKafkaConsumer.batches = [
+            {0: [make_record(0, n, {'type_id': 'hello',
+                                    'data': {'id': str(n), 'foo': {
+                                        'bar': 1 if n == 3 else 'a'}}})
+                 for n in range(6)]},
+        ]
+        event_loop.run_until_complete(consumer.start())
+
+        ids = sorted(p['0'] for q, p in session.executed
+                     if q.startswith('INSERT INTO test.hello'))
+        assert ids == ['0', '1', '2', '4', '5']
+        assert consumer.offsets.unacked == 0
+        assert consumer.stats()['errors'] == 1
+
+    def test_revoked_partitions_are_committed(self, consumer, event_loop):
+        kafka = consumer.create_kafka_consumer()
+        consumer.offsets.track(0, 0)
+        consumer.offsets.track(1, 0)
+        consumer.offsets.ack(0, 0)
+        consumer.offsets.ack(1, 0)
+
+        event_loop.run_until_complete(
+            kafka.listener.on_partitions_revoked({0}))
+
+        assert kafka.commits == [{0: 1}]
+        assert consumer.offsets.committable() == {1: 1}
+
+    def test_ids_derived_from_records(self, consumer, session, event_loop):
+        consumer.descriptors.add(DescriptorModel(id='hello'))
+        consumer.id_strategy = 'offset'
+
+        def consume():
+            FakeKafkaConsumer.batches = [
+                {0: [make_record(0, 7, {'type_id': 'hello', 'data': {}}),
+                     make_record(0, 8, {'type_id': 'hello',
+                                        'data': {'id': 'given'}})]},
+            ]
+            event_loop.run_until_complete(consumer.start())
+
+        consume()
+        consume()
+
+        ids = [p['0'] for q, p in session.executed
+               if q.startswith('INSERT INTO test.hello')]
+        assert ids[:2] == ids[2:]
+        assert ids[0] == record_id('logs', 0, 7)
+        assert ids[1] == 'given'
+
+    def test_event_timed_writes(self, consumer, session, event_loop):
+        consumer.descriptors.add(DescriptorModel(id='hello'))
+        consumer.timestamp_source = 'event'
+
+        def record(offset, **data):
+            return make_record(0, offset, {'type_id': 'hello', 'data': data},
+                               timestamp=1500000000000)
+
+        FakeKafkaConsumer.batches = [
+            {0: [record(0, id='1', last_modified='2017-07-14T02:40:00Z'),
+                 record(1, id='1')]},
+        ]
+        event_loop.run_until_complete(consumer.start())
+
+        inserts = [q for q, _ in session.executed
+                   if q.startswith('INSERT INTO test.hello')]
+        assert inserts[0].endswith('USING TIMESTAMP 1500000000000000')
+        assert inserts[1].endswith('USING TIMESTAMP 1500000000000000')
+
+    def test_write_timestamps_are_optional(self, consumer):
+        assert consumer.write_timestamp({'last_modified': 1}, 2) is None
+
+        consumer.timestamp_source = 'event'
+        assert consumer.write_timestamp({'last_modified': 1}, 2) == 1000000
+        assert consumer.write_timestamp({}, 2) == 2000
+        assert consumer.write_timestamp({}, -1) is None
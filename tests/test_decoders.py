@@ -0,0 +1,46 @@
+import json
+
+import msgpack
+import pytest
+
+from moisturizer.decoders import DecoderRegistry, decoders
+
+
+PAYLOAD = {'type_id': 'hello', 'data': {'foo': 'bar', 'n': [1, 2]}}
+
+
+class TestDecoderRegistry(object):
+
+    def test_detect_by_leading_byte(self):
+        assert decoders.detect(json.dumps(PAYLOAD).encode()) == 'json'
+        assert decoders.detect(b'\n  [1]') == 'json'
+        assert decoders.detect(msgpack.packb(PAYLOAD)) == 'msgpack'
+        assert decoders.detect(b'42') is None
+        assert decoders.detect(b'') is None
+
+    def test_detect_by_content_type(self):
+        value = msgpack.packb(PAYLOAD)
+        assert decoders.detect(value, 'application/json') == 'json'
+        assert decoders.detect(value, 'Application/X-MsgPack') == 'msgpack'
+        assert decoders.detect(value, 'text/plain') == 'msgpack'
+
+    def test_decode_json(self):
+        assert decoders.decode(json.dumps(PAYLOAD).encode()) == PAYLOAD
+
+    def test_decode_msgpack_buffers(self):
+        value = msgpack.packb(PAYLOAD, use_bin_type=True)
+        assert decoders.decode(value) == PAYLOAD
+        assert decoders.decode(memoryview(value)) == PAYLOAD
+        assert decoders.decode(memoryview(b' {"a": 1}')) == {'a': 1}
+
+    def test_undetected_formats_are_tried_in_order(self):
+        assert decoders.decode(b'42') == 42
+
+        with pytest.raises(ValueError):
+            decoders.decode(b'\xc1')
+
+    def test_custom_decoders(self):
+        registry = DecoderRegistry()
+        registry.register('csv', lambda value: value.split(b','),
+                          content_types=('text/csv',))
+        assert registry.decode(b'a,b', 'text/csv') == [b'a', b'b']
@@ -0,0 +1,78 @@
+import pytest
+
+from moisturizer.descriptors import DescriptorRegistry
+from moisturizer.migrations import SchemaMigrator
+from moisturizer.models import DescriptorModel, DescriptorFieldType
+
+
+@pytest.fixture()
+def registry(session):
+    return DescriptorRegistry(SchemaMigrator(session))
+
+
+def stored_descriptor(version, **properties):
+    return {
+        'id': 'hello',
+        'version': version,
+        'properties': {name: DescriptorFieldType(type=type_)
+                       for name, type_ in properties.items()},
+    }
+
+
+class TestDescriptorRegistry(object):
+
+    def test_lost_creation_uses_stored_descriptor(self, registry, session,
+                                                  event_loop):
+        loads = iter([[], [stored_descriptor(1, foo='string')]])
+
+        def respond(query, parameters):
+            if query.startswith('SELECT'):
+                return next(loads)
+            if query.startswith('INSERT'):
+                return [{'[applied]': False}]
+            return []
+
+        session.respond = respond
+        descriptor = event_loop.run_until_complete(registry.get('hello'))
+
+        assert descriptor.version == 1
+        assert 'foo' in descriptor.properties
+        assert 'hello' in registry
+
+    def test_poll_refreshes_outdated_descriptors(self, registry, session,
+                                                 event_loop):
+        descriptor = DescriptorModel(id='hello')
+        registry.add(descriptor)
+
+        def respond(query, parameters):
+            if query.startswith('SELECT "id", "version"'):
+                return [{'id': 'hello', 'version': 2},
+                        {'id': 'other', 'version': 5}]
+            return [stored_descriptor(2, foo='string')]
+
+        session.respond = respond
+        event_loop.run_until_complete(registry.poll())
+
+        assert descriptor.version == 2
+        assert 'foo' in descriptor.properties
+        assert registry.refreshes == 1
+
+        event_loop.run_until_complete(registry.poll())
+        assert registry.refreshes == 1
+
+    def test_legacy_descriptors_are_not_refreshed(self, registry, session,
+                                                  event_loop):
+        stored = stored_descriptor(None, foo='string')
+
+        def respond(query, parameters):
+            if query.endswith('IF "version" = null'):
+                stored['version'] = 0
+                return [{'[applied]': True}]
+            return [dict(stored)]
+
+        session.respond = respond
+        descriptor = event_loop.run_until_complete(registry.get('hello'))
+        event_loop.run_until_complete(registry.poll())
+
+        assert descriptor.version == 0
+        assert registry.refreshes == 0
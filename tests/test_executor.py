@@ -0,0 +1,71 @@
+import json
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from moisturizer.executor import DescriptorSnapshot, prepare_records
+from moisturizer.models import DescriptorModel, DescriptorFieldType
+
+
+@pytest.fixture()
+def descriptor():
+    descriptor = DescriptorModel(id='hello')
+    descriptor.properties['foo'] = DescriptorFieldType(type='integer')
+    return descriptor
+
+
+def envelope(type_id, **data):
+    return json.dumps({'type_id': type_id, 'data': data}).encode()
+
+
+class TestPrepareRecords(object):
+
+    def test_records_are_prepared_in_order(self, descriptor):
+        snapshot = DescriptorSnapshot([descriptor])
+        records = [
+            (envelope('hello', id=1, foo='42'), None, None, None),
+            (envelope('other', id=2), None, None, None),
+            (b'{"foo": 1, "bar": {"baz": true}}', None, 'hello', None),
+            (b'not json', None, None, None),
+        ]
+
+        results = pickle.loads(prepare_records(records, snapshot.data))
+        assert results == [
+            ('hello', {'id': '1', 'foo': 42}, False),
+            None,
+            ('hello', {'foo': 1, 'bar__baz': True}, True),
+            None,
+        ]
+
+    def test_snapshots_track_revisions(self, descriptor):
+        key = DescriptorSnapshot.key([descriptor])
+        descriptor.properties['bar'] = DescriptorFieldType(type='string')
+        assert DescriptorSnapshot.key([descriptor]) != key
+
+        snapshot = DescriptorSnapshot([descriptor])
+        records = [(envelope('hello', bar='x'), None, None, None)]
+        results = pickle.loads(prepare_records(records, snapshot.data))
+        assert results == [('hello', {'bar': 'x'}, False)]
+
+    def test_process_pool(self, descriptor):
+        snapshot = DescriptorSnapshot([descriptor])
+        records = [(envelope('hello', id=1, foo=2), None, None, None)]
+
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            prepared = pool.submit(prepare_records, records,
+                                   snapshot.data).result()
+        assert pickle.loads(prepared) == [('hello', {'id': '1', 'foo': 2},
+                                           False)]
+
+    def test_objects_get_ids(self, descriptor):
+        snapshot = DescriptorSnapshot([descriptor])
+        records = [
+            (envelope('hello', event_id=42), None, None, 'derived'),
+            (envelope('hello'), None, None, 'derived'),
+        ]
+
+        results = pickle.loads(prepare_records(records, snapshot.data,
+                                               id_field='event_id'))
+        assert [flatten['id'] for _, flatten, _ in results] == \
+            ['42', 'derived']
@@ -0,0 +1,149 @@
+import gzip
+import json
+import struct
+
+import msgpack
+import pytest
+
+from moisturizer.consumer import MoisturizerKafkaConsumer
+from moisturizer.importer import (
+    Importer,
+    file_format,
+    read_values,
+    split_length_prefixed,
+    split_lines,
+)
+
+
+def length_prefixed(*values):
+    return b''.join(struct.pack('>I', len(value)) + value
+                    for value in values)
+
+
+def event(n):
+    return {'type_id': 'hello', 'data': {'id': str(n), 'n': n}}
+
+
+@pytest.fixture()
+def importer(event_loop, session):
+    consumer = MoisturizerKafkaConsumer(
+        cluster='localhost:9092',
+        topics=['logs'],
+        group='moisturizer',
+        event_loop=event_loop,
+        session=session,
+    )
+    return Importer(consumer, chunk_size=2)
+
+
+class TestReaders(object):
+
+    def test_file_format(self):
+        assert file_format('events.jsonl') == 'jsonl'
+        assert file_format('events.msgpack.gz') == 'msgpack'
+        with pytest.raises(ValueError):
+            file_format('events.csv')
+
+    def test_split_lines(self):
+        buffer = b'{"a": 1}\n\n  \n{"b": 2}\r\n{"c": 3}'
+        assert list(split_lines(buffer)) == [b'{"a": 1}', b'{"b": 2}',
+                                             b'{"c": 3}']
+
+    def test_split_length_prefixed(self):
+        buffer = length_prefixed(b'first', b'', b'second')
+        assert list(split_length_prefixed(buffer)) == [b'first', b'',
+                                                       b'second']
+
+        with pytest.raises(ValueError):
+            list(split_length_prefixed(buffer[:-1]))
+
+    def test_read_values(self, tmpdir):
+        lines = tmpdir.join('events.jsonl')
+        lines.write_binary(b'{"a": 1}\n{"b": 2}\n')
+        packed = tmpdir.join('events.msgpack.gz')
+        with gzip.open(str(packed), 'wb') as f:
+            f.write(length_prefixed(b'\x80', b'\x81\xa1a\x01'))
+        empty = tmpdir.join('empty.jsonl')
+        empty.write_binary(b'')
+
+        assert list(read_values(str(lines))) == [b'{"a": 1}', b'{"b": 2}']
+        assert list(read_values(str(packed))) == [b'\x80', b'\x81\xa1a\x01']
+        assert list(read_values(str(empty))) == []
+
+
+class TestImporter(object):
+
+    def test_files_are_written(self, importer, session, event_loop, tmpdir):
+        lines = tmpdir.join('events.jsonl.gz')
+        with gzip.open(str(lines), 'wb') as f:
+            for n in range(3):
+                f.write(json.dumps(event(n)).encode() + b'\n')
+            f.write(b'{"broken\n')
+        packed = tmpdir.join('events.msgpack')
+        packed.write_binary(length_prefixed(*[
+            msgpack.packb(event(n), use_bin_type=True) for n in range(3, 5)
+        ]))
+
+        event_loop.run_until_complete(importer.run([str(lines),
+                                                    str(packed)]))
+
+        inserted = [parameters for query, parameters in session.executed
+                    if query.startswith('INSERT INTO test.hello')]
+        assert len(inserted) == 5
+
+        stats = importer.stats()
+        assert stats['read'] == 6
+        assert stats['errors'] == 1
+        assert stats['unacked'] == 0
+
+    def test_corrupt_files_are_skipped(self, importer, session, event_loop,
+                                       tmpdir):
+        corrupt = tmpdir.join('corrupt.msgpack')
+        corrupt.write_binary(b'\x00\x00\x00\x10\x80')
+        lines = tmpdir.join('events.jsonl')
+        lines.write_binary(json.dumps(event(0)).encode())
+
+        event_loop.run_until_complete(importer.run([str(corrupt),
+                                                    str(lines)]))
+
+        assert importer.stats()['errors'] == 1
+        assert any(query.startswith('INSERT INTO test.hello')
+                   for query, _ in session.executed)
+
+    def test_broken_gzip_files_are_skipped(self, importer, session,
+                                           event_loop, tmpdir):
+        compressed = gzip.compress(b''.join(
+            json.dumps(event(n)).encode() + b'\n' for n in range(100)))
+        truncated = tmpdir.join('truncated.jsonl.gz')
+        truncated.write_binary(compressed[:-20])
+        corrupt = tmpdir.join('corrupt.jsonl.gz')
+        corrupt.write_binary(compressed[:10] + b'garbage' * 10)
+        lines = tmpdir.join('events.jsonl')
+        lines.write_binary(json.dumps(event(0)).encode())
+
+        event_loop.run_until_complete(importer.run([
+            str(truncated), str(corrupt), str(lines)]))
+
+        assert importer.stats()['errors'] == 2
+        assert any(parameters['0'] == '0' for query, parameters
+                   in session.executed
+                   if query.startswith('INSERT INTO test.hello'))
+
+    def test_unwritten_records_are_bounded(self, importer, event_loop,
+                                           tmpdir):
+        consumer = importer.consumer
+        consumer.offsets.max_unacked = 2
+        consume_partition = consumer.consume_partition
+        unacked = []
+
+        async def counting(partition, records):
+            unacked.append(consumer.offsets.unacked)
+            await consume_partition(partition, records)
+
+        consumer.consume_partition = counting
+        lines = tmpdir.join('events.jsonl')
+        lines.write_binary(b'\n'.join(json.dumps(event(n)).encode()
+                                      for n in range(6)))
+
+        event_loop.run_until_complete(importer.run([str(lines)]))
+        assert unacked == [0, 0, 0]
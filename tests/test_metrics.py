@@ -0,0 +1,119 @@
+import asyncio
+import collections
+import time
+
+from moisturizer.metrics import (
+    Histogram,
+    Metrics,
+    MetricsServer,
+    render_prometheus,
+)
+
+
+TopicPartition = collections.namedtuple('TopicPartition',
+                                        ['topic', 'partition'])
+
+
+class TestHistogram(object):
+
+    def test_values_are_bucketed(self):
+        histogram = Histogram(buckets=(1, 10))
+        for value in (0.5, 1, 5, 50):
+            histogram.observe(value)
+
+        assert histogram.counts == [2, 1, 1]
+        assert list(histogram.cumulative()) == [(1, 2), (10, 3),
+                                                (float('inf'), 4)]
+        assert histogram.sum == 56.5
+
+    def test_quantiles(self):
+        histogram = Histogram(buckets=(1, 10))
+        assert histogram.quantile(0.5) == 0.0
+
+        for value in (0.5, 0.5, 0.5, 5):
+            histogram.observe(value)
+        assert histogram.quantile(0.5) == 1
+        assert histogram.quantile(0.99) == 10
+
+
+class TestMetrics(object):
+
+    def test_summary(self):
+        metrics = Metrics()
+        metrics.observe('decode', time.perf_counter())
+        metrics.count('hello', 'events')
+        metrics.count('hello', 'bytes', 42)
+        metrics.lag(0, 3)
+        metrics.lag(1, 4)
+
+        metrics.shape('hello', {'a': 1, 'b': 2}, new=True)
+        metrics.shape('hello', {'b': 3, 'a': 4}, new=True)
+        metrics.shape('hello', {'a': 5}, new=True)
+
+        summary = metrics.summary()
+        assert summary['stages']['decode']['count'] == 1
+        assert summary['types'] == {'hello': {'events': 1, 'bytes': 42}}
+        assert summary['shapes'] == {'hello': 2}
+        assert summary['lag'] == 7
+
+    def test_shapes_are_bounded(self):
+        metrics = Metrics(max_shapes=2)
+        for n in range(5):
+            metrics.shape('hello', {str(n): n}, new=True)
+        assert len(metrics.shapes['hello']) == 2
+
+    def test_shapes_are_sampled(self):
+        metrics = Metrics(shape_sample_interval=3)
+        for n in range(9):
+            metrics.shape('hello', {str(n): n})
+        assert len(metrics.shapes['hello']) == 3
+
+    def test_render_prometheus(self):
+        metrics = Metrics()
+        metrics.stages['decode'].observe(0.002)
+        metrics.count('hel"lo', 'events', 2)
+        metrics.shape('hel"lo', {'a': 1}, new=True)
+        metrics.lag(TopicPartition('logs', 1), 5)
+
+        text = render_prometheus(metrics, {'consumed': 2})
+        lines = text.splitlines()
+
+        assert 'moisturizer_stage_seconds_bucket{le="0.001",' \
+               'stage="decode"} 0' in lines
+        assert 'moisturizer_stage_seconds_bucket{le="0.0025",' \
+               'stage="decode"} 1' in lines
+        assert 'moisturizer_stage_seconds_bucket{le="+Inf",' \
+               'stage="decode"} 1' in lines
+        assert 'moisturizer_stage_seconds_count{stage="decode"} 1' in lines
+        assert 'moisturizer_type_events_total{type="hel\\"lo"} 2' in lines
+        assert 'moisturizer_type_shapes{type="hel\\"lo"} 1' in lines
+        assert 'moisturizer_partition_lag{partition="1",topic="logs"} 5' \
+            in lines
+        assert 'moisturizer_consumed 2' in lines
+
+
+class TestMetricsServer(object):
+
+    def test_scrape(self, event_loop):
+        server = MetricsServer(lambda: 'moisturizer_up 1\n',
+                               host='127.0.0.1', port=0)
+
+        async def get(path):
+            port = server.server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write('GET {} HTTP/1.1\r\nHost: x\r\n\r\n'.format(path)
+                         .encode())
+            response = await reader.read()
+            writer.close()
+            return response
+
+        event_loop.run_until_complete(server.start())
+        try:
+            metrics = event_loop.run_until_complete(get('/metrics'))
+            missing = event_loop.run_until_complete(get('/'))
+        finally:
+            event_loop.run_until_complete(server.stop())
+
+        assert metrics.startswith(b'HTTP/1.0 200 OK')
+        assert metrics.endswith(b'\r\n\r\nmoisturizer_up 1\n')
+        assert missing.startswith(b'HTTP/1.0 404')
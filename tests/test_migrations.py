@@ -0,0 +1,284 @@
+import asyncio
+
+import pytest
+from cassandra import InvalidRequest
+
+from moisturizer.migrations import SchemaMigrator, SchemaChangeWorker
+from moisturizer.models import DescriptorModel, DescriptorFieldType
+
+
+@pytest.fixture()
+def descriptor():
+    descriptor = DescriptorModel(id='hello')
+    descriptor.properties['foo'] = DescriptorFieldType(type='string')
+    return descriptor
+
+
+@pytest.fixture()
+def migrator(session):
+    return SchemaMigrator(session)
+
+
+class TestSchemaMigrator(object):
+
+    def test_create_statements(self, migrator, descriptor):
+        assert migrator.create_statements(descriptor.model) == [
+            'CREATE TABLE test.hello ("id" text , '
+            '"last_modified" timestamp , "foo" text , '
+            'PRIMARY KEY (("id")))',
+            'CREATE INDEX IF NOT EXISTS ON test.hello ("last_modified")',
+            'CREATE INDEX IF NOT EXISTS ON test.hello ("foo")',
+        ]
+
+    def test_alter_statements(self, migrator, descriptor):
+        statements = migrator.alter_statements(descriptor.model, {
+            'bar': DescriptorFieldType(type='integer', index=False),
+            'baz': DescriptorFieldType(type='string', format='date-time'),
+        })
+        assert statements == [
+            'ALTER TABLE test.hello ADD "bar" bigint ',
+            'ALTER TABLE test.hello ADD "baz" timestamp ',
+            'CREATE INDEX IF NOT EXISTS ON test.hello ("baz")',
+        ]
+
+    def test_migrate_adds_only_new_columns(self, migrator, descriptor,
+                                           session, event_loop):
+        new_fields = event_loop.run_until_complete(
+            migrator.migrate(descriptor, {'foo': 'a', 'bar': 42}))
+
+        assert list(new_fields) == ['bar']
+        assert descriptor.properties['bar'].type == 'integer'
+
+        queries = [query for query, _ in session.executed]
+        assert queries[:2] == [
+            'ALTER TABLE test.hello ADD "bar" bigint ',
+            'CREATE INDEX IF NOT EXISTS ON test.hello ("bar")',
+        ]
+        assert queries[2].startswith('UPDATE test.descriptor_model')
+        assert queries[2].endswith('IF "version" = %(4)s')
+        assert descriptor.version == 1
+
+    def test_migrate_without_changes(self, migrator, descriptor, session,
+                                     event_loop):
+        event_loop.run_until_complete(
+            migrator.migrate(descriptor, {'foo': 'a'}))
+        assert session.executed == []
+
+    def test_descriptor_is_updated_after_ddl(self, migrator, descriptor,
+                                             session, event_loop):
+        session.gate.clear()
+        migration = event_loop.create_task(
+            migrator.migrate(descriptor, {'bar': 42}))
+        event_loop.run_until_complete(asyncio.sleep(0.01))
+        assert 'bar' not in descriptor.properties
+
+        session.gate.set()
+        event_loop.run_until_complete(migration)
+        assert 'bar' in descriptor.properties
+
+    def test_existing_columns_are_tolerated(self, migrator, descriptor,
+                                            session, event_loop):
+        async def execute_future(query, parameters=None):
+            if query.query_string.startswith('ALTER'):
+                raise InvalidRequest('Invalid column name bar because it '
+                                     'conflicts with an existing column')
+            return [{'[applied]': True}]
+
+        session.execute_future = execute_future
+        event_loop.run_until_complete(
+            migrator.migrate(descriptor, {'bar': 42}))
+        assert 'bar' in descriptor.properties
+
+    def test_immutable_schema(self, session, descriptor, event_loop):
+        migrator = SchemaMigrator(session, enabled=False)
+        event_loop.run_until_complete(
+            migrator.migrate(descriptor, {'bar': 42}))
+
+        queries = [query for query, _ in session.executed]
+        assert len(queries) == 1
+        assert queries[0].startswith('UPDATE test.descriptor_model')
+
+    def test_version_conflicts_reload_descriptor(self, migrator, descriptor,
+                                                 session, event_loop):
+        stored = {
+            'id': 'hello',
+            'version': 1,
+            'properties': {
+                'foo': DescriptorFieldType(type='string'),
+                'bar': DescriptorFieldType(type='integer'),
+            },
+        }
+        applied = iter([False, True])
+
+        def respond(query, parameters):
+            if query.startswith('SELECT'):
+                return [stored]
+            if query.startswith('UPDATE'):
+                return [{'[applied]': next(applied)}]
+            return []
+
+        session.respond = respond
+        event_loop.run_until_complete(migrator.migrate(
+            descriptor, {'bar': 42, 'baz': 'a'}))
+
+        updates = [p for q, p in session.executed if q.startswith('UPDATE')]
+        assert len(updates) == 2
+        assert {updates[1]['1'], updates[1]['3']} == {'baz', 2}
+        assert set(descriptor.properties) >= {'foo', 'bar', 'baz'}
+        assert descriptor.version == 2
+
+    def test_legacy_descriptors_are_versioned(self, migrator, session,
+                                              event_loop):
+        stored = {
+            'id': 'hello',
+            'version': None,
+            'properties': {'foo': DescriptorFieldType(type='string')},
+        }
+
+        def respond(query, parameters):
+            if query.startswith('SELECT'):
+                return [dict(stored)]
+            if query.endswith('IF "version" = null'):
+                stored['version'] = 0
+            return [{'[applied]': True}]
+
+        session.respond = respond
+        descriptor = event_loop.run_until_complete(migrator.load('hello'))
+        assert descriptor.version == 0
+
+        event_loop.run_until_complete(migrator.migrate(descriptor,
+                                                       {'bar': 42}))
+        assert descriptor.version == 1
+        assert 'bar' in descriptor.properties
+
+    def test_refresh_reloads_changed_descriptor(self, migrator, descriptor,
+                                                session, event_loop):
+        session.respond = lambda query, parameters: [{
+            'id': 'hello',
+            'version': 3,
+            'properties': {'qux': DescriptorFieldType(type='boolean')},
+        }]
+        fingerprint = descriptor.fingerprint
+
+        event_loop.run_until_complete(migrator.refresh(descriptor))
+        assert descriptor.version == 3
+        assert 'qux' in descriptor.properties
+        assert descriptor.fingerprint != fingerprint
+
+
+@pytest.fixture()
+def released():
+    return []
+
+
+@pytest.fixture()
+def worker(migrator, released):
+    async def release(descriptor, object_, ack=None):
+        released.append(object_['n'])
+
+    return SchemaChangeWorker(migrator, release)
+
+
+def saved_descriptors(session):
+    return [query for query, _ in session.executed
+            if 'descriptor_model' in query]
+
+
+class TestSchemaChangeWorker(object):
+
+    def test_requests_are_coalesced(self, worker, descriptor, session,
+                                    released, event_loop):
+        async def park_all():
+            await worker.park(descriptor, {'x': DescriptorFieldType(
+                type='integer')}, {'n': 1, 'x': 1})
+            await worker.park(descriptor, {'y': DescriptorFieldType(
+                type='string')}, {'n': 2, 'y': 'a'})
+            assert worker.size == 2
+            await worker.drain()
+
+        event_loop.run_until_complete(park_all())
+
+        assert released == [1, 2]
+        assert len(saved_descriptors(session)) == 1
+        assert {'x', 'y'} <= set(descriptor.properties)
+        assert worker.size == 0
+        assert not worker.tasks
+
+    def test_requests_during_migration_run_next(self, worker, descriptor,
+                                                session, released,
+                                                event_loop):
+        session.gate.clear()
+
+        async def park_all():
+            await worker.park(descriptor, {'x': DescriptorFieldType(
+                type='integer')}, {'n': 1})
+            await asyncio.sleep(0.01)
+            await worker.park(descriptor, {'x': DescriptorFieldType(
+                type='integer')}, {'n': 2})
+            assert released == []
+            session.gate.set()
+            await worker.drain()
+
+        event_loop.run_until_complete(park_all())
+
+        assert released == [1, 2]
+        assert len(saved_descriptors(session)) == 1
+
+    def test_failed_migrations_reject_parked_objects(self, migrator,
+                                                     descriptor, released,
+                                                     event_loop):
+        errors = []
+        rejected = []
+        attempts = []
+
+        async def add_columns(descriptor, new_fields):
+            attempts.append(new_fields)
+            raise RuntimeError('timeout')
+
+        async def reject(descriptor, object_, exception, ack=None):
+            rejected.append((object_['n'], str(exception)))
+            ack()
+
+        migrator.add_columns = add_columns
+        worker = SchemaChangeWorker(migrator, released.append,
+                                    on_error=errors.append, reject=reject,
+                                    max_retries=2, retry_delay_ms=0)
+        acked = []
+
+        async def park():
+            await worker.park(descriptor, {'x': DescriptorFieldType(
+                type='integer')}, {'n': 1}, ack=lambda: acked.append(1))
+            await worker.drain()
+
+        event_loop.run_until_complete(park())
+        assert len(attempts) == 3
+        assert [str(e) for e in errors] == ['timeout']
+        assert rejected == [(1, 'timeout')]
+        assert acked == [1]
+        assert released == []
+
+    def test_failed_migrations_are_retried(self, migrator, descriptor,
+                                           session, released, event_loop):
+        add_columns = migrator.add_columns
+        failures = iter([RuntimeError('timeout')])
+
+        async def flaky_add_columns(descriptor, new_fields):
+            for failure in failures:
+                raise failure
+            return await add_columns(descriptor, new_fields)
+
+        migrator.add_columns = flaky_add_columns
+
+        async def release(descriptor, object_, ack=None):
+            released.append(object_['n'])
+
+        worker = SchemaChangeWorker(migrator, release, retry_delay_ms=0)
+
+        async def park():
+            await worker.park(descriptor, {'x': DescriptorFieldType(
+                type='integer')}, {'n': 1})
+            await worker.drain()
+
+        event_loop.run_until_complete(park())
+        assert released == [1]
+        assert 'x' in descriptor.properties
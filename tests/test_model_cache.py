@@ -0,0 +1,62 @@
+import pytest
+
+from moisturizer.models import (
+    DescriptorModel,
+    DescriptorFieldType,
+    ModelCache,
+    model_cache,
+)
+
+
+@pytest.fixture(autouse=True)
+def clean_model_cache():
+    model_cache.clear()
+    yield
+    model_cache.clear()
+
+
+@pytest.fixture()
+def descriptor():
+    descriptor = DescriptorModel(id='hello')
+    descriptor.properties['foo'] = DescriptorFieldType(type='string')
+    return descriptor
+
+
+class TestModelCache(object):
+
+    def test_model_is_built_once(self, descriptor):
+        assert descriptor.model is descriptor.model
+        assert model_cache.stats() == {
+            'size': 1,
+            'hits': 1,
+            'misses': 1,
+            'hit_rate': 0.5,
+        }
+
+    def test_model_is_shared_by_descriptor_instances(self, descriptor):
+        other = DescriptorModel(id='hello')
+        other.properties['foo'] = DescriptorFieldType(type='string')
+        assert descriptor.fingerprint == other.fingerprint
+        assert descriptor.model is other.model
+
+    def test_mutation_builds_new_revision(self, descriptor):
+        before = descriptor.model
+        descriptor.properties['bar'] = DescriptorFieldType(type='integer')
+
+        after = descriptor.model
+        assert after is not before
+        assert 'bar' in after._columns
+        assert 'bar' not in before._columns
+        assert model_cache.stats()['size'] == 1
+
+    def test_fingerprint_tracks_field_types(self, descriptor):
+        other = DescriptorModel(id='hello')
+        other.properties['foo'] = DescriptorFieldType(type='integer')
+        assert descriptor.fingerprint != other.fingerprint
+
+    def test_invalidate(self, descriptor):
+        cache = ModelCache()
+        model = cache.get(descriptor)
+        cache.invalidate('hello')
+        assert cache.get(descriptor) is not model
+        assert cache.hit_rate == 0.0
@@ -0,0 +1,62 @@
+from moisturizer.offsets import OffsetTracker
+
+
+class TestOffsetTracker(object):
+
+    def test_contiguous_acks_are_committable(self):
+        offsets = OffsetTracker()
+        for offset in range(10, 14):
+            offsets.track('p0', offset)
+
+        offsets.ack('p0', 11)
+        assert offsets.committable() == {}
+
+        offsets.ack('p0', 10)
+        assert offsets.committable() == {'p0': 12}
+
+        offsets.ack('p0', 13)
+        offsets.ack('p0', 12)
+        assert offsets.committable() == {'p0': 14}
+        assert offsets.unacked == 0
+
+    def test_committed_positions_are_skipped(self):
+        offsets = OffsetTracker(commit_interval_ms=0)
+        offsets.track('p0', 0)
+        offsets.track('p1', 0)
+        offsets.ack('p0', 0)
+        assert offsets.due
+
+        offsets.mark_committed(offsets.committable())
+        assert offsets.committable() == {}
+        assert not offsets.due
+
+        offsets.ack('p1', 0)
+        assert offsets.committable(['p0', 'p1']) == {'p1': 1}
+
+    def test_commits_wait_for_interval(self):
+        offsets = OffsetTracker(commit_interval_ms=60000)
+        offsets.track('p0', 0)
+        offsets.ack('p0', 0)
+        assert not offsets.due
+
+    def test_revoked_partitions_are_forgotten(self):
+        offsets = OffsetTracker()
+        offsets.track('p0', 0)
+        offsets.forget(['p0'])
+        offsets.ack('p0', 0)
+        assert offsets.committable() == {}
+        assert offsets.unacked == 0
+
+    def test_partitions_are_saturated(self):
+        offsets = OffsetTracker(max_unacked=2)
+        offsets.track('p0', 0)
+        offsets.track('p0', 1)
+        offsets.track('p1', 0)
+        assert offsets.full('p0')
+        assert not offsets.full('p1')
+        assert offsets.saturated() == {'p0'}
+
+        offsets.ack('p0', 1)
+        assert offsets.saturated() == {'p0'}
+        offsets.ack('p0', 0)
+        assert offsets.saturated() == set()
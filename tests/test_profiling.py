@@ -0,0 +1,144 @@
+import asyncio
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+
+from moisturizer.profiling import (
+    MemoryTracer,
+    Profiler,
+    StackSampler,
+    collapse_stack,
+)
+
+
+def identify(message, content_type=None, type_id=None):
+    return 'hello', {}
+
+
+async def commit(message, content_type=None, type_id=None, row_id=None,
+                 ack=None, timings=None):
+    timings[message.decode()] = 0.001
+    await asyncio.sleep(0.01)
+    if ack is not None:
+        ack()
+
+
+class TestProfiler(object):
+
+    def test_slow_events_are_captured(self, event_loop):
+        profiler = Profiler(identify, slow_event_ms=1)
+
+        acked = []
+        profiled = profiler.wrap(commit)
+        event_loop.run_until_complete(profiled(b'{}', None, None, None,
+                                               ack=lambda: acked.append(1)))
+
+        event, = profiler.slow_events
+        assert acked == [1]
+        assert event['type_id'] == 'hello'
+        assert event['size'] == 2
+        assert event['elapsed_ms'] >= 1
+        assert event['stages_ms'] == {'{}': 1.0}
+        assert profiler.stats() == {'profiled_events': 0, 'slow_events': 1}
+
+    def test_slow_events_have_their_own_timings(self, event_loop):
+        profiler = Profiler(identify, slow_event_ms=1)
+        profiled = profiler.wrap(commit)
+
+        async def commit_both():
+            await asyncio.gather(profiled(b'a'), profiled(b'bb'))
+
+        event_loop.run_until_complete(commit_both())
+
+        stages = {event['size']: list(event['stages_ms'])
+                  for event in profiler.slow_events}
+        assert stages == {1: ['a'], 2: ['bb']}
+
+    def test_fast_events_are_not_captured(self, event_loop):
+        profiler = Profiler(identify, slow_event_ms=10000)
+        event_loop.run_until_complete(profiler.wrap(commit)(b'{}'))
+        assert profiler.slow_count == 0
+
+    def test_sampled_commits_are_profiled(self, event_loop, tmpdir):
+        profiler = Profiler(identify, sample_rate=1.0,
+                            engine='cprofile', output_dir=str(tmpdir))
+        profiler.start()
+        event_loop.run_until_complete(profiler.wrap(commit)(b'{}'))
+        profiler.stop()
+
+        assert profiler.sampled == 1
+        stats = pstats.Stats(profiler.path + '.pstats')
+        assert any(name == 'commit' for _, _, name in stats.stats)
+
+    def test_unsampled_profilers_dump_nothing(self, tmpdir):
+        profiler = Profiler(identify, sample_rate=0.5,
+                            output_dir=str(tmpdir))
+        profiler.start()
+        profiler.stop()
+        assert not os.path.exists(profiler.path + '.folded')
+
+
+class TestStackSampler(object):
+
+    def test_collapse_stack(self):
+        stack = collapse_stack(sys._getframe())
+        assert stack.endswith('test_profiling.py:test_collapse_stack')
+
+    def test_active_thread_is_sampled(self, tmpdir):
+        sampler = StackSampler(interval_ms=1)
+        sampler.start()
+        sampler.enter()
+
+        deadline = time.monotonic() + 5
+        while not sampler.stacks and time.monotonic() < deadline:
+            sum(range(1000))
+
+        sampler.exit()
+        sampler.stop()
+
+        path = str(tmpdir.join('profile'))
+        sampler.dump(path)
+        with open(path + '.folded') as f:
+            stack, count = f.readline().rsplit(' ', 1)
+        assert 'test_active_thread_is_sampled' in stack
+        assert int(count) >= 1
+
+    def test_only_sampled_tasks_are_sampled(self, event_loop):
+        sampler = StackSampler(interval_ms=1)
+        sampler.start()
+
+        async def sampled():
+            sampler.enter()
+            await asyncio.sleep(0.2)
+            sampler.exit()
+
+        async def busy():
+            deadline = time.monotonic() + 0.1
+            while time.monotonic() < deadline:
+                sum(range(1000))
+
+        async def run_both():
+            await asyncio.gather(sampled(), busy())
+
+        event_loop.run_until_complete(run_both())
+        sampler.stop()
+
+        assert not any('busy' in stack for stack in sampler.stacks)
+        assert not sampler.active
+
+
+class TestMemoryTracer(object):
+
+    def test_toggle_dumps_snapshots(self, tmpdir):
+        tracer = MemoryTracer(output_dir=str(tmpdir))
+
+        tracer.toggle()
+        assert tracemalloc.is_tracing()
+
+        tracer.toggle()
+        assert not tracemalloc.is_tracing()
+        snapshot, = tmpdir.listdir()
+        assert snapshot.basename.endswith('-1.snapshot')
+        assert tracemalloc.Snapshot.load(str(snapshot))
@@ -0,0 +1,133 @@
+import asyncio
+import base64
+import collections
+import json
+
+import pytest
+
+from moisturizer.reporting import (
+    ErrorReporter,
+    FileDeadLetters,
+    KafkaDeadLetters,
+    create_dead_letters,
+)
+
+
+Record = collections.namedtuple('Record', ['topic', 'partition', 'offset',
+                                           'value', 'key'])
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.captured = []
+
+    def captureException(self, **kwargs):
+        self.captured.append(kwargs)
+
+
+class FakeProducer(object):
+
+    def __init__(self, **options):
+        self.options = options
+        self.sent = []
+
+    async def start(self):
+        pass
+
+    async def send(self, topic, value=None, key=None, headers=None):
+        self.sent.append((topic, value, key, headers))
+        future = asyncio.Future()
+        future.set_result(None)
+        return future
+
+    async def stop(self):
+        pass
+
+
+class TestErrorReporter(object):
+
+    def test_errors_are_sampled_by_kind(self):
+        client = FakeClient()
+        errors = ErrorReporter(client, sample_burst=2)
+
+        for _ in range(5):
+            errors.report(ValueError('boom'), 'hello')
+        errors.report(KeyError('foo'), 'hello')
+        errors.report(ValueError('boom'), 'world')
+        errors.close()
+
+        assert len(client.captured) == 4
+        assert errors.stats() == {'errors': 7, 'errors_suppressed': 3}
+        assert client.captured[0]['tags'] == {'type_id': 'hello'}
+        assert client.captured[0]['exc_info'][0] is ValueError
+
+    def test_window_resets_samples(self):
+        client = FakeClient()
+        errors = ErrorReporter(client, sample_interval_ms=0, sample_burst=1)
+
+        for _ in range(3):
+            errors.report(ValueError('boom'), 'hello')
+        errors.close()
+
+        assert len(client.captured) == 3
+
+    def test_reports_are_dropped_when_queue_is_full(self):
+        client = FakeClient()
+        errors = ErrorReporter(client, max_queue=0)
+
+        errors.report(ValueError('boom'))
+        errors.close()
+
+        assert client.captured == []
+        assert errors.stats()['errors_suppressed'] == 1
+
+    def test_sent_reports_leave_the_queue(self):
+        client = FakeClient()
+        errors = ErrorReporter(client, sample_burst=1000, max_queue=1000)
+
+        for n in range(1000):
+            errors.report(ValueError('boom'), str(n % 10))
+        errors.close()
+
+        assert len(client.captured) == 1000
+        assert errors.queued == 0
+
+
+class TestDeadLetters(object):
+
+    def test_file_dead_letters(self, tmpdir, event_loop):
+        path = str(tmpdir.join('dead.jsonl'))
+        dead_letters = FileDeadLetters(path)
+
+        event_loop.run_until_complete(dead_letters.start())
+        event_loop.run_until_complete(dead_letters.send(
+            Record('logs', 1, 42, b'{"foo"', None), ValueError('bad'),
+            'hello'))
+        event_loop.run_until_complete(dead_letters.stop())
+
+        with open(path) as f:
+            letter = json.loads(f.readline())
+
+        assert letter['offset'] == 42
+        assert letter['type'] == 'hello'
+        assert letter['error_code'] == 'ValueError'
+        assert base64.b64decode(letter['value']) == b'{"foo"'
+
+    def test_kafka_dead_letters(self, event_loop):
+        dead_letters = KafkaDeadLetters('localhost:9092', 'dead',
+                                        loop=event_loop)
+        dead_letters.producer_class = FakeProducer
+
+        event_loop.run_until_complete(dead_letters.start())
+        event_loop.run_until_complete(dead_letters.send(
+            Record('logs', 1, 42, b'raw', b'key'), ValueError('bad')))
+
+        topic, value, key, headers = dead_letters.producer.sent[0]
+        assert (topic, value, key) == ('dead', b'raw', b'key')
+        assert ('moisturizer-offset', b'42') in headers
+        assert ('moisturizer-error_code', b'ValueError') in headers
+
+    def test_unknown_destination(self):
+        with pytest.raises(ValueError):
+            create_dead_letters({'errors.dead_letter': 'smtp'})
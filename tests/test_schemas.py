@@ -4,7 +4,13 @@ import colander
 import mock
 import pytest
 
-from moisturizer.schemas import InferredObjectSchema, InferredTypeSchema
+from moisturizer.models import DescriptorModel, DescriptorFieldType
+from moisturizer.schemas import (
+    CompiledObjectSchema,
+    InferredObjectSchema,
+    InferredTypeSchema,
+    SchemaCache,
+)
 
 
 @pytest.fixture()
@@ -110,3 +116,129 @@ class TestTypeSchema(object):
     def test_validate_type_schema(self, invalid_type_payload):
         with pytest.raises(colander.Invalid):
             InferredTypeSchema().deserialize(invalid_type_payload)
+
+
+@pytest.fixture()
+def descriptor():
+    descriptor = DescriptorModel(id='MyType')
+    descriptor.properties['foo'] = DescriptorFieldType(type='integer')
+    return descriptor
+
+
+class TestSchemaCache(object):
+
+    def test_schema_is_bound_once(self, descriptor):
+        cache = SchemaCache()
+        schema = cache.get(descriptor)
+        assert cache.get(descriptor) is schema
+        assert cache.stats() == {
+            'size': 1,
+            'hits': 1,
+            'misses': 1,
+            'hit_rate': 0.5,
+        }
+        assert schema.deserialize({'foo': '42'}) == {'foo': 42}
+
+    def test_new_revision_replaces_schema(self, descriptor):
+        cache = SchemaCache()
+        before = cache.get(descriptor)
+        descriptor.properties['bar'] = DescriptorFieldType(type='boolean')
+
+        after = cache.get(descriptor)
+        assert after is not before
+        assert after.deserialize({'bar': 'false'}) == {'bar': False}
+        assert cache.stats()['size'] == 1
+
+    def test_least_recently_used_are_evicted(self):
+        cache = SchemaCache(max_size=2)
+        first, second, third = [DescriptorModel(id=id_)
+                                for id_ in ('first', 'second', 'third')]
+
+        cache.get(first)
+        cache.get(second)
+        cache.get(first)
+        cache.get(third)
+
+        assert list(cache.revisions) == ['first', 'third']
+
+    def test_invalidate(self, descriptor):
+        cache = SchemaCache()
+        schema = cache.get(descriptor)
+        cache.invalidate('MyType')
+        assert cache.get(descriptor) is not schema
+
+
+CONFORMANCE_FIELDS = {
+    'string': DescriptorFieldType(type='string'),
+    'integer': DescriptorFieldType(type='integer'),
+    'number': DescriptorFieldType(type='number'),
+    'float': DescriptorFieldType(type='number', format='float'),
+    'double': DescriptorFieldType(type='number', format='double'),
+    'boolean': DescriptorFieldType(type='boolean'),
+    'date_time': DescriptorFieldType(type='string', format='date-time'),
+    'uuid': DescriptorFieldType(type='string', format='uuid'),
+    'object': DescriptorFieldType(type='object'),
+    'required': DescriptorFieldType(type='integer', required=True),
+}
+
+CONFORMANCE_VALUES = [
+    'abc', '', ' ', '42', '-4.2', 'nan', 'true', 'False', '0',
+    '2018-01-01T10:00:00', '2018-01-01T10:00:00+03:00', '2018-01-01',
+    'a long time ago',
+    42, 0, -1, 2 ** 70, 4.2, 0.0, True, False, None,
+    {}, {'a': 1}, [], [1], b'bytes',
+]
+
+
+def deserialize_result(schema, payload):
+    # Compares reprs, as NaN values are never equal.
+    try:
+        result = schema.deserialize(dict(payload))
+        return {k: repr(v) for k, v in result.items()}
+    except colander.Invalid as e:
+        return ('invalid', e.asdict())
+    except Exception as e:
+        return ('error', type(e))
+
+
+@pytest.fixture()
+def conformance_descriptor():
+    descriptor = DescriptorModel(id='MyType')
+    descriptor.properties.update(CONFORMANCE_FIELDS)
+    return descriptor
+
+
+class TestCompiledObjectSchema(object):
+
+    @pytest.mark.parametrize('field', sorted(CONFORMANCE_FIELDS))
+    def test_conforms_to_colander(self, conformance_descriptor, field):
+        schema = InferredObjectSchema().bind(
+            descriptor=conformance_descriptor)
+        compiled = CompiledObjectSchema(schema)
+
+        for value in CONFORMANCE_VALUES:
+            payload = {'required': 1, 'unknown': 'keep', field: value}
+            assert deserialize_result(compiled, payload) == \
+                deserialize_result(schema, payload), value
+
+    @pytest.mark.parametrize('payload', [
+        {},
+        {'required': None},
+        {'required': ''},
+        {'required': '3', 'id': 42, 'last_modified': '2018-01-01'},
+        {'required': 3, 'id': None, 'last_modified': 'yesterday'},
+        {'required': 3, 'nested': {'a': {'b': None}}},
+    ])
+    def test_conforms_on_envelope(self, conformance_descriptor, payload):
+        schema = InferredObjectSchema().bind(
+            descriptor=conformance_descriptor)
+        compiled = CompiledObjectSchema(schema)
+
+        assert deserialize_result(compiled, payload) == \
+            deserialize_result(schema, payload)
+
+    def test_compiled_engine(self, descriptor):
+        schema = SchemaCache(engine='compiled').get(descriptor)
+        assert isinstance(schema, CompiledObjectSchema)
+        assert schema.deserialize({'foo': '42', 'bar': None}) == {'foo': 42}
+        assert schema.flatten({'a': {'b': 1}}) == {'a__b': 1}
@@ -0,0 +1,63 @@
+import os
+import sys
+import time
+
+import pytest
+
+from moisturizer.config import load_settings
+from moisturizer.supervisor import Supervisor
+
+
+def exiting_worker(index, settings, reports):
+    reports.put((index, os.getpid(), {'consumed': index + 1}))
+    sys.exit(1)
+
+
+def idle_worker(index, settings, reports):
+    time.sleep(60)
+
+
+def wait_for_exit(supervisor):
+    for process in supervisor.processes.values():
+        process.join(5)
+
+
+@pytest.fixture()
+def settings():
+    return load_settings(**{'supervisor.shutdown_timeout_ms': 5000})
+
+
+class TestSupervisor(object):
+
+    def test_exited_workers_are_restarted(self, settings):
+        supervisor = Supervisor(settings, workers=2, target=exiting_worker)
+        for index in range(2):
+            supervisor.spawn(index)
+        first = {p.pid for p in supervisor.processes.values()}
+
+        wait_for_exit(supervisor)
+        time.sleep(0.1)
+        supervisor.collect()
+        supervisor.check()
+
+        assert {p.pid for p in supervisor.processes.values()} != first
+        health = supervisor.health()
+        assert health['restarts'] == 2
+        assert health['stats'] == {'consumed': 3}
+
+        supervisor.stop()
+        supervisor.shutdown()
+
+    def test_shutdown_terminates_workers(self, settings):
+        supervisor = Supervisor(settings, workers=2, target=idle_worker)
+        for index in range(2):
+            supervisor.spawn(index)
+        assert supervisor.health()['alive'] == 2
+
+        supervisor.shutdown()
+        assert supervisor.health()['alive'] == 0
+        assert [p.exitcode for p in supervisor.processes.values()] == \
+            [-15, -15]
+
+    def test_workers_default_to_cpu_count(self, settings):
+        assert Supervisor(settings).workers == os.cpu_count()
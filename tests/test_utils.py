@@ -0,0 +1,73 @@
+import datetime
+
+import flatten_json
+import pytest
+
+from moisturizer.utils import KeyCache, flatten_object, timestamp_micros
+
+
+PAYLOADS = [
+    {},
+    {'a': 1, 'b': None, 'c': 'x'},
+    {'a': {'b': {'c': 1, 'd': None}}, 'e': [1, {'f': 2}, [3]]},
+    {'a': [], 'b': {}, 'c': 0, 'd': False, 'e': ''},
+    {'': {'a': 1}, 'b': {'': 2}},
+    {'a': (1, 2), 'b': [None, 1]},
+]
+
+
+@pytest.fixture()
+def keys():
+    return KeyCache(separator='__')
+
+
+class TestFlattenObject(object):
+
+    @pytest.mark.parametrize('payload', PAYLOADS)
+    def test_matches_flatten_json(self, keys, payload):
+        expected = {k: v for k, v in
+                    flatten_json.flatten(payload, separator='__').items()
+                    if v is not None}
+        flatten, _ = flatten_object(payload, keys)
+        assert flatten == expected
+        assert list(flatten) == list(expected)
+
+    def test_infers_missing_keys(self, keys):
+        flatten, inferred = flatten_object(
+            {'a': 1, 'b': {'c': 'x'}}, keys, known={'a'}, infer=type)
+        assert flatten == {'a': 1, 'b__c': 'x'}
+        assert inferred == {'b__c': str}
+
+    def test_key_cache(self):
+        keys = KeyCache(separator='__', max_size=2)
+        assert keys.join('a', 'b') is keys.join('a', 'b')
+        assert keys.join('a', 0) == 'a__0'
+        assert keys.size == 2
+
+        keys.join('b', 'c')
+        assert keys.size == 1
+
+    def test_key_cache_bounds_keys_of_a_prefix(self):
+        keys = KeyCache(separator='__', max_size=100)
+        for n in range(10000):
+            assert keys.join('map', n) == 'map__{}'.format(n)
+        assert keys.size <= 100
+        assert sum(len(children) for children in keys.keys.values()) <= 100
+
+
+class TestTimestampMicros(object):
+
+    @pytest.mark.parametrize('value', [
+        datetime.datetime(2017, 7, 14, 2, 40),
+        '2017-07-14T02:40:00Z',
+        '2017-07-14T04:40:00+02:00',
+        1500000000,
+        1500000000000,
+        1500000000000000,
+    ])
+    def test_timestamps(self, value):
+        assert timestamp_micros(value) == 1500000000000000
+
+    @pytest.mark.parametrize('value', [None, True, 'soon', {}])
+    def test_not_timestamps(self, value):
+        assert timestamp_micros(value) is None
@@ -0,0 +1,252 @@
+import asyncio
+import datetime
+
+import pytest
+from cassandra.cqlengine import ValidationError, columns
+
+from moisturizer.models import (
+    DescriptorModel,
+    DescriptorFieldType,
+    InferredModel,
+)
+from moisturizer.writer import BatchWriter
+
+
+class ClusteredModel(InferredModel):
+    __table_name__ = 'clustered'
+    seq = columns.Integer(primary_key=True)
+
+
+async def write_all(writer):
+    await writer.flush()
+    await writer.drain()
+
+
+@pytest.fixture()
+def model():
+    descriptor = DescriptorModel(id='hello')
+    descriptor.properties['foo'] = DescriptorFieldType(type='string')
+    descriptor.properties['bar'] = DescriptorFieldType(type='string')
+    return descriptor.model
+
+
+@pytest.fixture()
+def writer(session):
+    return BatchWriter(session, max_messages=3, max_batch_statements=2)
+
+
+class TestBatchWriter(object):
+
+    def test_due_by_size(self, writer, model):
+        writer.add('hello', model(id='1'))
+        writer.add('hello', model(id='2'))
+        assert not writer.due
+        writer.add('hello', model(id='3'))
+        assert writer.due
+
+    def test_due_by_latency(self, session, model):
+        writer = BatchWriter(session, max_latency_ms=0)
+        assert writer.timeout is None
+        writer.add('hello', model(id='1'))
+        assert writer.due
+        assert writer.timeout == 0
+
+    def test_disabled_flushes_every_message(self, session, model):
+        writer = BatchWriter(session, enabled=False)
+        writer.add('hello', model(id='1'))
+        assert writer.due
+
+    def test_single_partitions_are_single_writes(self, writer, model,
+                                                 session, event_loop):
+        writer.add('hello', model(id='1', foo='a'))
+        writer.add('hello', model(id='2', foo='b'))
+        event_loop.run_until_complete(write_all(writer))
+
+        assert len(session.executed) == 2
+        for query, parameters in session.executed:
+            assert query.startswith('INSERT INTO test.hello')
+        assert writer.size == 0
+        assert not writer.pending
+
+    def test_partition_rows_are_batched(self, writer, session, event_loop):
+        for seq in range(3):
+            writer.add('clustered', ClusteredModel(id='1', seq=seq))
+        event_loop.run_until_complete(write_all(writer))
+
+        (first, parameters), (second, _) = session.executed
+        assert first.startswith('BEGIN UNLOGGED BATCH')
+        assert first.count('INSERT INTO test.clustered') == 2
+        assert len(parameters) == 6
+        assert second.startswith('INSERT INTO test.clustered')
+
+    def test_repeated_primary_keys_are_split(self, model, session,
+                                             event_loop):
+        writer = BatchWriter(session, coalesce=False)
+        writer.add('hello', model(id='1', foo='a'))
+        writer.add('hello', model(id='1', foo='b'))
+        event_loop.run_until_complete(write_all(writer))
+
+        assert [parameters['2'] for _, parameters in session.executed] == \
+            ['a', 'b']
+
+    def test_batches_respect_byte_threshold(self, session, event_loop):
+        writer = BatchWriter(session, max_batch_bytes=20)
+        for seq in range(2):
+            writer.add('clustered', ClusteredModel(id='1', seq=seq))
+        event_loop.run_until_complete(write_all(writer))
+
+        assert len(session.executed) == 2
+
+    def test_window_bounds_in_flight_writes(self, session, model,
+                                            event_loop):
+        writer = BatchWriter(session, max_in_flight=2)
+        session.gate.clear()
+
+        for id_ in ('1', '2', '3'):
+            writer.add('hello', model(id=id_))
+        flush = event_loop.create_task(writer.flush())
+        event_loop.run_until_complete(asyncio.sleep(0.01))
+
+        assert writer.full
+        assert not flush.done()
+        assert len(session.started) == 2
+
+        session.gate.set()
+        event_loop.run_until_complete(flush)
+        event_loop.run_until_complete(writer.drain())
+        assert len(session.executed) == 3
+        assert not writer.full
+
+    def test_partition_writes_are_ordered(self, session, model, event_loop):
+        writer = BatchWriter(session)
+        session.gate.clear()
+
+        for foo in ('a', 'b', 'c'):
+            writer.add('hello', model(id='1', foo=foo))
+            event_loop.run_until_complete(writer.flush())
+        writer.add('hello', model(id='2', foo='d'))
+        event_loop.run_until_complete(writer.flush())
+        event_loop.run_until_complete(asyncio.sleep(0.01))
+
+        assert [p['2'] for _, p in session.started] == ['a', 'd']
+
+        session.gate.set()
+        event_loop.run_until_complete(writer.drain())
+        assert [p['2'] for _, p in session.executed
+                if p['0'] == '1'] == ['a', 'b', 'c']
+        assert not writer.tails
+
+    def test_write_errors_are_handled(self, session, model, event_loop):
+        errors = []
+        attempts = []
+        writer = BatchWriter(session, max_retries=2, retry_delay_ms=0,
+                             on_error=errors.append)
+
+        async def execute_future(query, parameters=None):
+            attempts.append(query)
+            raise RuntimeError('unavailable')
+
+        session.execute_future = execute_future
+        writer.add('hello', model(id='1'))
+        event_loop.run_until_complete(write_all(writer))
+
+        assert len(attempts) == 3
+        assert [str(e) for e in errors] == ['unavailable']
+        assert not writer.in_flight
+
+    def test_failed_writes_are_handed_over(self, session, model,
+                                           event_loop):
+        failed = []
+
+        async def on_failure(exception, acks, type_id=None):
+            failed.append((str(exception), len(acks), type_id))
+
+        writer = BatchWriter(session, max_retries=0, on_failure=on_failure)
+
+        async def execute_future(query, parameters=None):
+            raise RuntimeError('unavailable')
+
+        session.execute_future = execute_future
+        writer.add('hello', model(id='1'), lambda: None)
+        writer.add('hello', model(id='2'), lambda: None)
+        event_loop.run_until_complete(write_all(writer))
+
+        assert failed == [('unavailable', 1, 'hello')] * 2
+
+    def test_transient_write_errors_are_retried(self, session, model,
+                                                event_loop):
+        acked = []
+        failures = iter([RuntimeError('timeout')])
+        execute = session.execute_future
+
+        async def execute_future(query, parameters=None):
+            for failure in failures:
+                raise failure
+            return await execute(query, parameters)
+
+        session.execute_future = execute_future
+        writer = BatchWriter(session, retry_delay_ms=0)
+        writer.add('hello', model(id='1'), lambda: acked.append(1))
+        event_loop.run_until_complete(write_all(writer))
+
+        assert len(session.executed) == 1
+        assert acked == [1]
+
+    def test_invalid_models_are_not_added(self, writer, model, session,
+                                          event_loop):
+        writer.add('hello', model(id='1', foo='a'))
+        with pytest.raises(ValidationError):
+            writer.add('hello', model(id='2', foo=1))
+        writer.add('hello', model(id='3', foo='c'))
+        event_loop.run_until_complete(write_all(writer))
+
+        assert sorted(p['0'] for _, p in session.executed) == ['1', '3']
+
+
+class TestCoalescing(object):
+
+    def test_same_row_writes_are_merged(self, model, session, event_loop):
+        writer = BatchWriter(session)
+        acked = []
+        writer.add('hello', model(id='1', foo='a'), lambda: acked.append(1))
+        writer.add('hello', model(id='1', bar='b'), lambda: acked.append(2))
+        writer.add('hello', model(id='1', foo='c'), lambda: acked.append(3))
+        writer.add('hello', model(id='2', foo='d'))
+        event_loop.run_until_complete(write_all(writer))
+
+        rows = {p['0']: p for _, p in session.executed}
+        assert sorted(rows) == ['1', '2']
+        assert set(rows['1'].values()) >= {'c', 'b'}
+        assert 'a' not in rows['1'].values()
+        assert acked == [1, 2, 3]
+        assert writer.coalesced == 2
+
+    def test_newest_event_wins(self, model, session, event_loop):
+        writer = BatchWriter(session)
+        newer = datetime.datetime(2017, 1, 2)
+        older = datetime.datetime(2017, 1, 1)
+        writer.add('hello', model(id='1', foo='new',
+                                  last_modified=newer).timestamp(5))
+        writer.add('hello', model(id='1', foo='old', bar='b',
+                                  last_modified=older).timestamp(5))
+        event_loop.run_until_complete(write_all(writer))
+
+        (query, parameters), = session.executed
+        assert set(parameters.values()) >= {'new', 'b'}
+        assert 'old' not in parameters.values()
+        assert query.endswith('USING TIMESTAMP 5')
+
+    def test_writes_keep_their_timestamps(self, model, session, event_loop):
+        writer = BatchWriter(session)
+        writer.add('hello', model(id='1', foo='a').timestamp(1000))
+        writer.add('hello', model(id='1', bar='b').timestamp(3000))
+        writer.add('hello', model(id='1', foo='c').timestamp(3000))
+        event_loop.run_until_complete(write_all(writer))
+
+        writes = [(query.rsplit(' ', 1)[1], set(parameters.values()))
+                  for query, parameters in session.executed]
+        assert len(writes) == 2
+        assert writes[0][0] == '1000' and 'a' in writes[0][1]
+        assert writes[1][0] == '3000' and writes[1][1] >= {'b', 'c'}
+        assert 'a' not in writes[1][1]
+        assert writer.coalesced == 1